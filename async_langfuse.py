@@ -1,11 +1,22 @@
 import aiohttp
-import json
+import asyncio
+import math
 import os
+import random
+import uuid
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
+from cache import is_closed_page, is_closed_query, is_complete_observation, is_complete_trace, query_key
+from langfuse_common import format_timestamp, group_by_trace, incomplete_indices, parse_timestamp, trace_windows
+from instrumentation import metrics
+from rules import compile_rules
+
+
 class FetchLangfuse:
     """
     A class for fetching data from Langfuse API
     """
-    def __init__(self, secret_key=None, public_key=None, host=None):
+    def __init__(self, secret_key=None, public_key=None, host=None, limit=100, limit_per_host=None, ttl_dns_cache=300, keepalive_timeout=30, timeout=None, scheduler=None, fanout=8, cache=None, offline=False):
         """
         Initialize FetchLangfuse with secret key, public key, and host
 
@@ -13,22 +24,166 @@ class FetchLangfuse:
             secret_key (str): The secret key for authentication
             public_key (str): The public key for authentication
             host (str): The host URL for the Langfuse API
+            limit (int, optional): The total number of pooled connections. Defaults to 100.
+            limit_per_host (int, optional): The number of pooled connections per host. Defaults to LANGFUSE_LIMIT_PER_HOST or 0 (unlimited).
+            ttl_dns_cache (int, optional): Seconds to cache DNS lookups. Defaults to 300.
+            keepalive_timeout (float, optional): Seconds to keep idle connections alive. Defaults to 30.
+            timeout (float, optional): Total timeout of a single request in seconds. Defaults to None.
+            scheduler (StageScheduler, optional): A scheduler whose "langfuse" stage bounds concurrent requests. Defaults to None.
+            fanout (int, optional): The number of concurrent requests at each crawl level. Defaults to 8.
+            cache (SQLiteCache, optional): A persistent cache of traces, observations and sessions. Defaults to None.
+            offline (bool, optional): Serve every request from the cache and never call the API. Defaults to False.
         """
         self.secret_key = secret_key or os.getenv('LANGFUSE_SECRET_KEY')
         self.public_key = public_key or os.getenv('LANGFUSE_PUBLIC_KEY')
         self.host = host or os.getenv('LANGFUSE_HOST')
+        self.limit = limit
+        self.limit_per_host = limit_per_host if limit_per_host is not None else int(os.getenv('LANGFUSE_LIMIT_PER_HOST', 0))
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.scheduler = scheduler
+        self.fanout = fanout
+        self.cache = cache
+        self.offline = offline
+        self._session = None
+
+    async def __aenter__(self):
+        self.get_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def get_session(self):
+        """
+        Get the shared client session, creating it on first use
+
+        Returns:
+            aiohttp.ClientSession: The pooled keep-alive session
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.ttl_dns_cache,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                auth=aiohttp.BasicAuth(self.public_key, self.secret_key),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def close(self):
+        """
+        Close the shared client session and its pooled connections
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _stage(self):
+        """
+        Get the scheduler slot guarding a single request
+
+        Returns:
+            An async context manager holding a "langfuse" slot, or a no-op one without scheduler
+        """
+        if self.scheduler is None:
+            return nullcontext()
+        return self.scheduler.stage("langfuse")
+
+    async def _get(self, url, params=None):
+        """
+        Send a GET request through the shared session
+
+        Args:
+            url (str): The request URL
+            params (dict, optional): Query parameters, None values are dropped. Defaults to None.
+
+        Returns:
+            dict: The JSON response
+        """
+        if params:
+            params = {key: value for key, value in params.items() if value is not None}
+        async with self._stage():
+            with metrics.timer("langfuse_get"):
+                async with self.get_session().get(url, params=params) as response:
+                    return await response.json()
+
+    async def _get_cached(self, kind, id, url, params=None, version=None, cacheable=bool, serve_online=True):
+        """
+        Send a GET request through the cache
 
-    async def fetch_sessions(self):
+        Args:
+            kind (str): The kind of the cache entry, e.g. "trace"
+            id (str): The ID of the cache entry
+            url (str): The request URL
+            params (dict, optional): Query parameters. Defaults to None.
+            version (str, optional): The expected version of a cached entry, e.g. an updatedAt. Defaults to None.
+            cacheable (callable, optional): Whether a response may be stored. Defaults to bool.
+            serve_online (bool, optional): Whether cached entries are served when not offline; mutable
+                resources such as sessions and list pages are only served offline. Defaults to True.
+
+        Returns:
+            dict: The JSON response
+
+        Raises:
+            LookupError: If offline and the entry is not cached
         """
-        Fetch all sessions from Langfuse API
+        # SQLite calls run in a worker thread so that they do not block the event loop
+        if self.cache is not None and (self.offline or serve_online):
+            value = await asyncio.to_thread(self.cache.get, kind, id, version)
+            if value is not None:
+                return value
+        if self.offline:
+            raise LookupError(f"{kind} {id} is not cached and offline mode is on")
+        value = await self._get(url, params=params)
+        if self.cache is not None and cacheable(value):
+            await asyncio.to_thread(self.cache.put, kind, id, value, version=value.get('updatedAt'))
+        return value
+
+    async def _post(self, url, payload):
+        """
+        Send a JSON POST request through the shared session
+
+        Args:
+            url (str): The request URL
+            payload (dict): The JSON body
+
+        Returns:
+            str: The response text
+        """
+        async with self._stage():
+            with metrics.timer("langfuse_post"):
+                async with self.get_session().post(url, json=payload) as response:
+                    return await response.text()
+
+    async def fetch_sessions(self, page: int = None, limit: int = None, fromTimestamp: str = None, toTimestamp: str = None):
+        """
+        Fetch one page of sessions from Langfuse API
+
+        Args:
+            page (int, optional): The page number. Defaults to None.
+            limit (int, optional): The limit of sessions per page. Defaults to None.
+            fromTimestamp (str, optional): The start of the creation time range. Defaults to None.
+            toTimestamp (str, optional): The end of the creation time range. Defaults to None.
 
         Returns:
             dict: The JSON response containing the sessions
         """
         url = f"{self.host}/api/public/sessions"
-        async with aiohttp.ClientSession(auth=aiohttp.BasicAuth(self.public_key, self.secret_key)) as session:
-            async with session.get(url) as response:
-                return await response.json()
+        params = {
+            "page": page,
+            "limit": limit,
+            "fromTimestamp": fromTimestamp,
+            "toTimestamp": toTimestamp
+        }
+        return await self._get_cached(
+            'sessions', query_key(url, params), url, params=params,
+            cacheable=lambda response: is_closed_page(response, params), serve_online=False)
 
     async def fetch_session(self, session_id):
         """
@@ -41,24 +196,43 @@ class FetchLangfuse:
             dict: The JSON response containing the session
         """
         url = f"{self.host}/api/public/sessions/{session_id}"
-        async with aiohttp.ClientSession(auth=aiohttp.BasicAuth(self.public_key, self.secret_key)) as session:
-            async with session.get(url) as response:
-                return await response.json()
+        return await self._get_cached(
+            'session', session_id, url,
+            cacheable=lambda session: 'traces' in session, serve_online=False)
 
-    async def fetch_trace(self, trace_id):
+    async def fetch_dataset_items(self, page: int = None, limit: int = None, dataset_name: str = None):
+        """
+        Fetch one page of dataset items from Langfuse API, newest first
+
+        Args:
+            page (int, optional): The page number. Defaults to None.
+            limit (int, optional): The limit of items per page. Defaults to None.
+            dataset_name (str, optional): The name of the dataset. Defaults to None.
+
+        Returns:
+            dict: The JSON response containing the dataset items
+        """
+        url = f"{self.host}/api/public/dataset-items"
+        params = {
+            "page": page,
+            "limit": limit,
+            "datasetName": dataset_name
+        }
+        return await self._get(url, params=params)
+
+    async def fetch_trace(self, trace_id, updated_at=None):
         """
         Fetch a specific trace from Langfuse API
 
         Args:
             trace_id (str): The ID of the trace
+            updated_at (str, optional): The known updatedAt of the trace, a cached copy of another version is refetched. Defaults to None.
 
         Returns:
             dict: The JSON response containing the trace
         """
         url = f"{self.host}/api/public/traces/{trace_id}"
-        async with aiohttp.ClientSession(auth=aiohttp.BasicAuth(self.public_key, self.secret_key)) as session:
-            async with session.get(url) as response:
-                return await response.json()
+        return await self._get_cached('trace', trace_id, url, version=updated_at, cacheable=is_complete_trace)
 
     async def fetch_observations(self, page: int = None, limit: int = None, name: str = None, userId: str = None, type: str = None, traceId: str = None, parentObservationId: str = None, fromStartTime: str = None, toStartTime: str = None, version: str = None):
         """
@@ -78,8 +252,13 @@ class FetchLangfuse:
 
         Returns:
             dict: The JSON response containing the observations
+
+        Raises:
+            LookupError: If offline and the time range of the query has not ended, such a page is never cached
         """
         url = f"{self.host}/api/public/observations"
+        if self.offline and not is_closed_query({"toStartTime": toStartTime}):
+            raise LookupError(f"Observations started until {toStartTime} are still changing and cannot be served offline")
         params = {
             "page": page,
             "limit": limit,
@@ -92,9 +271,121 @@ class FetchLangfuse:
             "toStartTime": toStartTime,
             "version": version
         }
-        async with aiohttp.ClientSession(auth=aiohttp.BasicAuth(self.public_key, self.secret_key)) as session:
-            async with session.get(url, params=params) as response:
-                return await response.json()
+        response = await self._get_cached(
+            'observations', query_key(url, params), url, params=params,
+            cacheable=lambda response: is_closed_page(response, params), serve_online=False)
+        if self.cache is not None and not self.offline:
+            await asyncio.to_thread(self.cache.put_many, 'observation', [
+                (observation['id'], observation, observation.get('updatedAt'))
+                for observation in response.get('data', []) if is_complete_observation(observation)])
+        return response
+
+    async def fetch_observations_in_window(self, from_time, to_time, page_size=100, **query):
+        """
+        Fetch every observation started within a time window, page by page
+
+        Args:
+            from_time (datetime): The start of the window
+            to_time (datetime): The end of the window
+            page_size (int, optional): The number of observations per page. Defaults to 100.
+            **query: Extra query parameters such as name, type or traceId
+
+        Returns:
+            list: A list of observations
+        """
+        return [observation async for observation in self.iter_observations(
+            page_size=page_size,
+            fromStartTime=format_timestamp(from_time),
+            toStartTime=format_timestamp(to_time),
+            **query
+        )]
+
+    async def iter_pages(self, fetch_page, page_size=50, prefetch=True, **params):
+        """
+        Walk every page of a paginated endpoint, fetching the next page while the current one is consumed
+
+        Args:
+            fetch_page (callable): A coroutine function taking page, limit and params, e.g. fetch_observations
+            page_size (int, optional): The number of items per page. Defaults to 50.
+            prefetch (bool, optional): Whether to request the next page before the current one is consumed.
+                Turn it off when the caller usually stops early. Defaults to True.
+            **params: Extra query parameters passed to every page
+
+        Yields:
+            dict: Each item of each page
+        """
+        page = 1
+        next_page = asyncio.create_task(fetch_page(page=page, limit=page_size, **params))
+        try:
+            while next_page is not None:
+                response = await next_page
+                next_page = None
+                more = page < response.get('meta', {}).get('totalPages', page)
+                if more and prefetch:
+                    page += 1
+                    next_page = asyncio.create_task(fetch_page(page=page, limit=page_size, **params))
+                for item in response['data']:
+                    yield item
+                if more and not prefetch:
+                    page += 1
+                    next_page = asyncio.create_task(fetch_page(page=page, limit=page_size, **params))
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def iter_sessions(self, page_size=50, **params):
+        """
+        Iterate over all sessions page by page
+
+        Args:
+            page_size (int, optional): The number of sessions per page. Defaults to 50.
+            **params: Extra query parameters of fetch_sessions
+
+        Yields:
+            dict: Each session
+        """
+        async for session in self.iter_pages(self.fetch_sessions, page_size=page_size, **params):
+            yield session
+
+    async def iter_observations(self, page_size=100, **params):
+        """
+        Iterate over all observations matching a query page by page
+
+        Args:
+            page_size (int, optional): The number of observations per page. Defaults to 100.
+            **params: Extra query parameters of fetch_observations
+
+        Yields:
+            dict: Each observation
+        """
+        async for observation in self.iter_pages(self.fetch_observations, page_size=page_size, **params):
+            yield observation
+
+    async def map_concurrent(self, func, items, ordered=True):
+        """
+        Apply a coroutine function to items with bounded fan-out, yielding results as they resolve
+
+        Args:
+            func (callable): The coroutine function to apply
+            items (list): The items to apply the function to
+            ordered (bool, optional): Whether to yield results in input order. Defaults to True.
+
+        Yields:
+            The result of each call
+        """
+        semaphore = asyncio.Semaphore(self.fanout)
+
+        async def run(item):
+            async with semaphore:
+                return await func(item)
+
+        tasks = [asyncio.create_task(run(item)) for item in items]
+        try:
+            for task in (tasks if ordered else asyncio.as_completed(tasks)):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
 
     async def fetch_observation(self, observation_id):
         """
@@ -107,9 +398,7 @@ class FetchLangfuse:
             dict: The JSON response containing the observation
         """
         url = f"{self.host}/api/public/observations/{observation_id}"
-        async with aiohttp.ClientSession(auth=aiohttp.BasicAuth(self.public_key, self.secret_key)) as session:
-            async with session.get(url) as response:
-                return await response.json()
+        return await self._get_cached('observation', observation_id, url, cacheable=is_complete_observation)
 
     async def fetch_node_observations(self, session_id, rules):
         """
@@ -122,19 +411,9 @@ class FetchLangfuse:
         Returns:
             list: A list of node observations
         """
-        node_observations = []
         session = await self.fetch_session(session_id)
         session_traces = await self.fetch_session_traces(session)
-        for session_trace in session_traces:
-            trace = await self.fetch_trace(session_trace["id"])
-            trace_observations = trace["observations"]
-            selected_ids = self.select_ids(trace_observations, rules)
-            if selected_ids:
-                for selected_id in selected_ids:
-                    observation_id = selected_id[0]
-                    observation = await self.fetch_observation(observation_id)
-                    node_observations.append(observation)
-        return node_observations
+        return await self.fetch_traces_selected_observations(session_traces, rules)
 
     async def fetch_session_traces(self, session):
         """
@@ -149,36 +428,91 @@ class FetchLangfuse:
         traces = session["traces"]
         return traces
 
-    async def fetch_trace_observations(self, trace_id):
+    async def fetch_trace_observations(self, trace_id, updated_at=None):
         """
         Fetch observations for a specific trace
 
         Args:
             trace_id (str): The ID of the trace
+            updated_at (str, optional): The known updatedAt of the trace. Defaults to None.
 
         Returns:
             list: A list of observations
         """
-        trace = await self.fetch_trace(trace_id)
+        trace = await self.fetch_trace(trace_id, updated_at=updated_at)
         observations = trace["observations"]
         return observations
 
+    async def complete_observations(self, observations):
+        """
+        Fetch the full body of observations that lack their input or output
+
+        Args:
+            observations (list): A list of observations
+
+        Returns:
+            list: The observations, with incomplete ones fetched again by ID
+        """
+        incomplete = incomplete_indices(observations)
+        fetched = [observation async for observation in self.map_concurrent(
+            self.fetch_observation, [observations[index]['id'] for index in incomplete])]
+        observations = list(observations)
+        for index, observation in zip(incomplete, fetched):
+            observations[index] = observation
+        return observations
+
+    async def fetch_traces_selected_observations(self, traces, rules, slack=600, max_window=600):
+        """
+        Fetch selected observations of several traces with a few time-windowed list queries.
+
+        The traces are grouped into windows of at most max_window seconds, one list query each, so a
+        session spread over hours only queries the minutes around its traces. The predicates of the
+        rules the API can evaluate are sent as query parameters and only the rest is applied locally.
+        Traces without a timestamp, or without any observation in their window, fall back to one GET
+        of the trace itself, whose payload already contains its observations.
+
+        Args:
+            traces (list): A list of traces, e.g. the traces of a session
+            rules (list): A list of rules to filter the observations
+            slack (float, optional): Seconds each window is widened by on both ends. Defaults to 600.
+            max_window (float, optional): The largest number of seconds between the first and last trace of a window. Defaults to 600.
+
+        Returns:
+            list: A list of selected observations, in trace order
+        """
+        query, residual = compile_rules(rules).split()
+        updated_at = {trace['id']: trace.get('updatedAt') for trace in traces}
+        timestamps = [parse_timestamp(trace['timestamp']) for trace in traces if trace.get('timestamp')]
+        windows = trace_windows(timestamps, slack, max_window)
+        pages = [observations async for observations in self.map_concurrent(
+            lambda window: self.fetch_observations_in_window(*window, **query), windows)]
+        trace_observations = group_by_trace([trace['id'] for trace in traces], pages)
+        for trace_id, observations in trace_observations.items():
+            trace_observations[trace_id] = self.select_data(observations, residual)
+
+        missing = [trace_id for trace_id, observations in trace_observations.items() if not observations]
+        fetched = [observations async for observations in self.map_concurrent(
+            lambda trace_id: self.fetch_trace_observations(trace_id, updated_at[trace_id]), missing)]
+        for trace_id, observations in zip(missing, fetched):
+            trace_observations[trace_id] = self.select_data(observations, rules)
+
+        selected_observations = []
+        for observations in trace_observations.values():
+            selected_observations.extend(observations)
+        return await self.complete_observations(selected_observations)
+
     def select_ids(self, data, rules):
         """
         Select IDs based on rules
 
         Args:
             data (list): The data to filter
-            rules (list): A list of rules to filter the data
+            rules (list): A list of rules to filter the data, or a RuleSet
 
         Returns:
-            list: A list of selected IDs
+            list: A list of selected (ID, index) pairs
         """
-        selected_ids = []
-        for item in data:
-            if all(rule(item) for rule in rules):
-                selected_ids.append((item['id'], data.index(item)))
-        return selected_ids
+        return [(data[index]['id'], index) for index in compile_rules(rules).select_indices(data)]
     
     def select_data(self, data, rules):
         """
@@ -186,16 +520,12 @@ class FetchLangfuse:
 
         Args:
             data (list): The data to filter
-            rules (list): A list of rules to filter the data
+            rules (list): A list of rules to filter the data, or a RuleSet
 
         Returns:
             list: A list of selected data
         """
-        selected_data = []
-        for item in data:
-            if all(rule(item) for rule in rules):
-                selected_data.append(item)
-        return selected_data
+        return [data[index] for index in compile_rules(rules).select_indices(data)]
 
     async def get_selected_observations(self, rules):
         """
@@ -207,18 +537,8 @@ class FetchLangfuse:
         Returns:
             list: A list of selected observations
         """
-        selected_observations = []
-        sessions = await self.fetch_sessions()
-        for session in sessions['data']:
-            session_id = session['id']
-            traces = await self.fetch_session_traces(await self.fetch_session(session_id))
-            for trace in traces:
-                trace_id = trace['id']
-                observations = await self.fetch_trace_observations(trace_id)
-                selected_ids = self.select_ids(observations, rules)
-                if selected_ids:
-                    selected_observations.extend([await self.fetch_observation(selected_id[0]) for selected_id in selected_ids])
-        return selected_observations
+        sessions_ids = [session['id'] async for session in self.iter_sessions()]
+        return await self.get_sessions_selected_observations(sessions_ids, rules)
 
     async def get_sessions_selected_observations(self, sessions_ids, rules):
         """
@@ -232,20 +552,36 @@ class FetchLangfuse:
             list: A list of selected observations
         """
         selected_observations = []
-        for session_id in sessions_ids:
-            traces = await self.fetch_session_traces(await self.fetch_session(session_id))
-            for trace in traces:
-                trace_id = trace['id']
-                observations = await self.fetch_trace_observations(trace_id)
-                selected_ids = self.select_ids(observations, rules)
-                if selected_ids:
-                    selected_observations.extend([await self.fetch_observation(selected_id[0]) for selected_id in selected_ids])
+        async for observations in self.iter_sessions_selected_observations(sessions_ids, rules, ordered=True):
+            selected_observations.extend(observations)
         return selected_observations
+
+    async def iter_sessions_selected_observations(self, sessions_ids, rules, ordered=False):
+        """
+        Crawl sessions concurrently, yielding the selected observations of each session as it resolves.
+
+        Args:
+            sessions_ids (list): A list of session IDs
+            rules (list): A list of rules to filter the observations
+            ordered (bool, optional): Whether to yield sessions in input order. Defaults to False.
+
+        Yields:
+            list: The selected observations of one session
+        """
+        async def crawl_session(session_id):
+            traces = await self.fetch_session_traces(await self.fetch_session(session_id))
+            return await self.fetch_traces_selected_observations(traces, rules)
+
+        async for observations in self.map_concurrent(crawl_session, sessions_ids, ordered=ordered):
+            yield observations
     
     async def get_trace_selected_observations(self, trace_id, rules):
         """
         Fetches selected observations based on given rules from a specific trace.
 
+        If some predicates of the rules can be evaluated by the API, only the matching
+        observations of the trace are listed; otherwise the whole trace is fetched.
+
         Args:
             trace_id (str): The ID of the trace
             rules (list): A list of rules to filter the observations
@@ -253,9 +589,29 @@ class FetchLangfuse:
         Returns:
             list: A list of selected observations
         """
+        query, residual = compile_rules(rules).split()
+        if query:
+            query['traceId'] = trace_id
+            observations = [observation async for observation in self.iter_observations(**query)]
+            return await self.complete_observations(self.select_data(observations, residual))
         observations = await self.fetch_trace_observations(trace_id)
-        return self.select_data(observations, rules)
+        return await self.complete_observations(self.select_data(observations, rules))
     
+    def is_trace_ready(self, observations, expected_count=1):
+        """
+        Check whether the selected observations of a trace are completely ingested
+
+        Args:
+            observations (list): The observations selected from the trace
+            expected_count (int, optional): The number of node observations the trace must contain. Defaults to 1.
+
+        Returns:
+            bool: True if enough observations are present and all of them have ended
+        """
+        if len(observations) < expected_count:
+            return False
+        return all(observation.get('endTime') for observation in observations)
+
     async def pull_score_to_langfuse(self, score, trace_id, observation_id, name):
         """
         Pull a single score to Langfuse asynchronously.
@@ -267,11 +623,23 @@ class FetchLangfuse:
             name (str): The name of the score.
 
         """
-        from datetime import datetime
         url = f"{self.host}/api/public/scores"
-        headers = {
-            "Content-Type": "application/json"
-        }
+        payload = self.score_payload(score, trace_id, observation_id, name)
+        return await self._post(url, payload)
+
+    def score_payload(self, score, trace_id, observation_id, name):
+        """
+        Build the body of a score, its ID is derived from the trace, observation and name so that re-sending it updates the same score
+
+        Args:
+            score (float): The score.
+            trace_id (str): The trace ID.
+            observation_id (str): The observation ID.
+            name (str): The name of the score.
+
+        Returns:
+            dict: The score body
+        """
         payload = {
             "id": f"{trace_id}-{observation_id}-{name}" if observation_id else f"{trace_id}-{name}",
             "traceId": trace_id,
@@ -282,8 +650,366 @@ class FetchLangfuse:
         }
         if observation_id is None:
             del payload["observationId"]
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, auth=aiohttp.BasicAuth(self.public_key, self.secret_key), headers=headers, data=json.dumps(payload)) as response:
-                return await response.text()
-        
+        return payload
+
+    async def ingest(self, batch):
+        """
+        Send a batch of events to the Langfuse batch ingestion endpoint
 
+        Args:
+            batch (list): A list of ingestion events
+
+        Returns:
+            tuple: (status, response), the HTTP status and the JSON response listing successes and errors per event
+        """
+        url = f"{self.host}/api/public/ingestion"
+        async with self._stage():
+            with metrics.timer("score_ingest"):
+                async with self.get_session().post(url, json={"batch": batch}) as response:
+                    return response.status, await response.json(content_type=None)
+
+    async def create_dataset_item(self, dataset_name, input, expected_output=None, metadata=None, id=None):
+        """
+        Create a dataset item through the public API
+
+        Args:
+            dataset_name (str): The name of the dataset
+            input: The input of the item
+            expected_output (optional): The expected output of the item. Defaults to None.
+            metadata (dict, optional): The metadata of the item. Defaults to None.
+            id (str, optional): The ID of the item, an existing item with this ID is updated. Defaults to None.
+
+        Returns:
+            tuple: (status, response), the HTTP status and the JSON response
+        """
+        url = f"{self.host}/api/public/dataset-items"
+        payload = {
+            "datasetName": dataset_name,
+            "input": input,
+            "expectedOutput": expected_output,
+            "metadata": metadata,
+            "id": id,
+        }
+        payload = {key: value for key, value in payload.items() if value is not None}
+        async with self._stage():
+            with metrics.timer("dataset_item"):
+                async with self.get_session().post(url, json=payload) as response:
+                    return response.status, await response.json(content_type=None)
+
+
+class ScoreBatchWriter:
+    """
+    A writer buffering scores and sending them through the batch ingestion endpoint by size or time
+    """
+    def __init__(self, fetch_langfuse, max_batch_size=100, flush_interval=1, max_retries=3, retry_delay=1):
+        """
+        Initialize ScoreBatchWriter
+
+        Args:
+            fetch_langfuse (FetchLangfuse): The client used to send the batches
+            max_batch_size (int, optional): Flush as soon as this many scores are buffered. Defaults to 100.
+            flush_interval (float, optional): Seconds between two time-based flushes. Defaults to 1.
+            max_retries (int, optional): How many times a failed event is retried. Defaults to 3.
+            retry_delay (float, optional): Seconds before the first retry, doubled on each retry. Defaults to 1.
+        """
+        self.fetch_langfuse = fetch_langfuse
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._buffer = []
+        self._flushes = set()
+        self._task = None
+
+    async def __aenter__(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def add(self, score, trace_id, observation_id, name):
+        """
+        Buffer a score
+
+        Args:
+            score (float): The score.
+            trace_id (str): The trace ID.
+            observation_id (str): The observation ID.
+            name (str): The name of the score.
+
+        Returns:
+            asyncio.Future: Resolved once the score is ingested, or failed with the ingestion error.
+                A score that is not a finite number fails at once and is never sent, since NaN is not valid JSON.
+        """
+        future = asyncio.get_running_loop().create_future()
+        if not is_finite_score(score):
+            future.set_exception(ValueError(f"Score {name} of observation {observation_id} is not a finite number: {score}"))
+            return future
+        event = {
+            "id": str(uuid.uuid4()),
+            "type": "score-create",
+            "timestamp": format_timestamp(datetime.now(timezone.utc)),
+            "body": self.fetch_langfuse.score_payload(score, trace_id, observation_id, name),
+        }
+        self._buffer.append((event, future))
+        if len(self._buffer) >= self.max_batch_size:
+            self._start_flush()
+        return future
+
+    def _start_flush(self):
+        batch, self._buffer = self._buffer, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def flush(self):
+        """
+        Send the buffered scores and wait for every batch in flight
+        """
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self._start_flush()
+
+    async def _send(self, batch):
+        """
+        Send a batch, retrying only the events that failed with a retryable status
+        """
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                status, response = await self.fetch_langfuse.ingest([event for event, _ in batch])
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                status, response = 503, {"errors": [{"id": event["id"], "status": 503, "message": str(e)} for event, _ in batch]}
+            if not isinstance(response, dict) or ("successes" not in response and "errors" not in response):
+                response = {"errors": [{"id": event["id"], "status": status, "message": str(response)} for event, _ in batch]}
+
+            errors = {error["id"]: error for error in response.get("errors", [])}
+            retry = []
+            for event, future in batch:
+                error = errors.get(event["id"])
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(event["body"]["id"])
+                elif is_retryable(error.get("status")) and attempt < self.max_retries:
+                    retry.append((event, future))
+                else:
+                    future.set_exception(RuntimeError(
+                        f"Score {event['body']['id']} was not ingested: {error.get('status')} {error.get('message', error.get('error'))}"))
+            if not retry:
+                return
+            metrics.retry("score_ingest")
+            batch = retry
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay *= 2
+
+
+def is_finite_score(score):
+    """
+    Check whether a score can be sent, ragas returns NaN when a metric could not be computed
+
+    Args:
+        score: The score
+
+    Returns:
+        bool: True if the score is a finite number
+    """
+    try:
+        return math.isfinite(float(score))
+    except (TypeError, ValueError):
+        return False
+
+
+def is_retryable(status):
+    """
+    Check whether an ingestion error status is worth retrying
+
+    Args:
+        status (int): The HTTP status of the event or request
+
+    Returns:
+        bool: True for rate limiting and server errors
+    """
+    return status is None or status == 429 or status >= 500
+
+
+
+class TracePoller:
+    """
+    A central poller resolving many pending traces with shared, time-windowed observation queries.
+
+    The shared window only covers traces started within max_window of now, so a tick downloads a
+    bounded slice of recent observations however long the run is. Traces still pending after that
+    are resolved by per-trace queries.
+    """
+    def __init__(self, fetch_langfuse, rules, expected_count=1, interval=2, page_size=100, slack=60, timeout=300, max_window=120):
+        """
+        Initialize TracePoller
+
+        Args:
+            fetch_langfuse (FetchLangfuse): The client used to query observations
+            rules (list): A list of rules to filter the observations of each trace, the predicates
+                the API can evaluate are sent as query parameters
+            expected_count (int, optional): The number of node observations a trace must contain. Defaults to 1.
+            interval (float, optional): Seconds between two polling ticks. Defaults to 2.
+            page_size (int, optional): The number of observations per page. Defaults to 100.
+            slack (float, optional): Seconds the query window is widened by on both ends. Defaults to 60.
+            timeout (float, optional): Seconds a trace may stay pending. Defaults to 300.
+            max_window (float, optional): Seconds back from now the shared window reaches. Defaults to 120.
+        """
+        self.fetch_langfuse = fetch_langfuse
+        self.rules = rules
+        self.query, self.residual = compile_rules(rules).split()
+        self.expected_count = expected_count
+        self.interval = interval
+        self.page_size = page_size
+        self.slack = timedelta(seconds=slack)
+        self.timeout = timeout
+        self.max_window = timedelta(seconds=max_window)
+        self._pending = {}
+        self._task = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    def start(self):
+        """
+        Start the polling loop in the background
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """
+        Stop the polling loop and fail the traces still pending
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for future, _, _ in self._pending.values():
+            if not future.done():
+                future.set_exception(asyncio.CancelledError())
+        self._pending.clear()
+
+    @property
+    def pending(self):
+        """
+        int: The number of traces waiting to be resolved
+        """
+        return len(self._pending)
+
+    async def wait(self, trace_id, start_time=None):
+        """
+        Wait until the selected observations of a trace are ready
+
+        Args:
+            trace_id (str): The ID of the trace
+            start_time (datetime, optional): A UTC time shortly before the trace started. Defaults to now.
+
+        Returns:
+            list: A list of selected observations
+
+        Raises:
+            asyncio.TimeoutError: If the trace is not ready before the timeout
+        """
+        loop = asyncio.get_running_loop()
+        if trace_id not in self._pending:
+            self._pending[trace_id] = (
+                loop.create_future(),
+                start_time or datetime.now(timezone.utc),
+                loop.time() + self.timeout,
+            )
+        future, _, deadline = self._pending[trace_id]
+        # The deadline holds even if the polling loop has died
+        try:
+            async with asyncio.timeout_at(deadline):
+                return await asyncio.shield(future)
+        except TimeoutError:
+            if self._pending.get(trace_id, (None,))[0] is future:
+                del self._pending[trace_id]
+            raise asyncio.TimeoutError(f"Trace {trace_id} not ready after {self.timeout}s") from None
+
+    async def run(self):
+        """
+        Poll Langfuse for all pending traces until cancelled
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self._pending:
+                continue
+            try:
+                await self.poll()
+            except Exception as e:
+                metrics.log(f"Polling observations failed: {e!r}")
+            self._expire()
+
+    async def poll(self):
+        """
+        Query the observations of the pending traces and resolve the traces that are ready
+        """
+        if self.fetch_langfuse.offline:
+            # The window of a pending trace ends in the future, such queries are never cached
+            for trace_id in list(self._pending):
+                future, _, _ = self._pending.pop(trace_id)
+                if not future.done():
+                    future.set_exception(LookupError(f"Trace {trace_id} cannot be polled in offline mode"))
+            return
+        now = datetime.now(timezone.utc)
+        horizon = now - self.max_window
+        recent = [start_time for _, start_time, _ in self._pending.values() if start_time >= horizon]
+        stragglers = [trace_id for trace_id, (_, start_time, _) in self._pending.items() if start_time < horizon]
+
+        trace_observations = {}
+        if recent:
+            observations = await self.fetch_langfuse.fetch_observations_in_window(
+                min(recent) - self.slack, now + self.slack, page_size=self.page_size, **self.query)
+            for observation in observations:
+                if observation.get('traceId') in self._pending:
+                    trace_observations.setdefault(observation['traceId'], []).append(observation)
+
+        async def fetch_trace(trace_id):
+            return trace_id, [observation async for observation in self.fetch_langfuse.iter_observations(
+                page_size=self.page_size, traceId=trace_id, **self.query)]
+
+        async for trace_id, observations in self.fetch_langfuse.map_concurrent(fetch_trace, stragglers):
+            if observations:
+                trace_observations[trace_id] = observations
+        for trace_id, observations in trace_observations.items():
+            selected = self.fetch_langfuse.select_data(observations, self.residual)
+            if self.fetch_langfuse.is_trace_ready(selected, self.expected_count) and trace_id in self._pending:
+                future, _, _ = self._pending.pop(trace_id)
+                if not future.done():
+                    future.set_result(selected)
+
+    def _expire(self):
+        """
+        Fail the pending traces whose timeout has passed
+        """
+        now = asyncio.get_running_loop().time()
+        for trace_id in [trace_id for trace_id, (_, _, deadline) in self._pending.items() if deadline <= now]:
+            future, _, _ = self._pending.pop(trace_id)
+            if not future.done():
+                future.set_exception(asyncio.TimeoutError(f"Trace {trace_id} not ready after {self.timeout}s"))
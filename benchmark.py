@@ -0,0 +1,472 @@
+"""
+Offline benchmark with local Dify, Langfuse and critic LLM stand-ins
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+import yaml
+from aiohttp import web
+
+
+def parse_time(timestamp):
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
+
+class StubServices:
+    """
+    Local stand-ins for the Dify chat API, the Langfuse public API and an OpenAI-compatible critic LLM.
+
+    Every Dify answer creates a trace of trace_size observations, one of them the LLM node selected by
+    Rules().llm_rules. The observations only become visible to the Langfuse API after ingestion_delay.
+    """
+    def __init__(self, latency=0.05, ingestion_delay=1, error_rate=0, trace_size=10, critic_reply=None, embedding_size=64):
+        """
+        Initialize StubServices
+
+        Args:
+            latency (float, optional): Seconds every request takes, Dify answers take ten times as long. Defaults to 0.05.
+            ingestion_delay (float, optional): Seconds before the observations of a trace are visible. Defaults to 1.
+            error_rate (float, optional): The probability of a request failing with a 500. Defaults to 0.
+            trace_size (int, optional): The number of observations per trace. Defaults to 10.
+            critic_reply (str, optional): The content of every critic LLM completion. Defaults to a JSON verdict.
+            embedding_size (int, optional): The dimension of the stub embeddings. Defaults to 64.
+        """
+        self.latency = latency
+        self.ingestion_delay = ingestion_delay
+        self.error_rate = error_rate
+        self.trace_size = trace_size
+        self.critic_reply = critic_reply or json.dumps({"question": "stub question", "noncommittal": 0, "verdict": 1, "reason": "stub"})
+        self.embedding_size = embedding_size
+        self.observations = {}
+        self.observations_by_name = {}
+        self.traces = {}
+        self.scores = 0
+        self.requests = {}
+        self._runner = None
+
+    def reset(self):
+        """
+        Forget every trace, score and request count
+        """
+        self.observations.clear()
+        self.observations_by_name.clear()
+        self.traces.clear()
+        self.scores = 0
+        self.requests.clear()
+
+    def app(self):
+        """
+        Build the aiohttp application serving all stand-ins
+
+        Returns:
+            web.Application: The application
+        """
+        app = web.Application(middlewares=[self._middleware])
+        app.add_routes([
+            web.post('/v1/chat-messages', self.chat_messages),
+            web.get('/api/public/observations', self.list_observations),
+            web.get('/api/public/observations/{id}', self.get_observation),
+            web.get('/api/public/traces/{id}', self.get_trace),
+            web.post('/api/public/ingestion', self.ingestion),
+            web.post('/critic/v1/chat/completions', self.chat_completions),
+            web.post('/critic/v1/embeddings', self.embeddings),
+        ])
+        return app
+
+    async def start(self, host='127.0.0.1', port=8900):
+        """
+        Start serving
+
+        Args:
+            host (str, optional): The host to bind. Defaults to '127.0.0.1'.
+            port (int, optional): The port to bind. Defaults to 8900.
+        """
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        """
+        Stop serving
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        name = f"{request.method} {route}"
+        self.requests[name] = self.requests.get(name, 0) + 1
+        await asyncio.sleep(self.latency)
+        if random.random() < self.error_rate:
+            return web.json_response({"message": "stub error"}, status=500)
+        return await handler(request)
+
+    async def chat_messages(self, request):
+        payload = await request.json()
+        conversation_id = str(uuid.uuid4())
+        trace_id = str(uuid.uuid4())
+        start_time = datetime.now(timezone.utc)
+        answer = f"stub answer to {payload['query'][:50]}"
+        self._add_trace(trace_id, payload['query'], answer, start_time)
+        await asyncio.sleep(self.latency * 9)
+        if payload.get('response_mode') != 'streaming':
+            return web.json_response({
+                "event": "message",
+                "conversation_id": conversation_id,
+                "message_id": trace_id,
+                "answer": answer,
+                "metadata": {},
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for token in answer.split(' '):
+            event = {"event": "message", "conversation_id": conversation_id, "message_id": trace_id, "answer": token + ' '}
+            await response.write(f"data: {json.dumps(event)}\n\n".encode())
+        event = {"event": "message_end", "conversation_id": conversation_id, "message_id": trace_id, "metadata": {}}
+        await response.write(f"data: {json.dumps(event)}\n\n".encode())
+        await response.write_eof()
+        return response
+
+    def _add_trace(self, trace_id, query, answer, start_time):
+        visible_at = time.monotonic() + self.ingestion_delay
+        timestamp = start_time.isoformat().replace('+00:00', 'Z')
+        observations = []
+        for index in range(self.trace_size):
+            observation = {
+                "id": str(uuid.uuid4()),
+                "traceId": trace_id,
+                "type": "SPAN",
+                "name": f"node-{index}",
+                "startTime": timestamp,
+                "endTime": timestamp,
+                "metadata": {"node_name": f"node-{index}", "node_type": "code"},
+                "input": {},
+                "output": {},
+            }
+            if index == 0:
+                observation.update({
+                    "name": "llm",
+                    "metadata": {"node_name": "LLM", "node_type": "llm"},
+                    "input": [
+                        {"role": "system", "content": "stub context"},
+                        {"role": "user", "content": query},
+                    ],
+                    "output": {"text": answer},
+                })
+            observations.append(observation)
+            self.observations[observation['id']] = (visible_at, observation)
+            self.observations_by_name.setdefault(observation['name'], []).append((visible_at, observation))
+        self.traces[trace_id] = (visible_at, {
+            "id": trace_id,
+            "timestamp": timestamp,
+            "updatedAt": timestamp,
+            "observations": observations,
+        })
+
+    def _visible(self, entry):
+        return entry is not None and entry[0] <= time.monotonic()
+
+    async def list_observations(self, request):
+        query = request.query
+        page = int(query.get('page', 1))
+        limit = int(query.get('limit', 50))
+        from_time = parse_time(query['fromStartTime']) if 'fromStartTime' in query else None
+        to_time = parse_time(query['toStartTime']) if 'toStartTime' in query else None
+        if 'traceId' in query:
+            entry = self.traces.get(query['traceId'])
+            entries = [(entry[0], observation) for observation in entry[1]['observations']] if entry else []
+        elif 'name' in query:
+            entries = self.observations_by_name.get(query['name'], [])
+        else:
+            entries = self.observations.values()
+        data = []
+        for entry in entries:
+            if not self._visible(entry):
+                continue
+            observation = entry[1]
+            if any(key in query and observation.get(key) != query[key] for key in ('name', 'type', 'traceId')):
+                continue
+            start_time = parse_time(observation['startTime'])
+            if (from_time and start_time < from_time) or (to_time and start_time > to_time):
+                continue
+            data.append(observation)
+        return web.json_response({
+            "data": data[(page - 1) * limit:page * limit],
+            "meta": {"page": page, "limit": limit, "totalItems": len(data), "totalPages": max((len(data) + limit - 1) // limit, 1)},
+        })
+
+    async def get_observation(self, request):
+        entry = self.observations.get(request.match_info['id'])
+        if not self._visible(entry):
+            return web.json_response({"message": "Observation not found"}, status=404)
+        return web.json_response(entry[1])
+
+    async def get_trace(self, request):
+        entry = self.traces.get(request.match_info['id'])
+        if not self._visible(entry):
+            return web.json_response({"message": "Trace not found"}, status=404)
+        return web.json_response(entry[1])
+
+    async def ingestion(self, request):
+        payload = await request.json()
+        successes, errors = [], []
+        for event in payload.get('batch', []):
+            if random.random() < self.error_rate:
+                errors.append({"id": event['id'], "status": 500, "message": "stub error"})
+            else:
+                successes.append({"id": event['id'], "status": 201})
+                if event.get('type') == 'score-create':
+                    self.scores += 1
+        return web.json_response({"successes": successes, "errors": errors}, status=207)
+
+    async def chat_completions(self, request):
+        payload = await request.json()
+        choices = [
+            {"index": index, "message": {"role": "assistant", "content": self.critic_reply}, "finish_reason": "stop"}
+            for index in range(payload.get('n') or 1)
+        ]
+        return web.json_response({
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get('model'),
+            "choices": choices,
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+    async def embeddings(self, request):
+        payload = await request.json()
+        inputs = payload['input'] if isinstance(payload['input'], list) else [payload['input']]
+        data = []
+        for index, text in enumerate(inputs):
+            seed = hashlib.sha256(json.dumps(text).encode()).digest()
+            generator = random.Random(seed)
+            data.append({"object": "embedding", "index": index, "embedding": [generator.uniform(-1, 1) for _ in range(self.embedding_size)]})
+        return web.json_response({
+            "object": "list",
+            "data": data,
+            "model": payload.get('model'),
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        })
+
+
+class BenchItem:
+    """
+    A dataset item shaped like a Langfuse DatasetItemClient, linking is only counted
+    """
+    def __init__(self, index):
+        self.id = f"bench-{index}"
+        self.input = {"department": "bench", "title": f"question {index}", "ask": f"benchmark question {index}"}
+        self.expected_output = f"expected answer {index}"
+        self.links = 0
+
+    def link(self, trace_or_observation=None, run_name=None, trace_id=None, observation_id=None):
+        self.links += 1
+
+
+class BenchDataset:
+    def __init__(self, size):
+        self.items = [BenchItem(index) for index in range(size)]
+
+
+def bench_config(base_url, overrides=None):
+    """
+    Build a run config pointing every service at the stand-ins
+
+    Args:
+        base_url (str): The base URL of the stand-ins
+        overrides (dict, optional): Config keys to override, e.g. DIFY_CONCURRENCY. Defaults to None.
+
+    Returns:
+        dict: The config
+    """
+    config = {
+        "LANGFUSE_PUBLIC_KEY": "pk-lf-bench",
+        "LANGFUSE_SECRET_KEY": "sk-lf-bench",
+        "LANGFUSE_HOST": base_url,
+        "DIFY_API_BASE": f"{base_url}/v1",
+        "DIFY_API_KEY": "app-bench",
+        "RAGAS_BASE_URL": f"{base_url}/critic/v1",
+        "RAGAS_API_KEY": "bench",
+        "RAGAS_CRITIC_LLM": "stub-critic",
+        "RAGAS_EMBEDDING": "stub-embedding",
+        "TRACE_POLL_INTERVAL": "0.5",
+        "LANGFUSE_CACHE_PATH": "",
+        "LANGFUSE_OFFLINE": "false",
+    }
+    config.update(overrides or {})
+    return config
+
+
+def peak_rss_mb():
+    """
+    Get the peak resident set size of this process
+
+    Returns:
+        float: The peak RSS in MiB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+async def run_worker(size, config_path, metric_names, eval_mode):
+    """
+    Drive process_dataset and process_eval of run.py against the stand-ins
+
+    Args:
+        size (int): The number of dataset items
+        config_path (str): The config file run.py loads
+        metric_names (list): The names of the ragas metrics
+        eval_mode (str): "batch" or "streaming"
+
+    Returns:
+        dict: The timings and stage metrics of the run
+    """
+    os.environ['AUTOEVAL_CONFIG'] = config_path
+    import ragas.metrics
+    import run
+    from utils import get_ragas_llm_and_embeddings
+
+    run.setup()
+    llm, embeddings = get_ragas_llm_and_embeddings()
+    ragas_metrics = [getattr(ragas.metrics, name) for name in metric_names]
+    dataset = BenchDataset(size)
+    run_name = f"bench-{size}"
+    start = time.monotonic()
+    async with run.fetch_langfuse, run.trace_poller, run.score_writer:
+        if eval_mode == 'streaming':
+            await run.process_dataset_streaming(dataset, run_name, ragas_metrics, llm, embeddings)
+            answered = time.monotonic()
+        else:
+            observations, expected_outputs = await run.process_dataset(dataset, run_name, ragas_metrics, llm, embeddings)
+            answered = time.monotonic()
+            await run.process_eval(observations, expected_outputs, ragas_metrics, llm, embeddings)
+    end = time.monotonic()
+    return {
+        "items": size,
+        "seconds": end - start,
+        "answer_seconds": answered - start,
+        "items_per_second": size / (end - start),
+        "linked": sum(item.links for item in dataset.items),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": run.metrics.snapshot(),
+    }
+
+
+async def run_benchmark(sizes, args):
+    """
+    Serve the stand-ins and run one worker process per dataset size, so that each peak RSS is measured alone
+
+    Args:
+        sizes (list): The dataset sizes
+        args (argparse.Namespace): The command line arguments
+
+    Returns:
+        list: The result of every size
+    """
+    services = StubServices(
+        latency=args.latency,
+        ingestion_delay=args.ingestion_delay,
+        error_rate=args.error_rate,
+        trace_size=args.trace_size,
+    )
+    await services.start(port=args.port)
+    overrides = dict(override.split('=', 1) for override in args.set)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for size in sizes:
+                services.reset()
+                config = bench_config(f"http://127.0.0.1:{args.port}", {"EVAL_MODE": args.eval_mode, **overrides})
+                config_path = os.path.join(directory, f"config-{size}.yaml")
+                result_path = os.path.join(directory, f"result-{size}.json")
+                with open(config_path, 'w', encoding='utf-8') as file:
+                    yaml.safe_dump(config, file)
+                process = await asyncio.create_subprocess_exec(
+                    sys.executable, os.path.abspath(__file__), '--worker',
+                    '--sizes', str(size),
+                    '--config', config_path,
+                    '--result', result_path,
+                    '--metrics', *args.metrics,
+                    '--eval-mode', args.eval_mode,
+                )
+                if await process.wait() != 0:
+                    raise RuntimeError(f"Benchmark worker for {size} items exited with {process.returncode}")
+                with open(result_path, 'r', encoding='utf-8') as file:
+                    result = json.load(file)
+                result["requests"] = dict(services.requests)
+                result["scores"] = services.scores
+                results.append(result)
+                print(format_result(result))
+    finally:
+        await services.stop()
+    return results
+
+
+def format_result(result):
+    """
+    Format the result of one size as a short report
+
+    Args:
+        result (dict): The result of run_worker with the request counts of the stand-ins
+
+    Returns:
+        str: The report
+    """
+    lines = [
+        f"{result['items']} items: {result['items_per_second']:.1f} items/s, {result['seconds']:.1f}s "
+        f"(answers {result['answer_seconds']:.1f}s), peak RSS {result['peak_rss_mb']:.0f} MiB, "
+        f"{result['linked']} links, {result['scores']} scores"
+    ]
+    for name, count in sorted(result['requests'].items()):
+        lines.append(f"  {name}: {count}")
+    for stage, summary in result['stages'].items():
+        if summary['count'] and summary['p50'] is not None:
+            lines.append(f"  {stage}: n={summary['count']} p50={summary['p50']:.3f}s p99={summary['p99']:.3f}s errors={summary['errors']} retries={summary['retries']}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the evaluation pipeline against local stand-ins of Dify, Langfuse and a critic LLM")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help="dataset sizes to run")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds every stand-in request takes")
+    parser.add_argument('--ingestion-delay', type=float, default=1, help="seconds before a trace is visible in Langfuse")
+    parser.add_argument('--error-rate', type=float, default=0, help="probability of a stand-in request failing")
+    parser.add_argument('--trace-size', type=int, default=10, help="observations per trace")
+    parser.add_argument('--metrics', nargs='+', default=['answer_relevancy', 'answer_similarity'], help="names of ragas metrics")
+    parser.add_argument('--eval-mode', choices=['batch', 'streaming'], default='batch')
+    parser.add_argument('--set', nargs='*', default=[], metavar='KEY=VALUE', help="config overrides, e.g. DIFY_CONCURRENCY=16")
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--output', help="write the results as JSON")
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        result = asyncio.run(run_worker(args.sizes[0], args.config, args.metrics, args.eval_mode))
+        with open(args.result, 'w', encoding='utf-8') as file:
+            json.dump(result, file)
+        return
+
+    results = asyncio.run(run_benchmark(args.sizes, args))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
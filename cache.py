@@ -0,0 +1,283 @@
+"""
+Persistent local cache
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+
+class SQLiteCache:
+    """
+    A persistent key-value cache in SQLite with age- and size-based eviction
+    """
+    def __init__(self, path, max_bytes=1024 ** 3, max_age=None, evict_every=100):
+        """
+        Initialize SQLiteCache
+
+        Args:
+            path (str): The path of the SQLite database file
+            max_bytes (int, optional): The total size of stored values above which the least recently used entries are evicted. Defaults to 1 GiB.
+            max_age (float, optional): Seconds after which an entry expires, None keeps entries forever. Defaults to None.
+            evict_every (int, optional): Run eviction after this many writes. Defaults to 100.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "kind TEXT, id TEXT, value TEXT, version TEXT, "
+            "stored_at REAL, accessed_at REAL, size INTEGER, "
+            "PRIMARY KEY (kind, id))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+
+    def get(self, kind, id, version=None):
+        """
+        Get a cached value
+
+        Args:
+            kind (str): The kind of the entry, e.g. "trace"
+            id (str): The ID of the entry
+            version (str, optional): The expected version, a stored entry with another version is invalidated. Defaults to None (any version).
+
+        Returns:
+            The cached value, or None on a miss
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, version, stored_at FROM entries WHERE kind = ? AND id = ?", (kind, id)
+            ).fetchone()
+            now = time.time()
+            if row is not None:
+                value, stored_version, stored_at = row
+                expired = self.max_age is not None and now - stored_at > self.max_age
+                if expired or (version is not None and version != stored_version):
+                    self._conn.execute("DELETE FROM entries WHERE kind = ? AND id = ?", (kind, id))
+                    row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE entries SET accessed_at = ? WHERE kind = ? AND id = ?", (now, kind, id))
+            self.hits += 1
+        return json.loads(value)
+
+    def put(self, kind, id, value, version=None):
+        """
+        Store a value
+
+        Args:
+            kind (str): The kind of the entry, e.g. "trace"
+            id (str): The ID of the entry
+            value: A JSON-serializable value
+            version (str, optional): The version of the value, e.g. its updatedAt. Defaults to None.
+        """
+        data = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, id, data, version, now, now, len(data)),
+            )
+            self._writes += 1
+            if self._writes % self.evict_every == 0:
+                self._evict()
+
+    def put_many(self, kind, entries):
+        """
+        Store several values in one transaction, skipping the entries whose stored version is unchanged
+
+        Args:
+            kind (str): The kind of the entries, e.g. "observation"
+            entries (list): (id, value, version) of every entry
+
+        Returns:
+            int: The number of entries written
+        """
+        entries = list({id: (id, value, version) for id, value, version in entries}.values())
+        if not entries:
+            return 0
+        now = time.time()
+        with self._lock:
+            stored = {}
+            for start in range(0, len(entries), 500):
+                ids = [id for id, _, _ in entries[start:start + 500]]
+                stored.update(self._conn.execute(
+                    f"SELECT id, version FROM entries WHERE kind = ? AND id IN ({','.join('?' * len(ids))})",
+                    (kind, *ids),
+                ).fetchall())
+            rows = []
+            for id, value, version in entries:
+                if version is not None and id in stored and stored[id] == version:
+                    continue
+                data = json.dumps(value, ensure_ascii=False)
+                rows.append((kind, id, data, version, now, now, len(data)))
+            if not rows:
+                return 0
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            previous, self._writes = self._writes, self._writes + len(rows)
+            if previous // self.evict_every != self._writes // self.evict_every:
+                self._evict()
+        return len(rows)
+
+    def delete(self, kind, id):
+        """
+        Remove an entry
+
+        Args:
+            kind (str): The kind of the entry
+            id (str): The ID of the entry
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM entries WHERE kind = ? AND id = ?", (kind, id))
+
+    def evict(self):
+        """
+        Remove expired entries, then the least recently used ones until the cache fits max_bytes
+        """
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        if self.max_age is not None:
+            self._conn.execute("DELETE FROM entries WHERE stored_at < ?", (time.time() - self.max_age,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        for kind, id, size in self._conn.execute(
+            "SELECT kind, id, size FROM entries ORDER BY accessed_at"
+        ).fetchall():
+            self._conn.execute("DELETE FROM entries WHERE kind = ? AND id = ?", (kind, id))
+            excess -= size
+            if excess <= 0:
+                break
+
+    def stats(self):
+        """
+        Get the hit and miss counts
+
+        Returns:
+            dict: hits, misses and hit_rate
+        """
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+    def close(self):
+        """
+        Close the database connection
+        """
+        with self._lock:
+            self._conn.close()
+
+    @classmethod
+    def from_env(cls, prefix="LANGFUSE_CACHE"):
+        """
+        Create a cache from PREFIX_PATH, PREFIX_MAX_MB and PREFIX_MAX_AGE_DAYS environment variables
+
+        Args:
+            prefix (str, optional): The prefix of the environment variables. Defaults to "LANGFUSE_CACHE".
+
+        Returns:
+            SQLiteCache: The cache, or None if PREFIX_PATH is not set
+        """
+        path = os.getenv(f"{prefix}_PATH")
+        if not path:
+            return None
+        max_age_days = os.getenv(f"{prefix}_MAX_AGE_DAYS")
+        return cls(
+            path,
+            max_bytes=int(float(os.getenv(f"{prefix}_MAX_MB", 1024)) * 1024 ** 2),
+            max_age=float(max_age_days) * 86400 if max_age_days else None,
+        )
+
+
+def is_complete_observation(observation):
+    """
+    Check whether an observation has ended, so that its cached copy stays valid
+
+    Args:
+        observation (dict): The observation
+
+    Returns:
+        bool: True if the observation has an ID and an end time
+    """
+    return isinstance(observation, dict) and bool(observation.get('id')) and bool(observation.get('endTime'))
+
+
+def is_complete_trace(trace):
+    """
+    Check whether all observations of a trace have ended, so that its cached copy stays valid
+
+    Args:
+        trace (dict): The trace with its observations
+
+    Returns:
+        bool: True if the trace has observations and all of them have ended
+    """
+    observations = trace.get('observations') if isinstance(trace, dict) else None
+    return bool(observations) and all(is_complete_observation(observation) for observation in observations)
+
+
+def query_key(url, params):
+    """
+    Build a cache ID for a list query
+
+    Args:
+        url (str): The request URL
+        params (dict): The query parameters
+
+    Returns:
+        str: The cache ID
+    """
+    params = {key: value for key, value in (params or {}).items() if value is not None}
+    return f"{url}?{json.dumps(params, sort_keys=True, ensure_ascii=False)}"
+
+
+def is_closed_page(response, params=None):
+    """
+    Check whether a page of a list query can no longer change, so that its cached copy stays valid
+
+    Args:
+        response (dict): The page
+        params (dict, optional): The query parameters of the page. Defaults to None.
+
+    Returns:
+        bool: True if the page has data and its time range, if any, ended in the past
+    """
+    if not isinstance(response, dict) or 'data' not in response:
+        return False
+    return is_closed_query(params)
+
+
+def is_closed_query(params=None):
+    """
+    Check whether the time range of a list query, if any, ended in the past, so that its result can no longer change
+
+    Args:
+        params (dict, optional): The query parameters. Defaults to None.
+
+    Returns:
+        bool: True if the query has no end time or its end time has passed
+    """
+    end = (params or {}).get('toStartTime') or (params or {}).get('toTimestamp')
+    if end is None:
+        return True
+    return datetime.fromisoformat(end.replace('Z', '+00:00')) < datetime.now(timezone.utc)
@@ -0,0 +1,175 @@
+"""
+Columnar builders of evaluation batches
+"""
+from abc import ABC, abstractmethod
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from records import EvalRecord
+
+LLM_SCHEMA = pa.schema([
+    ("question", pa.string()),
+    ("contexts", pa.list_(pa.string())),
+    ("answer", pa.string()),
+    ("trace_id", pa.string()),
+    ("observation_id", pa.string()),
+])
+
+RETRIEVAL_SCHEMA = pa.schema([
+    ("query", pa.string()),
+    ("retrieval result", pa.struct([
+        ("title", pa.list_(pa.string())),
+        ("content", pa.list_(pa.string())),
+    ])),
+    ("trace_id", pa.string()),
+    ("observation_id", pa.string()),
+])
+
+
+class BatchBuilder(ABC):
+    """
+    A builder streaming observations into a typed Arrow table.
+
+    Rows are collected column by column and converted to a record batch every chunk_size rows,
+    so only one chunk is held as Python objects. Missing fields become explicit nulls, which
+    keeps every column the same length. Observations a builder cannot use are dropped and counted.
+    """
+    schema = None
+
+    def __init__(self, chunk_size=10000):
+        """
+        Initialize BatchBuilder
+
+        Args:
+            chunk_size (int, optional): The number of rows per record batch. Defaults to 10000.
+        """
+        self.chunk_size = chunk_size
+        self._columns = {name: [] for name in self.schema.names}
+        self._batches = []
+        self._rows = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self._rows
+
+    @abstractmethod
+    def row(self, observation):
+        """
+        Extract the values of one observation
+
+        Args:
+            observation (dict): The observation
+
+        Returns:
+            tuple: The value of every column in schema order, or None to drop the observation
+        """
+
+    def append(self, observation):
+        """
+        Append one observation
+
+        Args:
+            observation (dict): The observation
+        """
+        values = self.row(observation)
+        if values is None:
+            self.dropped += 1
+            return
+        for column, value in zip(self._columns.values(), values):
+            column.append(value)
+        self._rows += 1
+        if len(self._columns['observation_id']) >= self.chunk_size:
+            self._flush()
+
+    def extend(self, observations):
+        """
+        Append several observations
+
+        Args:
+            observations (iterable): The observations
+        """
+        for observation in observations:
+            self.append(observation)
+
+    def _flush(self):
+        if not self._columns['observation_id']:
+            return
+        self._batches.append(pa.record_batch(
+            [pa.array(values, type=field.type) for field, values in zip(self.schema, self._columns.values())],
+            schema=self.schema))
+        for column in self._columns.values():
+            column.clear()
+
+    def finish(self):
+        """
+        Convert the remaining rows and assemble the table, the record batches are not copied
+
+        Returns:
+            pa.Table: The table of every appended observation
+        """
+        self._flush()
+        return pa.Table.from_batches(self._batches, schema=self.schema)
+
+
+class LLMBatchBuilder(BatchBuilder):
+    """
+    A builder of the question, contexts and answer of LLM observations or their EvalRecords
+    """
+    schema = LLM_SCHEMA
+
+    def row(self, observation):
+        record = observation if isinstance(observation, EvalRecord) else EvalRecord.from_observation(observation)
+        return record.question, record.contexts, record.answer, record.trace_id, record.observation_id
+
+
+class RetrievalBatchBuilder(BatchBuilder):
+    """
+    A builder of the query and retrieved documents of retrieval observations
+    """
+    schema = RETRIEVAL_SCHEMA
+
+    def row(self, observation):
+        input = observation.get("input")
+        if not isinstance(input, dict) or "query" not in input:
+            return None
+        retrieval_result = {"title": [], "content": []}
+        output = observation.get("output")
+        results = output.get("result") if isinstance(output, dict) else None
+        for item in results or ():
+            if "title" in item and "content" in item:
+                retrieval_result["title"].append(item["title"])
+                retrieval_result["content"].append(item["content"])
+        return input["query"], retrieval_result, observation["traceId"], observation["id"]
+
+
+def drop_null_rows(table, column):
+    """
+    Remove the rows where a column is null
+
+    Args:
+        table (pa.Table): The table
+        column (str): The name of the column
+
+    Returns:
+        tuple: The remaining table and the observation_id of every removed row
+    """
+    valid = pc.is_valid(table[column])
+    if pc.all(valid).as_py() is not False:
+        return table, []
+    return table.filter(valid), table.filter(pc.invert(valid))['observation_id'].to_pylist()
+
+
+def to_dataset(table):
+    """
+    Wrap an Arrow table as a datasets.Dataset without copying it
+
+    Args:
+        table (pa.Table): The table
+
+    Returns:
+        Dataset: The dataset backed by the table
+    """
+    from datasets import Dataset
+    from datasets.table import InMemoryTable
+    return Dataset(InMemoryTable(table))
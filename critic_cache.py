@@ -0,0 +1,121 @@
+"""
+Content-addressed cache of critic LLM judgements
+"""
+import hashlib
+import json
+
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+from ragas.llms import BaseRagasLLM
+
+
+class CachedLLMWrapper(BaseRagasLLM):
+    """
+    A ragas LLM answering repeated prompts from a persistent cache.
+
+    Generations are keyed by a hash of the model name, the prompt, the temperature, n and the stop
+    words, so a tuple judged in a previous run is not sent to the critic LLM again.
+    """
+    def __init__(self, llm, cache, model=None):
+        """
+        Initialize CachedLLMWrapper
+
+        Args:
+            llm (BaseRagasLLM): The wrapped LLM, e.g. a LangchainLLMWrapper
+            cache (SQLiteCache): The cache storing the generations
+            model (str, optional): The model name in the cache key. Defaults to the model of the wrapped LLM.
+        """
+        self.llm = llm
+        self.cache = cache
+        self.model = model or getattr(getattr(llm, 'langchain_llm', None), 'model_name', None) or type(llm).__name__
+        self.run_config = llm.run_config
+
+    def set_run_config(self, run_config):
+        self.run_config = run_config
+        self.llm.set_run_config(run_config)
+
+    def key(self, prompt, n, temperature, stop):
+        """
+        Build the cache key of a generation request
+
+        Args:
+            prompt (PromptValue): The prompt
+            n (int): The number of completions
+            temperature (float): The sampling temperature
+            stop (list): The stop words
+
+        Returns:
+            str: The SHA-256 hex digest of the request
+        """
+        request = [self.model, prompt.to_string(), temperature, n, stop]
+        return hashlib.sha256(json.dumps(request, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def generate_text(self, prompt, n=1, temperature=1e-8, stop=None, callbacks=None):
+        key = self.key(prompt, n, temperature, stop)
+        cached = self.cache.get('llm', key)
+        if cached is not None:
+            return load_result(cached)
+        result = self.llm.generate_text(prompt, n=n, temperature=temperature, stop=stop, callbacks=callbacks)
+        self._put(key, result)
+        return result
+
+    async def agenerate_text(self, prompt, n=1, temperature=1e-8, stop=None, callbacks=None):
+        key = self.key(prompt, n, temperature, stop)
+        cached = self.cache.get('llm', key)
+        if cached is not None:
+            return load_result(cached)
+        result = await self.llm.agenerate_text(prompt, n=n, temperature=temperature, stop=stop, callbacks=callbacks)
+        self._put(key, result)
+        return result
+
+    def is_finished(self, response):
+        return self.llm.is_finished(response) if hasattr(self.llm, 'is_finished') else True
+
+    def _put(self, key, result):
+        # Empty generations are failures worth retrying on the next run
+        if result.generations and all(generation.text for generations in result.generations for generation in generations):
+            self.cache.put('llm', key, dump_result(result))
+
+    def stats(self):
+        """
+        Get the hit and miss counts of the cache
+
+        Returns:
+            dict: hits, misses and hit_rate
+        """
+        return self.cache.stats()
+
+
+def dump_result(result):
+    """
+    Turn an LLMResult into JSON-serializable generations
+
+    Args:
+        result (LLMResult): The result
+
+    Returns:
+        list: The text and generation info of every generation of every prompt
+    """
+    return [
+        [{"text": generation.text, "generation_info": generation.generation_info} for generation in generations]
+        for generations in result.generations
+    ]
+
+
+def load_result(generations):
+    """
+    Rebuild an LLMResult from dump_result
+
+    Args:
+        generations (list): The output of dump_result
+
+    Returns:
+        LLMResult: The result
+    """
+    return LLMResult(generations=[
+        [
+            ChatGeneration(message=AIMessage(content=generation["text"]), generation_info=generation["generation_info"])
+            for generation in prompt_generations
+        ]
+        for prompt_generations in generations
+    ])
@@ -5,10 +5,11 @@ LastEditors: Pengzirong
 LastEditTime: 2024-09-12 18:13:45
 Description: file content
 '''
-import pandas as pd
 import os
+import random
+import itertools
 from langfuse import Langfuse
-from async_langfuse import FetchLangfuse
+from async_langfuse import FetchLangfuse, is_retryable
 import asyncio
 from datetime import datetime
 import yaml
@@ -17,6 +18,8 @@ import json
 from tqdm import tqdm
 from utils import send_chat_message, process_llm_batch
 from rules import Rules
+from readers import iter_chunks, sample_chunks
+from manifest import DatasetManifest
 
 from datasets import Dataset 
 from ragas import evaluate
@@ -50,27 +53,51 @@ class DatasetProcessor:
         input_columns=None,
         output_columns=None,
         sample_size=-1,
+        bulk=False,
+        concurrency=16,
+        sample_mode='tail',
+        chunk_size=10000,
+        sync=False,
         ):
+        """Upload a table file to a Langfuse dataset.
 
-        # Determine file extension and read accordingly
-        file_extension = os.path.splitext(file_path)[1]
-        if file_extension == '.csv':
-            df = pd.read_csv(file_path, encoding=encoding)
-        elif file_extension == '.xlsx':
-            df = pd.read_excel(file_path, encoding=encoding)
-        elif file_extension == '.txt':
-            df = pd.read_csv(file_path, delimiter='\t', encoding=encoding)
-        elif file_extension == '.json':
-            df = pd.read_json(file_path, encoding=encoding)
-        else:
-            raise ValueError(f"Unsupported file format: {file_extension}")
-        
-        df = df.tail(sample_size)
+        The file is read and uploaded chunk by chunk, so memory is bounded by the chunk size
+        (and the sample size) rather than by the file size.
+
+        Args:
+            file_path (str): The path of a .csv, .txt/.tsv (tab-separated), .jsonl, .parquet, .json or .xlsx file.
+            ds_name_in_langfuse (str): The name of the dataset, nothing is uploaded if it already exists unless sync is set.
+            encoding (str, optional): The encoding of the file. Defaults to 'utf-8'.
+            description (str, optional): The description of the dataset. Defaults to None.
+            metadata (dict, optional): The metadata of the dataset. Defaults to None.
+            input_columns (list, optional): The input columns. Defaults to all columns but the last two.
+            output_columns (list, optional): The expected output columns. Defaults to the last column.
+            sample_size (int, optional): Upload only this many rows, a negative value uploads every row. Defaults to -1.
+            bulk (bool, optional): Upload the items concurrently through the public API instead of one by one. Defaults to False.
+            concurrency (int, optional): The number of concurrent requests in bulk mode. Defaults to 16.
+            sample_mode (str, optional): Which rows sample_size keeps: "head", "tail" or "reservoir". Defaults to 'tail'.
+            chunk_size (int, optional): The number of rows read at a time. Defaults to 10000.
+            sync (bool, optional): Upload only the rows that are new or changed since the local manifest of the
+                dataset. Items are keyed by the hash of their input, so a row whose expected output changed
+                updates its existing item. Defaults to False.
+
+        Returns:
+            list: (row, error) of every item that failed to upload
+        """
+
+        # Stream the file and sample it as it is read, the first chunk gives the columns
+        chunks = sample_chunks(
+            iter_chunks(file_path, encoding=encoding, chunk_size=chunk_size),
+            sample_size, mode=sample_mode)
+        first = next(chunks, None)
+        if first is None:
+            raise ValueError(f"No rows to upload in {file_path}")
+        chunks = itertools.chain([first], chunks)
         if input_columns is None:
-            input_columns = df.keys()[:-2]
+            input_columns = list(first.keys()[:-2])
             # print(f"Input columns: {input_columns}")
         if output_columns is None:
-            output_columns = [df.keys()[-1]]
+            output_columns = [first.keys()[-1]]
             # print(f"Output columns: {output_columns}")
             
         print(f"Input columns: {input_columns}")
@@ -81,45 +108,160 @@ class DatasetProcessor:
             
         # Create dataset in Langfuse if it doesn't already exist
         try:
-            self.langfuse.get_dataset(ds_name_in_langfuse)
-            print(f"Dataset {ds_name_in_langfuse} already exists in Langfuse.")
-            return
+            dataset = self.langfuse.get_dataset(ds_name_in_langfuse)
         except Exception as e:
+            dataset = None
             print(f"Creating dataset in Langfuse: {e}")
             self.langfuse.create_dataset(
                 name=ds_name_in_langfuse,
                 description=description,
                 metadata=metadata
             )
+        if dataset is not None and not sync:
+            print(f"Dataset {ds_name_in_langfuse} already exists in Langfuse.")
+            return []
 
-        # Process each row and upload to Langfuse
-        for i in tqdm(range(df.shape[0])):
-            data = df.iloc[i].to_dict()
-            
-            input_data = {key: data[key] for key in input_columns if key in data}
-            output_data = {key: data[key] for key in output_columns if key in data} if output_columns else None
+        manifest = None
+        if sync:
+            manifest = DatasetManifest(ds_name_in_langfuse, directory=os.getenv("DATASET_MANIFEST_DIR", ".cache/manifests"))
+            if dataset is None:
+                # The dataset was deleted or never uploaded, nothing in an old manifest is in it
+                manifest.reset()
+            elif not len(manifest):
+                manifest.seed(dataset.items)
+
+        skipped = []
+        seen = set()
+        built = 0
+
+        def build(chunk):
+            nonlocal built
+            items = self.build_dataset_items(chunk, input_columns, output_columns, skipped)
+            built += len(items)
+            return manifest.pending(items, seen) if manifest is not None else items
+
+        batches = (build(chunk) for chunk in chunks)
+        try:
+            if bulk:
+                total, failures = asyncio.run(self.upload_dataset_items(
+                    ds_name_in_langfuse, batches, concurrency=concurrency, manifest=manifest))
+            else:
+                total = 0
+                failures = []
+                with tqdm(unit='item') as progress:
+                    for items in batches:
+                        for row, input_data, output_data, item_id in items:
+                            try:
+                                self.langfuse.create_dataset_item(
+                                    dataset_name=ds_name_in_langfuse,
+                                    input=input_data,
+                                    expected_output=output_data,
+                                    id=item_id
+                                )
+                                if manifest is not None:
+                                    manifest.record(item_id)
+                            except Exception as e:
+                                failures.append((row, str(e)))
+                                progress.set_postfix(failed=len(failures))
+                            progress.update()
+                        total += len(items)
+        finally:
+            if manifest is not None:
+                manifest.close()
+
+        print(f"Uploaded {total - len(failures)}/{total} items to {ds_name_in_langfuse}, "
+              f"skipped {len(skipped)} rows with missing data"
+              + (f" and {built - total} unchanged rows" if manifest is not None else ""))
+        if skipped:
+            print(f"Skipped rows: {skipped}")
+        for row, error in failures:
+            print(f"Error creating dataset item in Langfuse for row {row}: {error}")
+        return failures
 
-            if len(input_columns) == 1:
-                input_data = data.get(input_columns[0], None)
-            if len(output_columns) == 1:
-                output_data = data.get(output_columns[0], None)
+    def build_dataset_items(self, df, input_columns, output_columns, skipped=None):
+        """Build the dataset items of a DataFrame column by column.
 
+        A single input or output column gives a plain value, several columns give a dict.
+        Missing values become None so that the items are JSON-serializable.
+
+        Args:
+            df (pd.DataFrame): The table.
+            input_columns (list): The input columns.
+            output_columns (list): The expected output columns, may be empty.
+            skipped (list, optional): A list the rows lacking input or output are appended to. Defaults to None.
+
+        Returns:
+            list: (row, input, expected_output, id) of every item, the ID is None
+        """
+        df = df.astype(object).where(df.notna(), None)
+
+        def column_values(columns):
+            if len(columns) == 1:
+                return df[columns[0]].tolist() if columns[0] in df else [None] * len(df)
+            return df[[column for column in columns if column in df]].to_dict('records')
+
+        inputs = column_values(list(input_columns))
+        outputs = column_values(list(output_columns)) if output_columns else [None] * len(df)
+        items = []
+        for row, input_data, output_data in zip(df.index.tolist(), inputs, outputs):
             if not input_data or (output_columns and not output_data):
-                print(f"Missing data in row {i}. Skipping row {i}")
-                continue
-            
-            # print(f"Input data: {input_data}")
-            # print(f"Output data: {output_data}")
-            
-            try:
-                self.langfuse.create_dataset_item(
-                    dataset_name=ds_name_in_langfuse,
-                    input=input_data,
-                    expected_output=output_data
-                )
-            except Exception as e:
-                print(f"Error creating dataset item in Langfuse for row {i}: {e}")
-                
+                if skipped is not None:
+                    skipped.append(row)
+            else:
+                items.append((row, input_data, output_data, None))
+        return items
+
+    async def upload_dataset_items(self, dataset_name, batches, concurrency=16, max_retries=3, retry_delay=1, manifest=None):
+        """Upload batches of dataset items concurrently, retrying rate-limited and failed requests.
+
+        The next batch is built in a thread while the current one uploads.
+
+        Args:
+            dataset_name (str): The name of the dataset.
+            batches (iterable): Lists of (row, input, expected_output, id), as built by build_dataset_items.
+            concurrency (int, optional): The number of concurrent requests. Defaults to 16.
+            max_retries (int, optional): The number of retries of a retryable failure. Defaults to 3.
+            retry_delay (float, optional): Seconds before the first retry, doubled after each one. Defaults to 1.
+            manifest (DatasetManifest, optional): A manifest recording the ID of every uploaded item. Defaults to None.
+
+        Returns:
+            tuple: (total, failures), the number of items and (row, error) of every item that failed to upload
+        """
+        async def upload(item):
+            row, input_data, output_data, item_id = item
+            delay = retry_delay
+            for attempt in range(max_retries + 1):
+                try:
+                    status, response = await fetch_langfuse.create_dataset_item(
+                        dataset_name, input_data, expected_output=output_data, id=item_id)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    status, response = None, str(e)
+                if status is not None and status < 300:
+                    if manifest is not None:
+                        manifest.record(item_id)
+                    return row, None
+                if not is_retryable(status) or attempt == max_retries:
+                    return row, f"{status} {response}"
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                delay *= 2
+
+        batches = iter(batches)
+        total = 0
+        failures = []
+        async with FetchLangfuse(fanout=concurrency) as fetch_langfuse:
+            with tqdm(unit='item') as progress:
+                items = await asyncio.to_thread(next, batches, None)
+                while items is not None:
+                    next_items = asyncio.create_task(asyncio.to_thread(next, batches, None))
+                    async for row, error in fetch_langfuse.map_concurrent(upload, items, ordered=False):
+                        if error is not None:
+                            failures.append((row, error))
+                            progress.set_postfix(failed=len(failures))
+                        progress.update()
+                    total += len(items)
+                    items = await next_items
+        return total, failures
+
 
 if __name__ == "__main__":
     import yaml
@@ -131,6 +273,7 @@ if __name__ == "__main__":
         file_path='../MedEval/妇产科6-28000.csv',
         encoding='GB18030',
         sample_size=2,
+        bulk=True,
         ds_name_in_langfuse="OAGD_妇产科",
         metadata={
             "author": "Peng Zirong",
@@ -0,0 +1,295 @@
+"""
+Persistent embedding cache and vectorised similarity
+"""
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+from ragas.embeddings import BaseRagasEmbeddings
+
+
+class EmbeddingStore:
+    """
+    A persistent store of float32 vectors keyed by text hash.
+
+    Vectors are appended to a raw float32 file read through a memory map, and an append-only
+    JSON Lines index maps each key to its row. Rows cut short by a crash are ignored on reopen.
+    Appends hold an exclusive file lock, so processes sharing the store do not interleave rows.
+    """
+    def __init__(self, directory):
+        """
+        Initialize EmbeddingStore, loading the existing index if any
+
+        Args:
+            directory (str): The directory of the vector file and its index
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.vectors_path = os.path.join(directory, 'vectors.f32')
+        self.index_path = os.path.join(directory, 'index.jsonl')
+        self.meta_path = os.path.join(directory, 'meta.json')
+        self.dim = None
+        self.rows = {}
+        self._count = 0
+        self._mmap = None
+        self._lock = threading.Lock()
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as file:
+                self.dim = json.load(file)['dim']
+            self._count = os.path.getsize(self.vectors_path) // (self.dim * 4) if os.path.exists(self.vectors_path) else 0
+            with open(self.index_path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry['row'] < self._count:
+                        self.rows[entry['key']] = entry['row']
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _matrix(self):
+        if self._count == 0:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        if self._mmap is None or self._mmap.shape[0] < self._count:
+            self._mmap = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self._count, self.dim))
+        return self._mmap
+
+    def get_many(self, keys):
+        """
+        Get the stored vectors of several keys
+
+        Args:
+            keys (list): The keys
+
+        Returns:
+            dict: A mapping from each stored key to its vector
+        """
+        with self._lock:
+            found = [(key, self.rows[key]) for key in keys if key in self.rows]
+            if not found:
+                return {}
+            matrix = np.array(self._matrix()[[row for _, row in found]])
+        return {key: vector for (key, _), vector in zip(found, matrix)}
+
+    def put_many(self, keys, vectors):
+        """
+        Append the vectors of several keys
+
+        Args:
+            keys (list): The keys
+            vectors (list): The vectors, all of the same dimension
+        """
+        if not len(keys):
+            return
+        matrix = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                with open(self.meta_path, 'w', encoding='utf-8') as file:
+                    json.dump({"dim": self.dim}, file)
+            if matrix.shape[1] != self.dim:
+                raise ValueError(f"Expected vectors of dimension {self.dim}, got {matrix.shape[1]}")
+            with open(self.vectors_path, 'ab') as file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                try:
+                    # Other processes may have appended rows, or a crash may have left a partial one
+                    start = file.seek(0, os.SEEK_END) // (self.dim * 4)
+                    file.truncate(start * self.dim * 4)
+                    file.write(matrix.tobytes())
+                    file.flush()
+                    with open(self.index_path, 'a', encoding='utf-8') as index:
+                        for offset, key in enumerate(keys):
+                            index.write(json.dumps({"key": key, "row": start + offset}) + '\n')
+                finally:
+                    fcntl.flock(file, fcntl.LOCK_UN)
+            for offset, key in enumerate(keys):
+                self.rows[key] = start + offset
+            self._count = start + len(keys)
+
+
+class CachedEmbeddings(BaseRagasEmbeddings):
+    """
+    Ragas embeddings answering repeated texts from an EmbeddingStore.
+
+    Texts are deduplicated and the missing ones are sent in large embed_documents batches.
+    Concurrent aembed_query calls are coalesced into one batch. Queries are embedded as
+    documents, which is the same for OpenAI-compatible endpoints.
+    """
+    def __init__(self, embeddings, store, model=None, batch_size=256, coalesce_delay=0.01):
+        """
+        Initialize CachedEmbeddings
+
+        Args:
+            embeddings (BaseRagasEmbeddings): The wrapped embeddings, e.g. a LangchainEmbeddingsWrapper
+            store (EmbeddingStore): The store of the vectors
+            model (str, optional): The model name in the key. Defaults to the model of the wrapped embeddings.
+            batch_size (int, optional): The largest number of texts per embed_documents call. Defaults to 256.
+            coalesce_delay (float, optional): Seconds aembed_query waits for other queries to batch with. Defaults to 0.01.
+        """
+        self.embeddings = embeddings
+        self.store = store
+        self.model = model or getattr(getattr(embeddings, 'embeddings', None), 'model', None) or type(embeddings).__name__
+        self.batch_size = batch_size
+        self.coalesce_delay = coalesce_delay
+        self.run_config = embeddings.run_config
+        self.hits = 0
+        self.misses = 0
+        self._queries = {}
+        self._flushes = set()
+
+    def set_run_config(self, run_config):
+        self.run_config = run_config
+        self.embeddings.set_run_config(run_config)
+
+    def key(self, text):
+        """
+        Build the key of a text
+
+        Args:
+            text (str): The text
+
+        Returns:
+            str: The SHA-256 hex digest of the model name and the text
+        """
+        return hashlib.sha256(f"{self.model}\n{text}".encode('utf-8')).hexdigest()
+
+    def _lookup(self, texts):
+        keys = [self.key(text) for text in texts]
+        vectors = self.store.get_many(list(dict.fromkeys(keys)))
+        missing = {}
+        for text, key in zip(texts, keys):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        self.hits += len(texts) - sum(1 for key in keys if key in missing)
+        self.misses += sum(1 for key in keys if key in missing)
+        return keys, vectors, missing
+
+    def _batches(self, missing):
+        items = list(missing.items())
+        for start in range(0, len(items), self.batch_size):
+            yield items[start:start + self.batch_size]
+
+    def embed_documents(self, texts):
+        keys, vectors, missing = self._lookup(texts)
+        for batch in self._batches(missing):
+            embedded = self.embeddings.embed_documents([text for _, text in batch])
+            self.store.put_many([key for key, _ in batch], embedded)
+            vectors.update(zip((key for key, _ in batch), np.asarray(embedded, dtype=np.float32)))
+        return [vectors[key].tolist() for key in keys]
+
+    async def aembed_documents(self, texts):
+        keys, vectors, missing = self._lookup(texts)
+        batches = list(self._batches(missing))
+        results = await asyncio.gather(*[
+            self.embeddings.aembed_documents([text for _, text in batch]) for batch in batches])
+        for batch, embedded in zip(batches, results):
+            self.store.put_many([key for key, _ in batch], embedded)
+            vectors.update(zip((key for key, _ in batch), np.asarray(embedded, dtype=np.float32)))
+        return [vectors[key].tolist() for key in keys]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_query(self, text):
+        loop = asyncio.get_running_loop()
+        pending = self._queries.get(loop)
+        if pending is None:
+            pending = self._queries[loop] = []
+            loop.call_later(self.coalesce_delay, self._schedule_flush, loop)
+        future = loop.create_future()
+        pending.append((text, future))
+        if len(pending) >= self.batch_size:
+            await self._flush_queries(loop)
+        return await future
+
+    def _schedule_flush(self, loop):
+        task = loop.create_task(self._flush_queries(loop))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush_queries(self, loop):
+        pending = self._queries.pop(loop, None)
+        if not pending:
+            return
+        try:
+            vectors = await self.aembed_documents([text for text, _ in pending])
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), vector in zip(pending, vectors):
+            if not future.done():
+                future.set_result(vector)
+
+    def similarities(self, texts, others):
+        """
+        Compute the cosine similarity of each pair of texts in one embedding batch
+
+        Args:
+            texts (list): The first text of every pair
+            others (list): The second text of every pair
+
+        Returns:
+            np.ndarray: The similarity of every pair
+        """
+        vectors = np.asarray(self.embed_documents(list(texts) + list(others)), dtype=np.float32)
+        return pairwise_cosine(vectors[:len(texts)], vectors[len(texts):])
+
+    def stats(self):
+        """
+        Get the hit and miss counts
+
+        Returns:
+            dict: hits, misses and hit_rate
+        """
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+def normalize(vectors):
+    """
+    Scale every row to unit length, zero rows stay zero
+
+    Args:
+        vectors (np.ndarray): A matrix of row vectors
+
+    Returns:
+        np.ndarray: The normalized matrix
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def cosine_similarity(queries, documents):
+    """
+    Compute the cosine similarity of every query with every document
+
+    Args:
+        queries (np.ndarray): A matrix of query vectors
+        documents (np.ndarray): A matrix of document vectors
+
+    Returns:
+        np.ndarray: A matrix of shape (len(queries), len(documents))
+    """
+    return normalize(queries) @ normalize(documents).T
+
+
+def pairwise_cosine(vectors, others):
+    """
+    Compute the cosine similarity of each row with the same row of another matrix
+
+    Args:
+        vectors (np.ndarray): A matrix of vectors
+        others (np.ndarray): A matrix of vectors of the same shape
+
+    Returns:
+        np.ndarray: The similarity of every row pair
+    """
+    return np.einsum('ij,ij->i', normalize(vectors), normalize(others))
@@ -1,11 +1,18 @@
 import os
 import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from cache import is_closed_page, is_closed_query, is_complete_observation, is_complete_trace, query_key
+from langfuse_common import format_timestamp, group_by_trace, incomplete_indices, parse_timestamp, trace_windows
+from rules import compile_rules
+
 
 class FetchLangfuse:
     """
     A class for fetching data from Langfuse API
     """
-    def __init__(self, secret_key, public_key, host):
+    def __init__(self, secret_key, public_key, host, fanout=8, cache=None, offline=False):
         """
         Initialize FetchLangfuse with secret key, public key, and host
 
@@ -13,24 +20,84 @@ class FetchLangfuse:
             secret_key (str): The secret key for authentication
             public_key (str): The public key for authentication
             host (str): The host URL for the Langfuse API
+            fanout (int, optional): The number of concurrent calls at each crawl level. Requests in flight
+                across all levels are capped at fanout * fanout, the size of the connection pool. Defaults to 8.
+            cache (SQLiteCache, optional): A persistent cache of traces, observations and sessions. Defaults to None.
+            offline (bool, optional): Serve every request from the cache and never call the API. Defaults to False.
         """
         self.secret_key = secret_key
         self.public_key = public_key
         self.host = host
+        self.fanout = fanout
+        self.cache = cache
+        self.offline = offline
+        self.session = requests.Session()
+        self.session.auth = (self.public_key, self.secret_key)
+        # Crawl levels nest map_concurrent, so threads can outnumber the pool; the semaphore keeps
+        # requests in flight within the pool instead of letting urllib3 discard connections
+        pool_size = fanout * fanout
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=pool_size))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=pool_size))
+        self._connections = threading.BoundedSemaphore(pool_size)
         # print(f"secret_key: {self.secret_key}")
         # print(f"public_key: {self.public_key}")
         # print(f"host: {self.host}")
         
-    def fetch_sessions(self):
+    def _get_cached(self, kind, id, url, params=None, version=None, cacheable=bool, serve_online=True):
+        """
+        Send a GET request through the cache
+
+        Args:
+            kind (str): The kind of the cache entry, e.g. "trace"
+            id (str): The ID of the cache entry
+            url (str): The request URL
+            params (dict, optional): Query parameters. Defaults to None.
+            version (str, optional): The expected version of a cached entry, e.g. an updatedAt. Defaults to None.
+            cacheable (callable, optional): Whether a response may be stored. Defaults to bool.
+            serve_online (bool, optional): Whether cached entries are served when not offline; mutable
+                resources such as sessions and list pages are only served offline. Defaults to True.
+
+        Returns:
+            dict: The JSON response
+
+        Raises:
+            LookupError: If offline and the entry is not cached
+        """
+        if self.cache is not None and (self.offline or serve_online):
+            value = self.cache.get(kind, id, version)
+            if value is not None:
+                return value
+        if self.offline:
+            raise LookupError(f"{kind} {id} is not cached and offline mode is on")
+        with self._connections:
+            value = self.session.get(url, params=params).json()
+        if self.cache is not None and cacheable(value):
+            self.cache.put(kind, id, value, version=value.get('updatedAt'))
+        return value
+
+    def fetch_sessions(self, page: int = None, limit: int = None, fromTimestamp: str = None, toTimestamp: str = None):
         """
-        Fetch all sessions from Langfuse API
+        Fetch one page of sessions from Langfuse API
+
+        Args:
+            page (int, optional): The page number. Defaults to None.
+            limit (int, optional): The limit of sessions per page. Defaults to None.
+            fromTimestamp (str, optional): The start of the creation time range. Defaults to None.
+            toTimestamp (str, optional): The end of the creation time range. Defaults to None.
 
         Returns:
             dict: The JSON response containing the sessions
         """
         url = f"{self.host}/api/public/sessions"
-        response = requests.get(url, auth=(self.public_key, self.secret_key))
-        return response.json()
+        params = {
+            "page": page,
+            "limit": limit,
+            "fromTimestamp": fromTimestamp,
+            "toTimestamp": toTimestamp
+        }
+        return self._get_cached(
+            'sessions', query_key(url, params), url, params=params,
+            cacheable=lambda response: is_closed_page(response, params), serve_online=False)
 
     def fetch_session(self, session_id):
         """
@@ -43,8 +110,9 @@ class FetchLangfuse:
             dict: The JSON response containing the session
         """
         url = f"{self.host}/api/public/sessions/{session_id}"
-        response = requests.get(url, auth=(self.public_key, self.secret_key))
-        return response.json()
+        return self._get_cached(
+            'session', session_id, url,
+            cacheable=lambda session: 'traces' in session, serve_online=False)
     
     def fetch_session_traces(self, session):
         """
@@ -59,19 +127,19 @@ class FetchLangfuse:
         traces = session["traces"]
         return traces
     
-    def fetch_trace(self, trace_id):
+    def fetch_trace(self, trace_id, updated_at=None):
         """
         Fetch a specific trace from Langfuse API
 
         Args:
             trace_id (str): The ID of the trace
+            updated_at (str, optional): The known updatedAt of the trace, a cached copy of another version is refetched. Defaults to None.
 
         Returns:
             dict: The JSON response containing the trace
         """
         url = f"{self.host}/api/public/traces/{trace_id}"
-        response = requests.get(url, auth=(self.public_key, self.secret_key))
-        return response.json()
+        return self._get_cached('trace', trace_id, url, version=updated_at, cacheable=is_complete_trace)
     
     def fetch_observations(self, page: int = None, limit: int = None, name: str = None, userId: str = None, type: str = None, traceId: str = None, parentObservationId: str = None, fromStartTime: str = None, toStartTime: str = None, version: str = None):
         """
@@ -91,8 +159,13 @@ class FetchLangfuse:
 
         Returns:
             dict: The JSON response containing the observations
+
+        Raises:
+            LookupError: If offline and the time range of the query has not ended, such a page is never cached
         """
         url = f"{self.host}/api/public/observations"
+        if self.offline and not is_closed_query({"toStartTime": toStartTime}):
+            raise LookupError(f"Observations started until {toStartTime} are still changing and cannot be served offline")
         params = {
             "page": page,
             "limit": limit,
@@ -105,9 +178,100 @@ class FetchLangfuse:
             "toStartTime": toStartTime,
             "version": version
         }
-        response = requests.get(url, auth=(self.public_key, self.secret_key), params=params)
-        return response.json()
+        response = self._get_cached(
+            'observations', query_key(url, params), url, params=params,
+            cacheable=lambda response: is_closed_page(response, params), serve_online=False)
+        if self.cache is not None and not self.offline:
+            self.cache.put_many('observation', [
+                (observation['id'], observation, observation.get('updatedAt'))
+                for observation in response.get('data', []) if is_complete_observation(observation)])
+        return response
     
+    def fetch_observations_in_window(self, from_time, to_time, page_size=100, **query):
+        """
+        Fetch every observation started within a time window, page by page
+
+        Args:
+            from_time (datetime): The start of the window
+            to_time (datetime): The end of the window
+            page_size (int, optional): The number of observations per page. Defaults to 100.
+            **query: Extra query parameters such as name, type or traceId
+
+        Returns:
+            list: A list of observations
+        """
+        return list(self.iter_observations(
+            page_size=page_size,
+            fromStartTime=format_timestamp(from_time),
+            toStartTime=format_timestamp(to_time),
+            **query
+        ))
+
+    def iter_pages(self, fetch_page, page_size=50, **params):
+        """
+        Walk every page of a paginated endpoint
+
+        Args:
+            fetch_page (callable): A function taking page, limit and params, e.g. fetch_observations
+            page_size (int, optional): The number of items per page. Defaults to 50.
+            **params: Extra query parameters passed to every page
+
+        Yields:
+            dict: Each item of each page
+        """
+        page = 1
+        while True:
+            response = fetch_page(page=page, limit=page_size, **params)
+            yield from response['data']
+            if page >= response.get('meta', {}).get('totalPages', page):
+                return
+            page += 1
+
+    def iter_sessions(self, page_size=50, **params):
+        """
+        Iterate over all sessions page by page
+
+        Args:
+            page_size (int, optional): The number of sessions per page. Defaults to 50.
+            **params: Extra query parameters of fetch_sessions
+
+        Yields:
+            dict: Each session
+        """
+        yield from self.iter_pages(self.fetch_sessions, page_size=page_size, **params)
+
+    def iter_observations(self, page_size=100, **params):
+        """
+        Iterate over all observations matching a query page by page
+
+        Args:
+            page_size (int, optional): The number of observations per page. Defaults to 100.
+            **params: Extra query parameters of fetch_observations
+
+        Yields:
+            dict: Each observation
+        """
+        yield from self.iter_pages(self.fetch_observations, page_size=page_size, **params)
+
+    def map_concurrent(self, func, items, ordered=True):
+        """
+        Apply a function to items on a bounded thread pool, yielding results as they resolve
+
+        Args:
+            func (callable): The function to apply
+            items (list): The items to apply the function to
+            ordered (bool, optional): Whether to yield results in input order. Defaults to True.
+
+        Yields:
+            The result of each call
+        """
+        with ThreadPoolExecutor(max_workers=self.fanout) as executor:
+            if ordered:
+                yield from executor.map(func, items)
+            else:
+                for future in as_completed([executor.submit(func, item) for item in items]):
+                    yield future.result()
+
     def fetch_observation(self, observation_id):
         """
         Fetch a specific observation from Langfuse API
@@ -119,8 +283,7 @@ class FetchLangfuse:
             dict: The JSON response containing the observation
         """
         url = f"{self.host}/api/public/observations/{observation_id}"
-        response = requests.get(url, auth=(self.public_key, self.secret_key))
-        return response.json()
+        return self._get_cached('observation', observation_id, url, cacheable=is_complete_observation)
     
     def fetch_session_traces_idx(self, session):
         """
@@ -143,17 +306,18 @@ class FetchLangfuse:
                 )
         return traces_idx
     
-    def fetch_trace_observations(self, trace_id):
+    def fetch_trace_observations(self, trace_id, updated_at=None):
         """
         Fetch observations for a specific trace
 
         Args:
             trace_id (str): The ID of the trace
+            updated_at (str, optional): The known updatedAt of the trace. Defaults to None.
 
         Returns:
             list: A list of observations
         """
-        trace = self.fetch_trace(trace_id)
+        trace = self.fetch_trace(trace_id, updated_at=updated_at)
         observations = trace["observations"]
         return observations
     
@@ -185,16 +349,12 @@ class FetchLangfuse:
 
         Args:
             data (list): The data to filter
-            rules (list): A list of rules to filter the data
+            rules (list): A list of rules to filter the data, or a RuleSet
 
         Returns:
-            list: A list of selected IDs
+            list: A list of selected (ID, index) pairs
         """
-        selected_ids = []
-        for item in data:
-            if all(rule(item) for rule in rules):
-                selected_ids.append((item['id'], data.index(item)))
-        return selected_ids
+        return [(data[index]['id'], index) for index in compile_rules(rules).select_indices(data)]
     
     def fetch_node_observations(self, session_id, rules):
         """
@@ -207,19 +367,77 @@ class FetchLangfuse:
         Returns:
             list: A list of node observations
         """
-        node_observations = []
         session = self.fetch_session(session_id)
         session_traces = self.fetch_session_traces(session)
-        for session_trace in session_traces:
-            trace = self.fetch_trace(session_trace["id"])
-            trace_observations = trace["observations"]
-            selected_ids = self.select_ids(trace_observations, rules)
-            if selected_ids:
-                for selected_id in selected_ids:
-                    observation_id = selected_id[0]
-                    observation = self.fetch_observation(observation_id)
-                    node_observations.append(observation)
-        return node_observations
+        return self.fetch_traces_selected_observations(session_traces, rules)
+
+    def complete_observations(self, observations):
+        """
+        Fetch the full body of observations that lack their input or output
+
+        Args:
+            observations (list): A list of observations
+
+        Returns:
+            list: The observations, with incomplete ones fetched again by ID
+        """
+        incomplete = incomplete_indices(observations)
+        fetched = self.map_concurrent(self.fetch_observation, [observations[index]['id'] for index in incomplete])
+        observations = list(observations)
+        for index, observation in zip(incomplete, fetched):
+            observations[index] = observation
+        return observations
+
+    def fetch_traces_selected_observations(self, traces, rules, slack=600, max_window=600):
+        """
+        Fetch selected observations of several traces with a few time-windowed list queries.
+
+        The traces are grouped into windows of at most max_window seconds, one list query each, so a
+        session spread over hours only queries the minutes around its traces. The predicates of the
+        rules the API can evaluate are sent as query parameters and only the rest is applied locally.
+        Traces without a timestamp, or without any observation in their window, fall back to one GET
+        of the trace itself, whose payload already contains its observations.
+
+        Args:
+            traces (list): A list of traces, e.g. the traces of a session
+            rules (list): A list of rules to filter the observations
+            slack (float, optional): Seconds each window is widened by on both ends. Defaults to 600.
+            max_window (float, optional): The largest number of seconds between the first and last trace of a window. Defaults to 600.
+
+        Returns:
+            list: A list of selected observations, in trace order
+        """
+        query, residual = compile_rules(rules).split()
+        updated_at = {trace['id']: trace.get('updatedAt') for trace in traces}
+        timestamps = [parse_timestamp(trace['timestamp']) for trace in traces if trace.get('timestamp')]
+        windows = trace_windows(timestamps, slack, max_window)
+        trace_observations = group_by_trace([trace['id'] for trace in traces], self.map_concurrent(
+            lambda window: self.fetch_observations_in_window(*window, **query), windows))
+        for trace_id, observations in trace_observations.items():
+            trace_observations[trace_id] = self.select_data(observations, residual)
+
+        missing = [trace_id for trace_id, observations in trace_observations.items() if not observations]
+        for trace_id, observations in zip(missing, self.map_concurrent(
+                lambda trace_id: self.fetch_trace_observations(trace_id, updated_at[trace_id]), missing)):
+            trace_observations[trace_id] = self.select_data(observations, rules)
+
+        selected_observations = []
+        for observations in trace_observations.values():
+            selected_observations.extend(observations)
+        return self.complete_observations(selected_observations)
+
+    def select_data(self, data, rules):
+        """
+        Select data based on rules
+
+        Args:
+            data (list): The data to filter
+            rules (list): A list of rules to filter the data, or a RuleSet
+
+        Returns:
+            list: A list of selected data
+        """
+        return [data[index] for index in compile_rules(rules).select_indices(data)]
     
     def fetch_trace_scores(self, trace_id):
         """
@@ -245,18 +463,26 @@ class FetchLangfuse:
         Returns:
             list: A list of selected observations
         """
-        selected_observations = []
-        sessions = self.fetch_sessions()['data']
-        for session in sessions:
-            session_id = session['id']
+        sessions_ids = [session['id'] for session in self.iter_sessions()]
+        return self.get_sessions_selected_observations(sessions_ids, rules)
+
+    def iter_sessions_selected_observations(self, sessions_ids, rules, ordered=False):
+        """
+        Crawl sessions concurrently, yielding the selected observations of each session as it resolves.
+
+        Args:
+            sessions_ids (list): A list of session IDs
+            rules (list): A list of rules to filter the observations
+            ordered (bool, optional): Whether to yield sessions in input order. Defaults to False.
+
+        Yields:
+            list: The selected observations of one session
+        """
+        def crawl_session(session_id):
             traces = self.fetch_session_traces(self.fetch_session(session_id))
-            for trace in traces:
-                trace_id = trace['id']
-                observations = self.fetch_trace_observations(trace_id)
-                selected_ids = self.select_ids(observations, rules)
-                if selected_ids:
-                    selected_observations.extend([self.fetch_observation(selected_id[0]) for selected_id in selected_ids])
-        return selected_observations
+            return self.fetch_traces_selected_observations(traces, rules)
+
+        yield from self.map_concurrent(crawl_session, sessions_ids, ordered=ordered)
     
     def get_sessions_selected_observations(self, sessions_ids, rules):
         """
@@ -270,12 +496,6 @@ class FetchLangfuse:
             list: A list of selected observations
         """
         selected_observations = []
-        for session_id in sessions_ids:
-            traces = self.fetch_session_traces(self.fetch_session(session_id))
-            for trace in traces:
-                trace_id = trace['id']
-                observations = self.fetch_trace_observations(trace_id)
-                selected_ids = self.select_ids(observations, rules)
-                if selected_ids:
-                    selected_observations.extend([self.fetch_observation(selected_id[0]) for selected_id in selected_ids])
+        for observations in self.iter_sessions_selected_observations(sessions_ids, rules, ordered=True):
+            selected_observations.extend(observations)
         return selected_observations
\ No newline at end of file
@@ -0,0 +1,262 @@
+"""
+Per-stage latency instrumentation
+"""
+import asyncio
+import json
+import os
+import random
+import time
+
+
+class Histogram:
+    """
+    A latency histogram keeping exact counts and a bounded reservoir of samples for quantiles
+    """
+    def __init__(self, reservoir_size=10000):
+        """
+        Initialize Histogram
+
+        Args:
+            reservoir_size (int, optional): The largest number of samples kept for quantiles. Defaults to 10000.
+        """
+        self.reservoir_size = reservoir_size
+        self.samples = []
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+        self.retries = 0
+
+    def observe(self, value):
+        """
+        Record a value
+
+        Args:
+            value (float): The value, e.g. seconds
+        """
+        self.count += 1
+        self.sum += value
+        if len(self.samples) < self.reservoir_size:
+            self.samples.append(value)
+        else:
+            index = random.randrange(self.count)
+            if index < self.reservoir_size:
+                self.samples[index] = value
+
+    def quantile(self, q):
+        """
+        Estimate a quantile
+
+        Args:
+            q (float): The quantile between 0 and 1
+
+        Returns:
+            float: The estimated quantile, or None without samples
+        """
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+    def snapshot(self):
+        """
+        Summarize the histogram
+
+        Returns:
+            dict: count, errors, retries, sum, mean, p50, p90 and p99
+        """
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "retries": self.retries,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+class _Timer:
+    """
+    A monotonic timer recording into a histogram, usable with both with and async with
+    """
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.monotonic() - self.start)
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            self.histogram.errors += 1
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+
+class Metrics:
+    """
+    A registry of per-stage histograms
+    """
+    QUANTILES = (("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99"))
+
+    def __init__(self):
+        self.histograms = {}
+        self._line = None
+
+    def histogram(self, stage):
+        """
+        Get the histogram of a stage, creating it on first use
+
+        Args:
+            stage (str): The name of the stage
+
+        Returns:
+            Histogram: The histogram
+        """
+        if stage not in self.histograms:
+            self.histograms[stage] = Histogram()
+        return self.histograms[stage]
+
+    def timer(self, stage):
+        """
+        Time a block and record it for a stage, an exception raised in the block counts as an error
+
+        Args:
+            stage (str): The name of the stage
+
+        Returns:
+            A context manager usable with both with and async with
+        """
+        return _Timer(self.histogram(stage))
+
+    def observe(self, stage, value):
+        """
+        Record a value for a stage
+
+        Args:
+            stage (str): The name of the stage
+            value (float): The value, e.g. seconds
+        """
+        self.histogram(stage).observe(value)
+
+    def error(self, stage):
+        """
+        Count an error of a stage
+
+        Args:
+            stage (str): The name of the stage
+        """
+        self.histogram(stage).errors += 1
+
+    def retry(self, stage):
+        """
+        Count a retry of a stage
+
+        Args:
+            stage (str): The name of the stage
+        """
+        self.histogram(stage).retries += 1
+
+    def snapshot(self):
+        """
+        Summarize every stage
+
+        Returns:
+            dict: A mapping from stage name to its summary
+        """
+        return {stage: histogram.snapshot() for stage, histogram in self.histograms.items()}
+
+    def summary(self):
+        """
+        Format the p50/p99 latency and error count of every stage as a single line
+
+        Returns:
+            str: The summary line
+        """
+        parts = []
+        for stage, snapshot in self.snapshot().items():
+            if snapshot["count"]:
+                parts.append(f"{stage} n={snapshot['count']} p50={snapshot['p50']:.2f}s p99={snapshot['p99']:.2f}s err={snapshot['errors']}")
+        return " | ".join(parts)
+
+    async def report(self, interval=5, extra=None):
+        """
+        Rewrite a live summary line periodically until cancelled
+
+        Args:
+            interval (float, optional): Seconds between two updates. Defaults to 5.
+            extra (callable, optional): A function returning more text for the line, e.g. StageScheduler.summary. Defaults to None.
+        """
+        self._line = ""
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                self._line = " || ".join(part for part in (self.summary(), extra() if extra else "") if part)
+                print(f"\r\033[K{self._line}", end="", flush=True)
+        finally:
+            self._line = None
+            print()
+
+    def log(self, message):
+        """
+        Print a message above the live summary line, or as a plain line when no report is running
+
+        Args:
+            message (str): The message
+        """
+        if self._line is None:
+            print(message)
+        else:
+            print(f"\r\033[K{message}\n{self._line}", end="", flush=True)
+
+    def export_json(self, path):
+        """
+        Write the summary of every stage as JSON
+
+        Args:
+            path (str): The output file path
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.snapshot(), file, indent=2)
+
+    def export_prometheus(self, path, prefix="autoeval"):
+        """
+        Write the summary of every stage in the Prometheus text exposition format
+
+        Args:
+            path (str): The output file path
+            prefix (str, optional): The prefix of the metric names. Defaults to "autoeval".
+        """
+        snapshot = self.snapshot()
+        lines = [
+            f"# HELP {prefix}_stage_seconds Latency of pipeline stages in seconds.",
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for stage, summary in snapshot.items():
+            for quantile, key in self.QUANTILES:
+                if summary[key] is not None:
+                    lines.append(f'{prefix}_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {summary[key]}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {summary["sum"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {summary["count"]}')
+        for name in ("errors", "retries"):
+            lines.append(f"# HELP {prefix}_stage_{name}_total Number of {name} of pipeline stages.")
+            lines.append(f"# TYPE {prefix}_stage_{name}_total counter")
+            for stage, summary in snapshot.items():
+                lines.append(f'{prefix}_stage_{name}_total{{stage="{stage}"}} {summary[name]}')
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write("\n".join(lines) + "\n")
+
+
+metrics = Metrics()
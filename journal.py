@@ -0,0 +1,88 @@
+"""
+Append-only journal of evaluation runs
+"""
+import json
+import os
+import re
+
+
+class RunJournal:
+    """
+    An append-only JSON Lines journal recording which stages of a run are complete.
+
+    Item stages are keyed by dataset item ID ("answered", "resolved", "linked") and
+    score stages by observation ID ("scored", "uploaded"). Reopening the journal of a
+    run replays it, so a restarted run only repeats the unfinished work.
+    """
+    def __init__(self, run_name, directory='runs'):
+        """
+        Initialize RunJournal, replaying the existing journal of the run if any
+
+        Args:
+            run_name (str): The name of the run
+            directory (str, optional): The directory of the journal files. Defaults to 'runs'.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.run_name = run_name
+        self.path = os.path.join(directory, re.sub(r'[^\w.-]+', '_', run_name) + '.jsonl')
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A line cut short by a crash
+                        continue
+                    self.entries.setdefault(entry['key'], {})[entry['stage']] = entry['data']
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if self._file.tell() > 0:
+            with open(self.path, 'rb') as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    self._file.write('\n')
+
+    def record(self, key, stage, **data):
+        """
+        Append the completion of a stage
+
+        Args:
+            key (str): The dataset item ID or observation ID
+            stage (str): The completed stage
+            **data: The results of the stage needed to resume from it
+        """
+        self._file.write(json.dumps({"key": key, "stage": stage, "data": data}, ensure_ascii=False) + '\n')
+        self._file.flush()
+        self.entries.setdefault(key, {})[stage] = data
+
+    def get(self, key, stage):
+        """
+        Get the recorded results of a stage
+
+        Args:
+            key (str): The dataset item ID or observation ID
+            stage (str): The stage
+
+        Returns:
+            dict: The recorded data, or None if the stage is not complete
+        """
+        return self.entries.get(key, {}).get(stage)
+
+    def done(self, key, stage):
+        """
+        Check whether a stage is complete
+
+        Args:
+            key (str): The dataset item ID or observation ID
+            stage (str): The stage
+
+        Returns:
+            bool: True if the stage was recorded
+        """
+        return stage in self.entries.get(key, {})
+
+    def close(self):
+        """
+        Close the journal file
+        """
+        self._file.close()
@@ -0,0 +1,88 @@
+"""
+Pure helpers shared by the sync and async Langfuse clients
+"""
+from datetime import datetime, timedelta, timezone
+
+
+def format_timestamp(time):
+    """
+    Format a datetime as the ISO 8601 UTC timestamp expected by the Langfuse API
+
+    Args:
+        time (datetime): The time, naive values are taken as UTC
+
+    Returns:
+        str: The timestamp, e.g. 2024-09-12T08:00:00.000Z
+    """
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return time.astimezone(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def parse_timestamp(timestamp):
+    """
+    Parse an ISO 8601 timestamp returned by the Langfuse API
+
+    Args:
+        timestamp (str): The timestamp, e.g. 2024-09-12T08:00:00.000Z
+
+    Returns:
+        datetime: The timezone-aware time
+    """
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
+
+def trace_windows(timestamps, slack=600, max_window=600):
+    """
+    Group trace timestamps into short query windows, so traces far apart in time do not span one long window
+
+    Args:
+        timestamps (list): The timestamps of the traces
+        slack (float, optional): Seconds each window is widened by on both ends. Defaults to 600.
+        max_window (float, optional): The largest number of seconds between the first and last trace of a window. Defaults to 600.
+
+    Returns:
+        list: (from_time, to_time) of every window
+    """
+    windows = []
+    for timestamp in sorted(timestamps):
+        if windows and (timestamp - windows[-1][0]).total_seconds() <= max_window:
+            windows[-1][1] = timestamp
+        else:
+            windows.append([timestamp, timestamp])
+    return [(first - timedelta(seconds=slack), last + timedelta(seconds=slack)) for first, last in windows]
+
+
+def group_by_trace(trace_ids, pages):
+    """
+    Group the observations of several list queries by trace, dropping other traces and duplicates
+
+    Args:
+        trace_ids (iterable): The IDs of the wanted traces
+        pages (iterable): Lists of observations, e.g. one per query window. Windows may overlap.
+
+    Returns:
+        dict: A mapping from each trace ID to its observations, in the order they were listed
+    """
+    trace_observations = {trace_id: [] for trace_id in trace_ids}
+    seen = set()
+    for observations in pages:
+        for observation in observations:
+            if observation.get('traceId') in trace_observations and observation['id'] not in seen:
+                seen.add(observation['id'])
+                trace_observations[observation['traceId']].append(observation)
+    return trace_observations
+
+
+def incomplete_indices(observations):
+    """
+    Find the observations listed without their input or output
+
+    Args:
+        observations (list): A list of observations
+
+    Returns:
+        list: The indices of the incomplete observations
+    """
+    return [index for index, observation in enumerate(observations)
+            if 'input' not in observation or 'output' not in observation]
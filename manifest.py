@@ -0,0 +1,155 @@
+"""
+Manifest of the rows synced to a dataset
+"""
+import hashlib
+import json
+import os
+import re
+
+
+def item_key(input, dataset_name=''):
+    """
+    Compute a stable hash of the input of a dataset item, used as its ID
+
+    Args:
+        input: The input of the item
+        dataset_name (str, optional): The name of the dataset, item IDs are unique across datasets. Defaults to ''.
+
+    Returns:
+        str: The SHA-256 hex digest of the canonical JSON of the input
+    """
+    content = json.dumps(
+        {"dataset": dataset_name, "input": input},
+        sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def item_hash(input, expected_output, dataset_name=''):
+    """
+    Compute a stable hash of the content of a dataset item, used to detect changed rows
+
+    Args:
+        input: The input of the item
+        expected_output: The expected output of the item
+        dataset_name (str, optional): The name of the dataset. Defaults to ''.
+
+    Returns:
+        str: The SHA-256 hex digest of the canonical JSON of the item
+    """
+    content = json.dumps(
+        {"dataset": dataset_name, "input": input, "expected_output": expected_output},
+        sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class DatasetManifest:
+    """
+    An append-only JSON Lines record of the items uploaded to a dataset.
+
+    Every entry maps the hash of an item's input to the ID of its item and the hash of its content.
+    A row whose content is unchanged is skipped, and a row whose expected output changed is
+    uploaded again with the ID of its existing item, so that the item is updated in place.
+    """
+    def __init__(self, dataset_name, directory='.cache/manifests'):
+        """
+        Initialize DatasetManifest, loading the existing manifest of the dataset if any
+
+        Args:
+            dataset_name (str): The name of the dataset
+            directory (str, optional): The directory of the manifest files. Defaults to '.cache/manifests'.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.dataset_name = dataset_name
+        self.path = os.path.join(directory, re.sub(r'[^\w.-]+', '_', dataset_name) + '.jsonl')
+        self.entries = {}
+        self._staged = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry['key']] = (entry['id'], entry['hash'])
+                    except (json.JSONDecodeError, KeyError):
+                        # A line cut short by a crash, or written by an older version
+                        continue
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if self._file.tell() > 0:
+            with open(self.path, 'rb') as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    self._file.write('\n')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def record(self, id, key=None, hash=None):
+        """
+        Append an uploaded item
+
+        Args:
+            id (str): The ID of the item
+            key (str, optional): The hash of its input. Defaults to the key staged by pending.
+            hash (str, optional): The hash of its content. Defaults to the hash staged by pending.
+        """
+        if key is None:
+            key, hash = self._staged.pop(id)
+        if self.entries.get(key) == (id, hash):
+            return
+        self._file.write(json.dumps({"key": key, "id": id, "hash": hash}) + '\n')
+        self._file.flush()
+        self.entries[key] = (id, hash)
+
+    def reset(self):
+        """
+        Forget every recorded item
+        """
+        self._file.seek(0)
+        self._file.truncate()
+        self.entries.clear()
+        self._staged.clear()
+
+    def seed(self, items):
+        """
+        Record the items already in the dataset, e.g. when it was uploaded without a manifest
+
+        Args:
+            items (list): Dataset items with id, input and expected_output attributes
+        """
+        for item in items:
+            self.record(
+                item.id,
+                key=item_key(item.input, self.dataset_name),
+                hash=item_hash(item.input, item.expected_output, self.dataset_name))
+
+    def pending(self, items, seen=None):
+        """
+        Select the new and changed items and give them the ID of their existing item, or their input hash
+
+        Args:
+            items (list): (row, input, expected_output, id) of every item
+            seen (set, optional): Input hashes already selected in this sync, so a duplicate input uploads once. Defaults to None.
+
+        Returns:
+            list: (row, input, expected_output, id) of every new or changed item
+        """
+        selected = []
+        for row, input, expected_output, _ in items:
+            key = item_key(input, self.dataset_name)
+            hash = item_hash(input, expected_output, self.dataset_name)
+            id, stored_hash = self.entries.get(key, (key, None))
+            if stored_hash == hash or (seen is not None and key in seen):
+                continue
+            if seen is not None:
+                seen.add(key)
+            self._staged[id] = (key, hash)
+            selected.append((row, input, expected_output, id))
+        return selected
+
+    def close(self):
+        """
+        Close the manifest file
+        """
+        self._file.close()
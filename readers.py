@@ -0,0 +1,131 @@
+"""
+Chunked readers of large source files
+"""
+import os
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+
+def iter_chunks(file_path, encoding='utf-8', chunk_size=10000):
+    """
+    Read a table file as a stream of DataFrames of at most chunk_size rows
+
+    CSV, TSV (.tsv or .txt), JSON Lines (.jsonl) and Parquet are streamed, so memory is bounded by the
+    chunk size. JSON arrays (.json) and Excel files (.xlsx) cannot be streamed and are read whole first.
+
+    Args:
+        file_path (str): The path of the file
+        encoding (str, optional): The encoding of text files. Defaults to 'utf-8'.
+        chunk_size (int, optional): The largest number of rows per chunk. Defaults to 10000.
+
+    Yields:
+        pd.DataFrame: The next chunk of rows, indexed by row number in the file
+    """
+    start = 0
+    for chunk in _read_chunks(file_path, encoding, chunk_size):
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        start += len(chunk)
+        yield chunk
+
+
+def _read_chunks(file_path, encoding, chunk_size):
+    file_extension = os.path.splitext(file_path)[1].lower()
+    if file_extension == '.csv':
+        with pd.read_csv(file_path, encoding=encoding, chunksize=chunk_size) as reader:
+            yield from reader
+    elif file_extension in ('.txt', '.tsv'):
+        with pd.read_csv(file_path, delimiter='\t', encoding=encoding, chunksize=chunk_size) as reader:
+            yield from reader
+    elif file_extension == '.jsonl':
+        with pd.read_json(file_path, lines=True, encoding=encoding, chunksize=chunk_size) as reader:
+            yield from reader
+    elif file_extension == '.parquet':
+        import pyarrow.parquet as pq
+        with pq.ParquetFile(file_path) as parquet_file:
+            for batch in parquet_file.iter_batches(batch_size=chunk_size):
+                yield batch.to_pandas()
+    elif file_extension == '.json':
+        yield from _split(pd.read_json(file_path, encoding=encoding), chunk_size)
+    elif file_extension == '.xlsx':
+        yield from _split(pd.read_excel(file_path), chunk_size)
+    else:
+        raise ValueError(f"Unsupported file format: {file_extension}")
+
+
+def _split(df, chunk_size):
+    for start in range(0, len(df), chunk_size):
+        yield df.iloc[start:start + chunk_size]
+
+
+def sample_chunks(chunks, sample_size=-1, mode='tail', seed=None):
+    """
+    Sample rows from a stream of DataFrames while it is read
+
+    Memory stays bounded by the sample size plus one chunk. "head" keeps the first rows and stops
+    reading early, "tail" keeps the last rows and "reservoir" keeps a uniform random sample.
+
+    Args:
+        chunks (iterable): The DataFrames, e.g. from iter_chunks
+        sample_size (int, optional): The number of rows to keep, a negative value keeps every row. Defaults to -1.
+        mode (str, optional): "head", "tail" or "reservoir". Defaults to 'tail'.
+        seed (int, optional): The seed of the reservoir sampling. Defaults to None.
+
+    Yields:
+        pd.DataFrame: The sampled rows, chunk by chunk for "head" and all at once for "tail" and "reservoir"
+    """
+    if sample_size < 0:
+        yield from chunks
+        return
+    if mode == 'head':
+        remaining = sample_size
+        for chunk in chunks if remaining > 0 else ():
+            yield chunk.iloc[:remaining]
+            remaining -= len(chunk)
+            if remaining <= 0:
+                break
+    elif mode == 'tail':
+        kept = deque()
+        rows = 0
+        for chunk in chunks:
+            kept.append(chunk)
+            rows += len(chunk)
+            while kept and rows - len(kept[0]) >= sample_size:
+                rows -= len(kept.popleft())
+        if kept and sample_size > 0:
+            yield pd.concat(kept).tail(sample_size)
+    elif mode == 'reservoir':
+        sample = _reservoir(chunks, sample_size, np.random.default_rng(seed))
+        if sample is not None and len(sample):
+            yield sample.sort_index()
+    else:
+        raise ValueError(f"Unsupported sample mode: {mode}")
+
+
+def _reservoir(chunks, sample_size, rng):
+    # Algorithm R applied a chunk at a time: row t of the stream replaces a random slot j <= t if j < sample_size
+    sample = None
+    seen = 0
+    for chunk in chunks:
+        if sample is None:
+            sample = chunk.iloc[:0]
+        fill = min(max(sample_size - len(sample), 0), len(chunk))
+        if fill:
+            sample = pd.concat([sample, chunk.iloc[:fill]])
+        rest = chunk.iloc[fill:]
+        positions = seen + fill + np.arange(len(rest))
+        seen += len(chunk)
+        if not len(rest):
+            continue
+        slots = rng.integers(0, positions + 1)
+        accepted = np.flatnonzero(slots < sample_size)
+        if not len(accepted):
+            continue
+        # A later row replacing the same slot wins, as it would row by row
+        slots = slots[accepted]
+        last = len(slots) - 1 - np.unique(slots[::-1], return_index=True)[1]
+        keep = np.ones(len(sample), dtype=bool)
+        keep[slots[last]] = False
+        sample = pd.concat([sample[keep], rest.iloc[accepted[last]]])
+    return sample
@@ -0,0 +1,117 @@
+"""
+Slim evaluation records projected from observations
+"""
+import json
+import os
+
+
+class EvalRecord:
+    """
+    The fields of an LLM observation that evaluation needs.
+
+    Observations carry full prompts, metadata and usage. Projecting them right after they are
+    fetched keeps memory proportional to the evaluated text instead of the trace size.
+    """
+    __slots__ = ('question', 'contexts', 'answer', 'trace_id', 'observation_id', 'raw_offset')
+
+    def __init__(self, question, contexts, answer, trace_id, observation_id, raw_offset=None):
+        """
+        Initialize EvalRecord
+
+        Args:
+            question (str): The last user message of the prompt
+            contexts (tuple): The system messages of the prompt
+            answer (str): The output text, None if the observation has none
+            trace_id (str): The ID of the trace
+            observation_id (str): The ID of the observation
+            raw_offset (int, optional): The offset of the raw observation in an ObservationSpill. Defaults to None.
+        """
+        self.question = question
+        self.contexts = contexts
+        self.answer = answer
+        self.trace_id = trace_id
+        self.observation_id = observation_id
+        self.raw_offset = raw_offset
+
+    @classmethod
+    def from_observation(cls, observation, spill=None):
+        """
+        Project an observation, optionally spilling its raw JSON to disk first
+
+        Args:
+            observation (dict): The observation as returned by the public API
+            spill (ObservationSpill, optional): The file keeping the raw observation. Defaults to None.
+
+        Returns:
+            EvalRecord: The projected record
+        """
+        question = ""
+        contexts = []
+        messages = observation.get("input")
+        for message in messages if isinstance(messages, list) else ():
+            if message["role"] == "user":
+                question = message["content"]
+            elif message["role"] == "system":
+                contexts.append(message["content"])
+        output = observation.get("output")
+        answer = output.get("text") if isinstance(output, dict) else None
+        return cls(question, tuple(contexts), answer, observation["traceId"], observation["id"],
+                   spill.write(observation) if spill else None)
+
+    def __repr__(self):
+        return f"EvalRecord(observation_id={self.observation_id!r}, trace_id={self.trace_id!r})"
+
+
+class ObservationSpill:
+    """
+    An append-only JSON Lines file of raw observations, read back by byte offset
+    """
+    def __init__(self, path):
+        """
+        Initialize ObservationSpill
+
+        Args:
+            path (str): The path of the spill file
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._file = open(path, 'ab')
+
+    def write(self, observation):
+        """
+        Append a raw observation
+
+        Args:
+            observation (dict): The observation
+
+        Returns:
+            int: The byte offset of the observation in the file
+        """
+        offset = self._file.tell()
+        self._file.write(json.dumps(observation, ensure_ascii=False).encode('utf-8') + b'\n')
+        return offset
+
+    def read(self, record):
+        """
+        Read the raw observation of a record
+
+        Args:
+            record (EvalRecord): A record projected with this spill
+
+        Returns:
+            dict: The observation, or None if it was not spilled
+        """
+        if record.raw_offset is None:
+            return None
+        self._file.flush()
+        with open(self.path, 'rb') as file:
+            file.seek(record.raw_offset)
+            return json.loads(file.readline())
+
+    def close(self):
+        """
+        Close the spill file
+        """
+        self._file.close()
@@ -5,18 +5,223 @@ LastEditors: Pengzirong
 LastEditTime: 2024-09-05 15:16:40
 Description: file content
 '''
+import re
+from abc import ABC, abstractmethod
+
+_MISSING = object()
+
+
+class Predicate(ABC):
+    """
+    A declarative predicate over one field of an observation, e.g. "name" or "metadata.node_name"
+    """
+    def __init__(self, field):
+        """
+        Initialize Predicate with a dotted field path
+
+        Args:
+            field (str): The dotted path of the field
+        """
+        self.field = field
+        self.path = tuple(field.split('.'))
+
+    def get(self, item):
+        """
+        Get the field value from an observation
+
+        Args:
+            item (dict): The observation
+
+        Returns:
+            The value, or a sentinel if any part of the path is missing
+        """
+        value = item
+        for key in self.path:
+            if not isinstance(value, dict):
+                return _MISSING
+            value = value.get(key, _MISSING)
+        return value
+
+    @abstractmethod
+    def test(self, value):
+        """
+        Test a field value
+
+        Args:
+            value: The field value
+
+        Returns:
+            bool: Whether the value satisfies the predicate
+        """
+
+    def __call__(self, item):
+        return self.test(self.get(item))
+
+
+class Eq(Predicate):
+    """
+    Field equals a value
+    """
+    def __init__(self, field, value):
+        super().__init__(field)
+        self.value = value
+
+    def test(self, value):
+        return value == self.value
+
+    def __repr__(self):
+        return f"Eq({self.field!r}, {self.value!r})"
+
+
+class In(Predicate):
+    """
+    Field is one of several values
+    """
+    def __init__(self, field, values):
+        super().__init__(field)
+        self.values = frozenset(values)
+
+    def test(self, value):
+        return value is not _MISSING and value in self.values
+
+    def __repr__(self):
+        return f"In({self.field!r}, {sorted(self.values)!r})"
+
+
+class Regex(Predicate):
+    """
+    Field is a string matching a regular expression
+    """
+    def __init__(self, field, pattern):
+        super().__init__(field)
+        self.pattern = re.compile(pattern)
+
+    def test(self, value):
+        return isinstance(value, str) and self.pattern.search(value) is not None
+
+    def __repr__(self):
+        return f"Regex({self.field!r}, {self.pattern.pattern!r})"
+
+
+def _safe(rule):
+    """
+    Wrap an opaque rule so that observations lacking a field fail it instead of raising
+    """
+    def test(item):
+        try:
+            return bool(rule(item))
+        except (KeyError, TypeError, IndexError):
+            return False
+    return test
+
+
+class RuleSet(list):
+    """
+    A list of rules that compiles into a single matcher.
+
+    Items are Predicate objects or plain callables such as lambdas; both are callable on an
+    observation, so a RuleSet still works wherever a list of rules is expected.
+    """
+    KEY_FIELDS = ('name', 'type')
+    # Fields the observations API can filter on with an exact match
+    QUERY_FIELDS = ('name', 'type', 'traceId', 'userId', 'parentObservationId', 'version')
+
+    def compile(self):
+        """
+        Compile the rules into a key matcher over (name, type) and a matcher for the rest
+
+        Returns:
+            tuple: (match_key, match_rest), both taking an observation and returning a bool
+        """
+        rules = tuple(self)
+        if getattr(self, '_compiled', None) is not None and self._compiled[0] == rules:
+            return self._compiled[1]
+        key_tests = tuple(rule for rule in self if isinstance(rule, Predicate) and rule.field in self.KEY_FIELDS)
+        rest_tests = tuple(
+            rule if isinstance(rule, Predicate) else _safe(rule)
+            for rule in self
+            if not (isinstance(rule, Predicate) and rule.field in self.KEY_FIELDS)
+        )
+
+        def match_key(item):
+            return all(test(item) for test in key_tests)
+
+        def match_rest(item):
+            return all(test(item) for test in rest_tests)
+
+        self._compiled = (rules, (match_key, match_rest))
+        return match_key, match_rest
+
+    def select_indices(self, data):
+        """
+        Select the indices of matching observations in a single pass.
+
+        Observations are bucketed by (name, type), so the name and type predicates are
+        evaluated once per bucket rather than once per observation.
+
+        Args:
+            data (list): The observations
+
+        Returns:
+            list: The indices of the matching observations
+        """
+        match_key, match_rest = self.compile()
+        buckets = {}
+        indices = []
+        for index, item in enumerate(data):
+            key = (item.get('name'), item.get('type'))
+            key_matched = buckets.get(key)
+            if key_matched is None:
+                key_matched = buckets[key] = match_key(item)
+            if key_matched and match_rest(item):
+                indices.append(index)
+        return indices
+
+    def split(self):
+        """
+        Split the rules into observation query parameters and the rules left to apply locally
+
+        Returns:
+            tuple: (query, residual), a dict of query parameters the server can evaluate and a RuleSet of the others
+        """
+        query = {}
+        residual = RuleSet()
+        for rule in self:
+            if isinstance(rule, Eq) and rule.field in self.QUERY_FIELDS and rule.field not in query:
+                query[rule.field] = rule.value
+            else:
+                residual.append(rule)
+        return query, residual
+
+    def __call__(self, item):
+        match_key, match_rest = self.compile()
+        return match_key(item) and match_rest(item)
+
+
+def compile_rules(rules):
+    """
+    Turn a list of rules into a RuleSet
+
+    Args:
+        rules (list): Predicate objects or plain callables
+
+    Returns:
+        RuleSet: The rule set
+    """
+    return rules if isinstance(rules, RuleSet) else RuleSet(rules)
+
 
 class Rules:
     def __init__(self):
-        self.knowledge_retrieval_rules = [
-            lambda item: item['name'] == 'knowledge-retrieval',
-            lambda item: item['type'] == 'SPAN',
-            lambda item: item['metadata']['node_name'] == '知识检索',
-            lambda item: item['metadata']['node_type'] == 'knowledge-retrieval',
-        ]
-        self.llm_rules = [
-            lambda item: item['name'] == 'llm',
-            lambda item: item['type'] == 'SPAN',
-            lambda item: item['metadata']['node_name'] == 'LLM',
-            lambda item: item['metadata']['node_type'] == 'llm',
-        ]
+        self.knowledge_retrieval_rules = RuleSet([
+            Eq('name', 'knowledge-retrieval'),
+            Eq('type', 'SPAN'),
+            Eq('metadata.node_name', '知识检索'),
+            Eq('metadata.node_type', 'knowledge-retrieval'),
+        ])
+        self.llm_rules = RuleSet([
+            Eq('name', 'llm'),
+            Eq('type', 'SPAN'),
+            Eq('metadata.node_name', 'LLM'),
+            Eq('metadata.node_type', 'llm'),
+        ])
@@ -7,20 +7,29 @@ Description: file content
 '''
 
 import pandas as pd
+import pyarrow as pa
 import os
 from langfuse import Langfuse
-from async_langfuse import FetchLangfuse
+from async_langfuse import FetchLangfuse, ScoreBatchWriter, TracePoller, is_finite_score
 import asyncio
-from datetime import datetime
+from datetime import datetime, timezone
 import yaml
 import aiohttp
 import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-from utils import send_chat_message, process_llm_batch
+from utils import send_chat_message, process_llm_batch, evaluate_shard, metric_attribute_names
 from rules import Rules
+from scheduler import StageScheduler, micro_batches, worker_pool
+from cache import SQLiteCache
+from journal import RunJournal
+from snapshot import DatasetSnapshot
+from instrumentation import metrics
+from columnar import drop_null_rows, to_dataset
+from records import EvalRecord, ObservationSpill
 
-from datasets import Dataset 
-from ragas import evaluate
+from ragas import evaluate, RunConfig
 from ragas.metrics import (
     answer_correctness,
     answer_relevancy,
@@ -32,21 +41,50 @@ from ragas.metrics import (
 
 ############################################
 # step 0: load config and init langfuse
-config_file_path = 'config.yaml'
-with open(config_file_path, 'r') as file:
-    config = yaml.load(file, Loader=yaml.FullLoader)
+# 放在函数里而不是模块顶层：spawn 出来的评估进程会重新导入本文件，不能再建一遍客户端
+config = None
+langfuse = None
+scheduler = None
+fetch_langfuse = None
+trace_poller = None
+score_writer = None
 
-for key in config:
-    os.environ[key] = config[key]
-    print(f'{key}={config[key]}')
+def setup():
+    global config, langfuse, scheduler, fetch_langfuse, trace_poller, score_writer
+    config_file_path = os.getenv('AUTOEVAL_CONFIG', 'config.yaml')
+    with open(config_file_path, 'r') as file:
+        config = yaml.load(file, Loader=yaml.FullLoader)
 
-langfuse = Langfuse()
+    for key in config:
+        os.environ[key] = config[key]
+        print(f'{key}={config[key]}')
 
-fetch_langfuse = FetchLangfuse(
-        secret_key=os.getenv('LANGFUSE_SECRET_KEY'),
-        public_key=os.getenv('LANGFUSE_PUBLIC_KEY'),
-        host=os.getenv('LANGFUSE_HOST')
-    )
+    langfuse = Langfuse()
+
+    scheduler = StageScheduler.from_env()
+
+    fetch_langfuse = FetchLangfuse(
+            secret_key=os.getenv('LANGFUSE_SECRET_KEY'),
+            public_key=os.getenv('LANGFUSE_PUBLIC_KEY'),
+            host=os.getenv('LANGFUSE_HOST'),
+            scheduler=scheduler,
+            cache=SQLiteCache.from_env(),
+            offline=os.getenv('LANGFUSE_OFFLINE', 'false').lower() == 'true'
+        )
+
+    trace_poller = TracePoller(
+            fetch_langfuse,
+            rules=Rules().llm_rules,
+            expected_count=int(os.getenv("EXPECTED_NODE_COUNT", 1)),
+            interval=float(os.getenv("TRACE_POLL_INTERVAL", 2)),
+            timeout=float(os.getenv("TRACE_READY_TIMEOUT", 300))
+        )
+
+    score_writer = ScoreBatchWriter(
+            fetch_langfuse,
+            max_batch_size=int(os.getenv("SCORE_BATCH_SIZE", 100)),
+            flush_interval=float(os.getenv("SCORE_FLUSH_INTERVAL", 1))
+        )
 
 ############################################
 # step 1: upload dataset to langfuse
@@ -120,20 +158,23 @@ async def process_dataset(
     run_name, 
     ragas_metrics, 
     ragas_llm, 
-    ragas_embeddings):
-    tasks = []
-    results = []
-    for item in dataset.items:
-        task = asyncio.create_task(
-            process_item(
-            item,
-            run_name,
-            ragas_metrics, 
-            ragas_llm, 
-            ragas_embeddings))
-        tasks.append(task)
-
-    results = await asyncio.gather(*tasks)
+    ragas_embeddings,
+    journal=None):
+    # 固定数量的 worker 按需从 item 流里取，不为每个 item 预先建任务
+    monitor = asyncio.create_task(metrics.report(extra=scheduler.summary))
+    try:
+        results = await worker_pool(
+            lambda item: process_item(
+                item,
+                run_name,
+                ragas_metrics, 
+                ragas_llm, 
+                ragas_embeddings,
+                journal=journal),
+            dataset.items,
+            int(os.getenv("ITEM_CONCURRENCY", 64)))
+    finally:
+        monitor.cancel()
     
     # 将所有 observations 和 expected_outputs 合并到两个列表中
     all_observations = []
@@ -145,13 +186,97 @@ async def process_dataset(
     return all_observations, all_expected_outputs
 
 
+async def process_dataset_streaming(
+    dataset,
+    run_name, 
+    ragas_metrics, 
+    ragas_llm, 
+    ragas_embeddings,
+    journal=None,
+    batch_size=32,
+    batch_interval=10):
+    # 每个 item 解析完成后立即进入队列，按大小或时间组成 micro-batch 送去评估和上传分数
+    queue = asyncio.Queue()
+
+    async def produce(item):
+        observations, expected_outputs = await process_item(
+            item, run_name, ragas_metrics, ragas_llm, ragas_embeddings, journal=journal)
+        for pair in zip(observations, expected_outputs):
+            await queue.put(pair)
+
+    async def produce_all():
+        await worker_pool(produce, dataset.items, int(os.getenv("ITEM_CONCURRENCY", 64)))
+        await queue.put(None)
+
+    async def consume():
+        uploads = []
+        try:
+            async for batch in micro_batches(queue, max_size=batch_size, max_wait=batch_interval):
+                observations = [observation for observation, _ in batch]
+                # 逐批评估：每批已经用满 CRITIC_CONCURRENCY 个 critic 并发，上传与下一批的评估重叠
+                scored = await score_eval(
+                    observations,
+                    [expected_output for _, expected_output in batch],
+                    ragas_metrics, ragas_llm, ragas_embeddings, journal=journal)
+                uploads.append(asyncio.create_task(upload_scores(observations, scored, journal=journal)))
+            await asyncio.gather(*uploads)
+        finally:
+            for upload in uploads:
+                upload.cancel()
+            await asyncio.gather(*uploads, return_exceptions=True)
+
+    monitor = asyncio.create_task(metrics.report(extra=scheduler.summary))
+    try:
+        # 任一任务失败时 TaskGroup 会取消其余的生产、评估和上传任务
+        async with asyncio.TaskGroup() as task_group:
+            task_group.create_task(produce_all())
+            task_group.create_task(consume())
+    finally:
+        monitor.cancel()
+
+
+
+eval_pool = None
+observation_spill = None
+
+def get_eval_pool(shards):
+    # spawn 而不是 fork：父进程里有事件循环和 Langfuse 的后台线程
+    global eval_pool
+    if eval_pool is None:
+        eval_pool = ProcessPoolExecutor(max_workers=shards, mp_context=multiprocessing.get_context('spawn'))
+    return eval_pool
 
-def ragas_evaluation(observations, expected_output, metrics, llm, embeddings):
+
+def ragas_evaluation(observations, expected_output, ragas_metrics, llm, embeddings, max_workers=16, shards=1):
     batch = process_llm_batch(observations)
-    batch['ground_truth'] = expected_output
-    batch_keys = batch.keys()
-    batch = Dataset.from_dict(batch)
-    scores = evaluate(batch, metrics=metrics, llm=llm, embeddings=embeddings)
+    batch = batch.append_column('ground_truth', pa.array(expected_output, type=pa.string()))
+    # 没有 output.text 的 observation 无法评估，跳过而不是让整批失败
+    batch, skipped = drop_null_rows(batch, 'answer')
+    if skipped:
+        metrics.log(f"Skipping {len(skipped)} observations without an answer: {skipped[:5]}")
+    batch_keys = batch.column_names
+    size = batch.num_rows
+    if size == 0:
+        return pd.DataFrame(columns=['trace_id', 'observation_id']), []
+    if shards > 1 and size > 1:
+        # 按顺序切成连续的 shard，拼接后的分数与 trace/observation 的原始顺序一致
+        shard_size = -(-size // shards)
+        pool = get_eval_pool(shards)
+        # take 拷贝出紧凑的 shard：slice 在 pickle 时会带上整张表的 buffer
+        futures = [
+            pool.submit(
+                evaluate_shard,
+                batch.take(pa.array(range(start, min(start + shard_size, size)))),
+                metric_attribute_names(ragas_metrics),
+                max_workers)
+            for start in range(0, size, shard_size)
+        ]
+        scores = pd.concat([future.result() for future in futures], ignore_index=True)
+        score_keys = [key for key in scores.columns if key not in batch_keys]
+        return scores, score_keys
+    batch = to_dataset(batch)
+    scores = evaluate(batch, metrics=ragas_metrics, llm=llm, embeddings=embeddings,
+                      run_config=RunConfig(max_workers=max_workers))
     scores['trace_id'] = batch['trace_id']
     scores['observation_id'] = batch['observation_id']
     score_keys = [key for key in scores.keys() if key not in batch_keys]
@@ -161,18 +286,37 @@ def ragas_evaluation(observations, expected_output, metrics, llm, embeddings):
 async def run_dify_app(query):
     while True:
         try:
-            response = await send_chat_message(
-                url=os.getenv("DIFY_API_BASE"), 
-                api_key=os.getenv("DIFY_API_KEY"), 
-                query=query,
-                user="autoeval_dev")
+            async with scheduler.stage("dify"):
+                # 拿到 dify 并发名额之后才计时，排队时间不算进 trace 的开始时间
+                start_time = datetime.now(timezone.utc)
+                with metrics.timer("dify"):
+                    response = await send_chat_message(
+                        url=os.getenv("DIFY_API_BASE"), 
+                        api_key=os.getenv("DIFY_API_KEY"), 
+                        query=query,
+                        response_mode=os.getenv("DIFY_RESPONSE_MODE", "blocking"),
+                        user="autoeval_dev")
             session_id = response['conversation_id']
             trace_id = response['message_id']
             # print(f"trace_id: {trace_id}")
-            return session_id, trace_id
+            latency = response.get('latency')
+            if latency:
+                itl = latency['itl']
+                if latency['ttft'] is not None:
+                    metrics.observe("dify_ttft", latency['ttft'])
+                for seconds in itl:
+                    metrics.observe("dify_itl", seconds)
+                latency = {
+                    "ttft": latency['ttft'],
+                    "itl_mean": sum(itl) / len(itl) if itl else None,
+                    "itl_max": max(itl) if itl else None,
+                    "total": latency['total'],
+                }
+            return session_id, trace_id, start_time, latency
         except Exception as e:
-            print(f"An error occurred: {str(e)}")
-            print("Retrying after 10 seconds...")
+            metrics.retry("dify")
+            metrics.log(f"An error occurred: {str(e)}")
+            metrics.log("Retrying after 10 seconds...")
             await asyncio.sleep(10)
 
 async def process_item(
@@ -180,36 +324,59 @@ async def process_item(
     run_name,
     ragas_metrics, 
     ragas_llm, 
-    ragas_embeddings
+    ragas_embeddings,
+    journal=None
     ):
     query = item.input['ask']+'\n'+item.input['title'] if item.input['ask'] != '无' else item.input['title']
     expected_output = item.expected_output
     
-    session_id, trace_id = await run_dify_app(query)
-    print(f"trace_id: {trace_id}")
-    rules = Rules().llm_rules
-    
-    await asyncio.sleep(10)
+    answered = journal.get(item.id, 'answered') if journal else None
+    if answered:
+        session_id, trace_id = answered['session_id'], answered['trace_id']
+        start_time = datetime.fromisoformat(answered['start_time'])
+    else:
+        session_id, trace_id, start_time, latency = await run_dify_app(query)
+        if journal:
+            journal.record(item.id, 'answered', session_id=session_id, trace_id=trace_id, start_time=start_time.isoformat(), latency=latency)
     
-    while True:
-        try:
-            observations = await fetch_langfuse.get_trace_selected_observations(trace_id, rules)
-            break
-        except Exception as e:
-            print(f"An error occurred: {str(e)}")
-            print("Retrying after 10 seconds...")
-            await asyncio.sleep(10)
+    resolved = journal.get(item.id, 'resolved') if journal else None
+    # 离线模式下缓存里没有的 observation 会抛 LookupError，和超时一样跳过这个 item
+    try:
+        if resolved:
+            observations = await asyncio.gather(*[
+                fetch_langfuse.fetch_observation(observation_id) for observation_id in resolved['observation_ids']])
+        else:
+            with metrics.timer("trace_ingestion"):
+                observations = await trace_poller.wait(trace_id, start_time)
+    except (asyncio.TimeoutError, LookupError) as e:
+        metrics.log(f"Skipping item: {str(e)}")
+        return [], []
+    # 只保留评估需要的字段，完整的 observation 可选地写到磁盘
+    # 续跑时 observation 已经写过，沿用 journal 里的 offset 而不是重复追加
+    spill = None if resolved else observation_spill
+    observations = [EvalRecord.from_observation(observation, spill) for observation in observations]
+    if resolved:
+        for observation, raw_offset in zip(observations, resolved.get('raw_offsets') or ()):
+            observation.raw_offset = raw_offset
+    elif journal:
+        journal.record(item.id, 'resolved',
+                       observation_ids=[observation.observation_id for observation in observations],
+                       raw_offsets=[observation.raw_offset for observation in observations])
     
-    for observation in observations:
-        trace_id = observation['traceId']
-        observation_id = observation['id']
-        
-        item.link(
-            trace_or_observation=None,
-            run_name=run_name,
-            trace_id=trace_id,
-            observation_id=observation_id
-        )
+    if not (journal and journal.done(item.id, 'linked')):
+        for observation in observations:
+            trace_id = observation.trace_id
+            observation_id = observation.observation_id
+            
+            with metrics.timer("link"):
+                item.link(
+                    trace_or_observation=None,
+                    run_name=run_name,
+                    trace_id=trace_id,
+                    observation_id=observation_id
+                )
+        if journal:
+            journal.record(item.id, 'linked')
     return observations, [expected_output] * len(observations)
 
 async def process_eval(
@@ -217,31 +384,90 @@ async def process_eval(
     expected_outputs, 
     ragas_metrics, 
     ragas_llm, 
-    ragas_embeddings):
-    scores, score_keys = ragas_evaluation(
-        observations, expected_outputs, ragas_metrics, ragas_llm, ragas_embeddings
-    )
-    # print(scores)
-    # print(score_keys)
-    # print(f"Scores type: {type(scores)}")
-    for _, row in scores.iterrows():
-        trace_id = row['trace_id']
-        observation_id = row['observation_id']
-        for evaluation_key in score_keys:
-            score = row[evaluation_key]
-            await fetch_langfuse.pull_score_to_langfuse(
+    ragas_embeddings,
+    journal=None):
+    scored = await score_eval(
+        observations, expected_outputs, ragas_metrics, ragas_llm, ragas_embeddings, journal=journal)
+    await upload_scores(observations, scored, journal=journal)
+
+
+async def score_eval(
+    observations, 
+    expected_outputs, 
+    ragas_metrics, 
+    ragas_llm, 
+    ragas_embeddings,
+    journal=None):
+    pending = [
+        (observation, expected_output)
+        for observation, expected_output in zip(observations, expected_outputs)
+        if not (journal and journal.done(observation.observation_id, 'scored'))
+    ]
+    scored = {}
+    if pending:
+        # EVAL_SHARD_WORKERS 只是每个 shard 进程内的并发，不分片时用 critic 的并发上限
+        shards = int(os.getenv("EVAL_SHARDS", 1))
+        shard_workers = int(os.getenv("EVAL_SHARD_WORKERS") or scheduler.limits["critic"])
+        async with scheduler.stage("critic"):
+            with metrics.timer("ragas_evaluate"):
+                scores, score_keys = await asyncio.to_thread(
+                    ragas_evaluation,
+                    [observation for observation, _ in pending],
+                    [expected_output for _, expected_output in pending],
+                    ragas_metrics, ragas_llm, ragas_embeddings,
+                    max_workers=shard_workers if shards > 1 else scheduler.limits["critic"],
+                    shards=shards
+                )
+        # print(scores)
+        # print(score_keys)
+        # print(f"Scores type: {type(scores)}")
+        for _, row in scores.iterrows():
+            # ragas 算不出的指标是 NaN，不记录也不上传
+            scored[row['observation_id']] = {
+                "trace_id": row['trace_id'],
+                "scores": {key: float(row[key]) for key in score_keys if is_finite_score(row[key])},
+            }
+            if journal:
+                journal.record(row['observation_id'], 'scored', **scored[row['observation_id']])
+    return scored
+
+
+async def upload_scores(observations, scored, journal=None):
+    uploads = {}
+    for observation in observations:
+        observation_id = observation.observation_id
+        if journal and journal.done(observation_id, 'uploaded'):
+            continue
+        result = scored.get(observation_id) or (journal.get(observation_id, 'scored') if journal else None)
+        if result is None:
+            continue
+        uploads[observation_id] = [
+            score_writer.add(
                 score=score,
-                trace_id=trace_id,
+                trace_id=result['trace_id'],
                 observation_id=observation_id,
                 name=evaluation_key
             )
+            for evaluation_key, score in result['scores'].items()
+        ]
+    for observation_id, futures in uploads.items():
+        errors = [result for result in await asyncio.gather(*futures, return_exceptions=True) if isinstance(result, Exception)]
+        if errors:
+            metrics.error("score_upload")
+            metrics.log(f"Uploading scores of {observation_id} failed: {errors[0]}")
+        elif journal:
+            journal.record(observation_id, 'uploaded')
 
         
 async def main():
+    global observation_spill
+    setup()
     from utils import get_ragas_llm_and_embeddings
     llm, embeddings = get_ragas_llm_and_embeddings()
     
-    dataset = langfuse.get_dataset("OAGD_妇产科")
+    dataset = DatasetSnapshot(
+        "OAGD_妇产科", fetch_langfuse, langfuse,
+        directory=os.getenv("DATASET_SNAPSHOT_DIR", ".cache/datasets"))
     run_name = "glm4-chat CritcLLM glm4-chat"
     # run_name = "glm4-chat test"
     ragas_metrics = [
@@ -252,10 +478,45 @@ async def main():
         context_utilization,
         faithfulness,
     ]
-    observations, expected_outputs = await process_dataset(
-        dataset, run_name, 
-        ragas_metrics, ragas_llm=llm, ragas_embeddings=embeddings)
-    await process_eval(observations, expected_outputs, ragas_metrics, llm, embeddings)
+    journal = RunJournal(run_name, directory=os.getenv("RUN_JOURNAL_DIR", "runs"))
+    if os.getenv("OBSERVATION_SPILL", "false").lower() == "true":
+        observation_spill = ObservationSpill(os.path.splitext(journal.path)[0] + ".observations.jsonl")
+    try:
+        async with fetch_langfuse, trace_poller, score_writer:
+            refresh = os.getenv("DATASET_REFRESH", "delta")
+            # 没有快照时 off 也要先拉一次全量，否则 items 为空，整个 run 什么都不做
+            if refresh == "off" and dataset.info() is None:
+                refresh = "full"
+            if refresh != "off" and not fetch_langfuse.offline:
+                fetched = await dataset.refresh(full=refresh == "full")
+                print(f"Dataset snapshot: {fetched} items fetched, {dataset.info()}")
+            if os.getenv("EVAL_MODE", "batch") == "streaming":
+                await process_dataset_streaming(
+                    dataset, run_name, 
+                    ragas_metrics, ragas_llm=llm, ragas_embeddings=embeddings,
+                    journal=journal,
+                    batch_size=int(os.getenv("EVAL_BATCH_SIZE", 32)),
+                    batch_interval=float(os.getenv("EVAL_BATCH_INTERVAL", 10)))
+            else:
+                observations, expected_outputs = await process_dataset(
+                    dataset, run_name, 
+                    ragas_metrics, ragas_llm=llm, ragas_embeddings=embeddings,
+                    journal=journal)
+                await process_eval(observations, expected_outputs, ragas_metrics, llm, embeddings, journal=journal)
+    finally:
+        journal.close()
+        if observation_spill is not None:
+            observation_spill.close()
+    metrics_path = os.path.splitext(journal.path)[0]
+    metrics.export_json(f"{metrics_path}.metrics.json")
+    metrics.export_prometheus(f"{metrics_path}.prom")
+    print(metrics.summary())
+    if eval_pool is not None:
+        eval_pool.shutdown()
+    if hasattr(llm, 'stats'):
+        print(f"Critic cache: {llm.stats()}")
+    if hasattr(embeddings, 'stats'):
+        print(f"Embedding cache: {embeddings.stats()}")
     # Flush the langfuse client to ensure all data is sent to the server at the end of the experiment run
     langfuse.flush()
 
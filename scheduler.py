@@ -0,0 +1,153 @@
+"""
+Bounded-concurrency scheduling of pipeline stages
+"""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+
+class StageScheduler:
+    """
+    A scheduler bounding the number of concurrent calls per backend stage
+    """
+    def __init__(self, limits):
+        """
+        Initialize StageScheduler with a concurrency limit per stage
+
+        Args:
+            limits (dict): A mapping from stage name to its concurrency limit
+        """
+        self.limits = dict(limits)
+        self._semaphores = {name: asyncio.Semaphore(limit) for name, limit in self.limits.items()}
+        self.in_flight = {name: 0 for name in self.limits}
+        self.queued = {name: 0 for name in self.limits}
+
+    @classmethod
+    def from_env(cls):
+        """
+        Create a scheduler for the dify, langfuse and critic stages from environment variables
+
+        Returns:
+            StageScheduler: The scheduler
+        """
+        return cls({
+            "dify": int(os.getenv("DIFY_CONCURRENCY", 8)),
+            "langfuse": int(os.getenv("LANGFUSE_CONCURRENCY", 16)),
+            "critic": int(os.getenv("CRITIC_CONCURRENCY", 4)),
+        })
+
+    @asynccontextmanager
+    async def stage(self, name):
+        """
+        Hold one slot of a stage for the duration of the block
+
+        Args:
+            name (str): The name of the stage
+        """
+        semaphore = self._semaphores[name]
+        self.queued[name] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.queued[name] -= 1
+        self.in_flight[name] += 1
+        try:
+            yield
+        finally:
+            self.in_flight[name] -= 1
+            semaphore.release()
+
+    def stats(self):
+        """
+        Get the limit, in-flight and queued counts of every stage
+
+        Returns:
+            dict: A mapping from stage name to its counts
+        """
+        return {
+            name: {
+                "limit": self.limits[name],
+                "in_flight": self.in_flight[name],
+                "queued": self.queued[name],
+            }
+            for name in self.limits
+        }
+
+    def summary(self):
+        """
+        Format the stage counts as a single line
+
+        Returns:
+            str: The summary line
+        """
+        return " | ".join(
+            f"{name} {self.in_flight[name]}/{self.limits[name]} (+{self.queued[name]} queued)"
+            for name in self.limits
+        )
+
+
+async def micro_batches(queue, max_size=32, max_wait=10):
+    """
+    Group the items of a queue into batches closed by size or by time, None in the queue ends the stream
+
+    Args:
+        queue (asyncio.Queue): The queue of items
+        max_size (int, optional): The largest number of items in a batch. Defaults to 32.
+        max_wait (float, optional): Seconds a batch stays open after its first item. Defaults to 10.
+
+    Yields:
+        list: A batch of items
+    """
+    loop = asyncio.get_running_loop()
+    batch = []
+    deadline = None
+    while True:
+        if batch:
+            # asyncio.timeout rather than wait_for, which can swallow a cancellation arriving as the get completes
+            try:
+                async with asyncio.timeout_at(deadline):
+                    item = await queue.get()
+            except TimeoutError:
+                yield batch
+                batch = []
+                continue
+        else:
+            item = await queue.get()
+        if item is None:
+            break
+        if not batch:
+            deadline = loop.time() + max_wait
+        batch.append(item)
+        if len(batch) >= max_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def worker_pool(func, items, workers):
+    """
+    Apply a coroutine function to items with a fixed number of workers pulling from the item iterator
+
+    Items are drawn only when a worker is free, so a lazy iterable is never materialized and at
+    most workers calls are in flight. The first failure cancels the other workers.
+
+    Args:
+        func (callable): The coroutine function to apply
+        items (iterable): The items, e.g. a lazy stream of dataset items
+        workers (int): The number of workers
+
+    Returns:
+        list: The result of every call, in item order
+    """
+    iterator = enumerate(items)
+    results = {}
+
+    async def work():
+        for index, item in iterator:
+            results[index] = await func(item)
+
+    async with asyncio.TaskGroup() as task_group:
+        for _ in range(workers):
+            task_group.create_task(work())
+    return [results[index] for index in range(len(results))]
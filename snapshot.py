@@ -0,0 +1,207 @@
+"""
+Local Parquet snapshot of Langfuse datasets
+"""
+import json
+import os
+import re
+from contextlib import aclosing
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from langfuse_common import parse_timestamp
+
+SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("status", pa.string()),
+    ("created_at", pa.string()),
+    ("updated_at", pa.string()),
+    ("item", pa.string()),
+])
+
+
+class SnapshotItem:
+    """
+    A dataset item read from a snapshot, its JSON is only parsed when a field is used
+    """
+    def __init__(self, id, item, langfuse=None):
+        """
+        Initialize SnapshotItem
+
+        Args:
+            id (str): The ID of the item
+            item (str): The JSON of the item as returned by the public API
+            langfuse (Langfuse, optional): The client used to link the item to traces. Defaults to None.
+        """
+        self.id = id
+        self._item = item
+        self._data = None
+        self.langfuse = langfuse
+
+    @property
+    def data(self):
+        """
+        dict: The item as returned by the public API
+        """
+        if self._data is None:
+            self._data = json.loads(self._item)
+        return self._data
+
+    @property
+    def input(self):
+        return self.data.get('input')
+
+    @property
+    def expected_output(self):
+        return self.data.get('expectedOutput')
+
+    @property
+    def metadata(self):
+        return self.data.get('metadata')
+
+    @property
+    def status(self):
+        return self.data.get('status')
+
+    def link(self, trace_or_observation, run_name, **kwargs):
+        """
+        Link the item to a trace or observation in a dataset run through the Langfuse SDK
+
+        Args:
+            trace_or_observation: Passed to DatasetItemClient.link, None when trace_id is given
+            run_name (str): The name of the dataset run
+            **kwargs: trace_id, observation_id, run_metadata or run_description
+        """
+        from langfuse.client import DatasetItemClient
+        from langfuse.model import DatasetItem
+        DatasetItemClient(DatasetItem.parse_obj(self.data), self.langfuse).link(trace_or_observation, run_name, **kwargs)
+
+
+class DatasetSnapshot:
+    """
+    A local Parquet copy of a Langfuse dataset, refreshed by the items updated since its watermark.
+
+    The public API lists items newest first, so a refresh stops at the first item created before
+    the watermark. Edits to older items and deletions need a full refresh.
+    """
+    def __init__(self, dataset_name, fetch_langfuse, langfuse=None, directory='.cache/datasets'):
+        """
+        Initialize DatasetSnapshot
+
+        Args:
+            dataset_name (str): The name of the dataset
+            fetch_langfuse (FetchLangfuse): The client used to fetch dataset items
+            langfuse (Langfuse, optional): The client used to link items to traces. Defaults to None.
+            directory (str, optional): The directory of the snapshot files. Defaults to '.cache/datasets'.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.dataset_name = dataset_name
+        self.fetch_langfuse = fetch_langfuse
+        self.langfuse = langfuse
+        self.path = os.path.join(directory, re.sub(r'[^\w.-]+', '_', dataset_name) + '.parquet')
+
+    def info(self):
+        """
+        Read the version, watermark and size of the snapshot without reading its rows
+
+        Returns:
+            dict: version, watermark and rows, or None if there is no snapshot
+        """
+        if not os.path.exists(self.path):
+            return None
+        metadata = pq.read_metadata(self.path)
+        schema_metadata = metadata.metadata or {}
+        return {
+            "version": int(schema_metadata.get(b'version', b'0')),
+            "watermark": schema_metadata.get(b'watermark', b'').decode() or None,
+            "rows": metadata.num_rows,
+        }
+
+    async def refresh(self, full=False, page_size=100):
+        """
+        Fetch the items updated since the watermark and merge them into the snapshot
+
+        Args:
+            full (bool, optional): Fetch every item and replace the snapshot. Defaults to False.
+            page_size (int, optional): The number of items per page. Defaults to 100.
+
+        Returns:
+            int: The number of items fetched
+        """
+        current = self.info()
+        info = None if full else current
+        watermark = parse_timestamp(info['watermark']) if info and info['watermark'] else None
+
+        delta = {}
+        async with aclosing(self.fetch_langfuse.iter_pages(
+                self.fetch_langfuse.fetch_dataset_items, page_size=page_size, prefetch=watermark is None,
+                dataset_name=self.dataset_name)) as items:
+            async for item in items:
+                if watermark is None or parse_timestamp(item['updatedAt']) > watermark:
+                    delta.setdefault(item['id'], item)
+                if watermark is not None and parse_timestamp(item['createdAt']) <= watermark:
+                    break
+        if info is not None and not delta:
+            return 0
+
+        table = pa.Table.from_pydict({
+            "id": list(delta),
+            "status": [item.get('status') for item in delta.values()],
+            "created_at": [item['createdAt'] for item in delta.values()],
+            "updated_at": [item['updatedAt'] for item in delta.values()],
+            "item": [json.dumps(item, ensure_ascii=False) for item in delta.values()],
+        }, schema=SCHEMA)
+        if info is not None:
+            existing = pq.read_table(self.path)
+            existing = existing.filter(pc.invert(pc.is_in(existing['id'], value_set=table['id'])))
+            table = pa.concat_tables([table, existing])
+
+        updated_at = [parse_timestamp(timestamp) for timestamp in table['updated_at'].to_pylist()]
+        new_watermark = max(updated_at + ([watermark] if watermark else [])) if updated_at else watermark
+        table = table.replace_schema_metadata({
+            "dataset": self.dataset_name,
+            "version": str((current or {}).get('version', 0) + 1),
+            "watermark": new_watermark.isoformat().replace('+00:00', 'Z') if new_watermark else "",
+        })
+        temporary_path = self.path + '.tmp'
+        pq.write_table(table, temporary_path)
+        os.replace(temporary_path, self.path)
+        return len(delta)
+
+    def __len__(self):
+        info = self.info()
+        return info['rows'] if info else 0
+
+    def iter_items(self, batch_size=1024):
+        """
+        Iterate over the items of the snapshot, reading it batch by batch
+
+        Args:
+            batch_size (int, optional): The number of rows read at a time. Defaults to 1024.
+
+        Yields:
+            SnapshotItem: Each item, newest first
+
+        Raises:
+            FileNotFoundError: If the dataset was never refreshed
+        """
+        self._check_exists()
+        with pq.ParquetFile(self.path) as parquet_file:
+            for batch in parquet_file.iter_batches(batch_size=batch_size, columns=['id', 'item']):
+                for id, item in zip(batch.column('id').to_pylist(), batch.column('item').to_pylist()):
+                    yield SnapshotItem(id, item, self.langfuse)
+
+    def _check_exists(self):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(
+                f"No snapshot of dataset {self.dataset_name!r} at {self.path}, refresh it while online first")
+
+    @property
+    def items(self):
+        """
+        iterator: A lazy stream of the items, like the items of a DatasetClient. Raises FileNotFoundError
+        if the dataset was never refreshed.
+        """
+        self._check_exists()
+        return self.iter_items()
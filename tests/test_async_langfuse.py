@@ -0,0 +1,190 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from async_langfuse import FetchLangfuse, ScoreBatchWriter, TracePoller, is_finite_score
+from instrumentation import metrics
+from rules import Rules
+
+
+class FakeFetchLangfuse:
+    score_payload = FetchLangfuse.score_payload
+
+    def __init__(self):
+        self.batches = []
+
+    async def ingest(self, batch):
+        self.batches.append(batch)
+        return 207, {"successes": [{"id": event["id"], "status": 201} for event in batch], "errors": []}
+
+
+def test_is_finite_score():
+    assert is_finite_score(0.5)
+    assert is_finite_score(1)
+    assert not is_finite_score(float('nan'))
+    assert not is_finite_score(float('inf'))
+    assert not is_finite_score(None)
+    assert not is_finite_score("n/a")
+
+
+def test_nan_score_fails_alone():
+    fetch_langfuse = FakeFetchLangfuse()
+
+    async def main():
+        writer = ScoreBatchWriter(fetch_langfuse, max_batch_size=100, flush_interval=60)
+        async with writer:
+            futures = [
+                writer.add(0.5, "t1", "o1", "faithfulness"),
+                writer.add(float('nan'), "t1", "o1", "answer_relevancy"),
+                writer.add(1.0, "t2", "o2", "faithfulness"),
+            ]
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert results[0] == "t1-o1-faithfulness"
+    assert isinstance(results[1], ValueError)
+    assert results[2] == "t2-o2-faithfulness"
+    sent = [event["body"] for batch in fetch_langfuse.batches for event in batch]
+    assert [body["value"] for body in sent] == [0.5, 1.0]
+
+
+
+def llm_observation(trace_id, observation_id):
+    return {
+        "id": observation_id, "traceId": trace_id, "name": "llm", "type": "SPAN",
+        "metadata": {"node_name": "LLM", "node_type": "llm"}, "endTime": "2024-09-12T08:00:01.000Z",
+    }
+
+
+class WindowFetchLangfuse(FetchLangfuse):
+    def __init__(self, observations=(), error=None):
+        super().__init__('sk', 'pk', 'http://localhost')
+        self.observations = list(observations)
+        self.error = error
+        self.windows = []
+        self.trace_queries = []
+
+    async def fetch_observations_in_window(self, from_time, to_time, page_size=100, **query):
+        self.windows.append((from_time, to_time))
+        if self.error is not None:
+            raise self.error
+        return self.observations
+
+    async def iter_observations(self, page_size=100, **params):
+        self.trace_queries.append(params['traceId'])
+        for observation in self.observations:
+            if observation['traceId'] == params['traceId']:
+                yield observation
+
+
+def test_poller_survives_unexpected_errors(monkeypatch):
+    fetch_langfuse = WindowFetchLangfuse(error=ValueError("bad json"))
+    logged = []
+    monkeypatch.setattr(metrics, "log", logged.append)
+
+    async def main():
+        poller = TracePoller(fetch_langfuse, Rules().llm_rules, interval=0.01, timeout=0.2)
+        async with poller:
+            with pytest.raises(asyncio.TimeoutError):
+                await poller.wait("t1")
+            assert not poller._task.done()
+        return poller
+
+    poller = asyncio.run(main())
+    assert len(fetch_langfuse.windows) > 1
+    assert poller.pending == 0
+    assert logged and "bad json" in logged[0]
+
+
+def test_wait_times_out_without_polling_loop():
+    async def main():
+        poller = TracePoller(WindowFetchLangfuse(), Rules().llm_rules, timeout=0.05)
+        with pytest.raises(asyncio.TimeoutError):
+            await poller.wait("t1")
+        return poller.pending
+
+    assert asyncio.run(main()) == 0
+
+
+def test_old_traces_are_queried_by_trace_id():
+    fetch_langfuse = WindowFetchLangfuse([llm_observation("old", "o1"), llm_observation("new", "o2")])
+
+    async def main():
+        poller = TracePoller(fetch_langfuse, Rules().llm_rules, interval=0.01, slack=0, max_window=60)
+        async with poller:
+            now = datetime.now(timezone.utc)
+            return await asyncio.gather(
+                poller.wait("old", now - timedelta(minutes=10)),
+                poller.wait("new", now),
+            )
+
+    old, new = asyncio.run(main())
+    assert [observation["id"] for observation in old] == ["o1"]
+    assert [observation["id"] for observation in new] == ["o2"]
+    assert fetch_langfuse.trace_queries == ["old"]
+    from_time, _ = fetch_langfuse.windows[0]
+    assert from_time > datetime.now(timezone.utc) - timedelta(minutes=1)
+
+
+def test_session_observations_from_windows():
+    start = datetime(2024, 9, 12, 8, tzinfo=timezone.utc)
+    observations = [
+        dict(llm_observation("t1", "o1"), input=[], output={}),
+        dict(llm_observation("t2", "o2"), input=[], output={}),
+    ]
+    fetch_langfuse = WindowFetchLangfuse(observations)
+    traces = [
+        {"id": "t1", "timestamp": "2024-09-12T08:00:00.000Z"},
+        {"id": "t2", "timestamp": "2024-09-12T12:00:00.000Z"},
+    ]
+    selected = asyncio.run(fetch_langfuse.fetch_traces_selected_observations(traces, Rules().llm_rules, slack=60))
+    assert [observation["id"] for observation in selected] == ["o1", "o2"]
+    assert [to_time - from_time for from_time, to_time in fetch_langfuse.windows] == [timedelta(seconds=120)] * 2
+    assert fetch_langfuse.windows[0][0] == start - timedelta(seconds=60)
+
+
+def test_offline_poller_fails_pending_traces():
+    async def main():
+        fetch_langfuse = WindowFetchLangfuse()
+        fetch_langfuse.offline = True
+        poller = TracePoller(fetch_langfuse, Rules().llm_rules, interval=0.01)
+        async with poller:
+            with pytest.raises(LookupError):
+                await poller.wait("t1")
+        return fetch_langfuse.windows
+
+    assert asyncio.run(main()) == []
+
+
+class FakePages:
+    iter_pages = FetchLangfuse.iter_pages
+
+    def __init__(self):
+        self.requested = []
+
+    async def fetch_page(self, page, limit):
+        self.requested.append(page)
+        return {"data": [f"{page}-{index}" for index in range(limit)], "meta": {"totalPages": 3}}
+
+
+@pytest.mark.parametrize("prefetch, requested", [(True, [1, 2]), (False, [1])])
+def test_iter_pages_prefetch(prefetch, requested):
+    pages = FakePages()
+
+    async def main():
+        items = pages.iter_pages(pages.fetch_page, page_size=2, prefetch=prefetch)
+        first = [await anext(items), await anext(items)]
+        await asyncio.sleep(0)
+        await items.aclose()
+        return first
+
+    assert asyncio.run(main()) == ["1-0", "1-1"]
+    assert pages.requested == requested
+
+    pages = FakePages()
+
+    async def collect():
+        return [item async for item in pages.iter_pages(pages.fetch_page, page_size=1, prefetch=prefetch)]
+
+    assert asyncio.run(collect()) == ["1-0", "2-0", "3-0"]
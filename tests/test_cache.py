@@ -0,0 +1,18 @@
+from cache import SQLiteCache, is_closed_query
+
+
+def test_put_many_skips_unchanged_versions(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "cache.sqlite"))
+    entries = [(f"o{index}", {"id": f"o{index}", "n": index}, "v1") for index in range(1200)]
+    assert cache.put_many("observation", entries) == 1200
+    assert cache.put_many("observation", entries) == 0
+    assert cache.put_many("observation", [("o1", {"id": "o1", "n": -1}, "v2"), ("o2", {"id": "o2"}, "v1")]) == 1
+    assert cache.get("observation", "o1") == {"id": "o1", "n": -1}
+    assert cache.get("observation", "o1199") == {"id": "o1199", "n": 1199}
+    cache.close()
+
+
+def test_is_closed_query():
+    assert is_closed_query({})
+    assert is_closed_query({"toStartTime": "2024-09-12T08:00:00.000Z"})
+    assert not is_closed_query({"toStartTime": "2999-01-01T00:00:00.000Z"})
@@ -0,0 +1,46 @@
+import pytest
+
+from columnar import BatchBuilder, LLMBatchBuilder, RetrievalBatchBuilder, drop_null_rows
+from records import EvalRecord
+
+
+def llm_observation(index, answer=True):
+    return {
+        "id": f"o{index}", "traceId": f"t{index}",
+        "input": [{"role": "system", "content": "context"}, {"role": "user", "content": f"q{index}"}],
+        "output": {"text": f"a{index}"} if answer else {},
+    }
+
+
+def test_batch_builder_is_abstract():
+    with pytest.raises(TypeError):
+        BatchBuilder()
+
+
+def test_llm_batch_keeps_columns_aligned():
+    builder = LLMBatchBuilder(chunk_size=2)
+    builder.extend([llm_observation(0), llm_observation(1, answer=False), EvalRecord.from_observation(llm_observation(2))])
+    table = builder.finish()
+    assert table.column_names == ["question", "contexts", "answer", "trace_id", "observation_id"]
+    assert table["answer"].to_pylist() == ["a0", None, "a2"]
+    assert table["contexts"].to_pylist() == [["context"]] * 3
+    remaining, dropped = drop_null_rows(table, "answer")
+    assert remaining["observation_id"].to_pylist() == ["o0", "o2"]
+    assert dropped == ["o1"]
+
+
+def test_retrieval_batch_drops_observations_without_query():
+    builder = RetrievalBatchBuilder()
+    builder.extend([
+        {"id": "o0", "traceId": "t0", "input": {"query": "q"},
+         "output": {"result": [{"title": "x", "content": "y"}, {"title": "no content"}]}},
+        {"id": "o1", "traceId": "t1", "input": "not a dict"},
+        {"id": "o2", "traceId": "t2", "input": {"text": "no query"}},
+        {"id": "o3", "traceId": "t3", "input": {"query": "q3"}},
+    ])
+    table = builder.finish()
+    assert builder.dropped == 2
+    assert table.to_pylist() == [
+        {"query": "q", "retrieval result": {"title": ["x"], "content": ["y"]}, "trace_id": "t0", "observation_id": "o0"},
+        {"query": "q3", "retrieval result": {"title": [], "content": []}, "trace_id": "t3", "observation_id": "o3"},
+    ]
@@ -0,0 +1,51 @@
+import importlib
+import sys
+import types
+
+import numpy as np
+import pytest
+
+
+class FakeBaseRagasEmbeddings:
+    pass
+
+
+class FakeEmbeddings:
+    run_config = None
+
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+@pytest.fixture
+def embedding_cache(monkeypatch):
+    # embedding_cache subclasses ragas' BaseRagasEmbeddings, which only needs to exist here
+    embeddings = types.ModuleType("ragas.embeddings")
+    embeddings.BaseRagasEmbeddings = FakeBaseRagasEmbeddings
+    monkeypatch.setitem(sys.modules, "ragas", types.ModuleType("ragas"))
+    monkeypatch.setitem(sys.modules, "ragas.embeddings", embeddings)
+    monkeypatch.delitem(sys.modules, "embedding_cache", raising=False)
+    return importlib.import_module("embedding_cache")
+
+
+def test_cosine_helpers(embedding_cache):
+    vectors = np.array([[1, 0], [0, 2], [0, 0]])
+    assert np.allclose(embedding_cache.normalize(vectors), [[1, 0], [0, 1], [0, 0]])
+    assert np.allclose(embedding_cache.cosine_similarity(vectors, [[3, 3]]), [[2 ** -0.5], [2 ** -0.5], [0]])
+    assert np.allclose(embedding_cache.pairwise_cosine(vectors, [[2, 0], [1, 0], [1, 1]]), [1, 0, 0])
+
+
+def test_similarities_embed_each_text_once(embedding_cache, tmp_path):
+    embeddings = FakeEmbeddings()
+    cached = embedding_cache.CachedEmbeddings(
+        embeddings, embedding_cache.EmbeddingStore(str(tmp_path)), model="m")
+    similarities = cached.similarities(["a", "bb"], ["a", "a"])
+    assert np.allclose(similarities, [1, 3 / (5 ** 0.5 * 2 ** 0.5)])
+    assert embeddings.calls == [["a", "bb"]]
+    cached.similarities(["bb"], ["a"])
+    assert embeddings.calls == [["a", "bb"]]
+    assert cached.stats()["hits"] == 2
@@ -0,0 +1,32 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fetch_langfuse import FetchLangfuse
+
+
+class FakeResponse:
+    def json(self):
+        return {}
+
+
+def test_requests_in_flight_stay_within_the_connection_pool():
+    fetch_langfuse = FetchLangfuse("sk", "pk", "http://langfuse", fanout=2)
+    lock = threading.Lock()
+    in_flight = []
+    peak = []
+
+    def get(url, params=None):
+        with lock:
+            in_flight.append(url)
+            peak.append(len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.remove(url)
+        return FakeResponse()
+
+    fetch_langfuse.session.get = get
+    # Nested crawl levels can run fanout ** 3 threads at once
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda index: fetch_langfuse._get_cached("trace", index, f"/t/{index}"), range(32)))
+    assert max(peak) == 4
@@ -0,0 +1,25 @@
+import asyncio
+
+from instrumentation import Metrics
+
+
+def test_log_keeps_live_line_intact(capsys):
+    metrics = Metrics()
+
+    async def main():
+        report = asyncio.create_task(metrics.report(interval=0.01, extra=lambda: "live"))
+        await asyncio.sleep(0.03)
+        metrics.log("message")
+        report.cancel()
+        try:
+            await report
+        except asyncio.CancelledError:
+            pass
+
+    metrics.log("before")
+    asyncio.run(main())
+    metrics.log("after")
+    output = capsys.readouterr().out
+    assert output.startswith("before\n")
+    assert "\r\033[Kmessage\nlive" in output
+    assert output.endswith("\nafter\n")
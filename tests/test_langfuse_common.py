@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta, timezone
+
+from langfuse_common import format_timestamp, group_by_trace, incomplete_indices, parse_timestamp, trace_windows
+
+
+def test_timestamps_round_trip():
+    time = datetime(2024, 9, 12, 8, 30, 1, 250000, tzinfo=timezone.utc)
+    assert format_timestamp(time) == "2024-09-12T08:30:01.250Z"
+    assert format_timestamp(time.replace(tzinfo=None)) == "2024-09-12T08:30:01.250Z"
+    assert format_timestamp(time.astimezone(timezone(timedelta(hours=8)))) == "2024-09-12T08:30:01.250Z"
+    assert parse_timestamp("2024-09-12T08:30:01.250Z") == time
+
+
+def test_trace_windows_split_distant_traces():
+    start = datetime(2024, 9, 12, 8, tzinfo=timezone.utc)
+    timestamps = [start + timedelta(hours=3), start, start + timedelta(minutes=5), start + timedelta(hours=3, minutes=1)]
+    windows = trace_windows(timestamps, slack=60, max_window=600)
+    assert windows == [
+        (start - timedelta(seconds=60), start + timedelta(minutes=5, seconds=60)),
+        (start + timedelta(hours=3) - timedelta(seconds=60), start + timedelta(hours=3, minutes=1, seconds=60)),
+    ]
+    assert trace_windows([]) == []
+
+
+def test_group_by_trace_drops_duplicates_and_other_traces():
+    pages = [
+        [{"id": "o1", "traceId": "t1"}, {"id": "o2", "traceId": "t2"}, {"id": "o3", "traceId": "other"}],
+        [{"id": "o2", "traceId": "t2"}, {"id": "o4", "traceId": "t1"}],
+    ]
+    assert group_by_trace(["t1", "t2", "t3"], pages) == {
+        "t1": [{"id": "o1", "traceId": "t1"}, {"id": "o4", "traceId": "t1"}],
+        "t2": [{"id": "o2", "traceId": "t2"}],
+        "t3": [],
+    }
+
+
+def test_incomplete_indices():
+    observations = [{"input": 1, "output": 2}, {"input": 1}, {"output": 2}, {"input": None, "output": None}]
+    assert incomplete_indices(observations) == [1, 2]
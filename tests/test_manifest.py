@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+
+from manifest import DatasetManifest, item_hash, item_key
+
+
+def test_item_key_ignores_expected_output():
+    assert item_key({"q": "a"}, "ds") == item_key({"q": "a"}, "ds")
+    assert item_key({"q": "a"}, "ds") != item_key({"q": "a"}, "other")
+    assert item_hash({"q": "a"}, "x", "ds") != item_hash({"q": "a"}, "y", "ds")
+
+
+def test_changed_output_updates_the_same_item(tmp_path):
+    manifest = DatasetManifest("ds", directory=str(tmp_path))
+    first = manifest.pending([(0, {"q": "a"}, "x", None), (1, {"q": "b"}, "y", None)], set())
+    assert [id for _, _, _, id in first] == [item_key({"q": "a"}, "ds"), item_key({"q": "b"}, "ds")]
+    for _, _, _, id in first:
+        manifest.record(id)
+    manifest.close()
+
+    manifest = DatasetManifest("ds", directory=str(tmp_path))
+    changed = manifest.pending([(0, {"q": "a"}, "x2", None), (1, {"q": "b"}, "y", None)], set())
+    assert changed == [(0, {"q": "a"}, "x2", item_key({"q": "a"}, "ds"))]
+    manifest.record(changed[0][3])
+    assert manifest.pending([(0, {"q": "a"}, "x2", None)], set()) == []
+    manifest.close()
+
+
+def test_seeded_items_keep_their_ids(tmp_path):
+    manifest = DatasetManifest("ds", directory=str(tmp_path))
+    manifest.seed([SimpleNamespace(id="existing", input={"q": "a"}, expected_output="x")])
+    assert manifest.pending([(0, {"q": "a"}, "x", None)]) == []
+    assert manifest.pending([(0, {"q": "a"}, "x2", None)]) == [(0, {"q": "a"}, "x2", "existing")]
+    manifest.close()
+
+
+def test_duplicate_inputs_upload_once(tmp_path):
+    manifest = DatasetManifest("ds", directory=str(tmp_path))
+    seen = set()
+    assert len(manifest.pending([(0, {"q": "a"}, "x", None), (1, {"q": "a"}, "y", None)], seen)) == 1
+    assert manifest.pending([(2, {"q": "a"}, "z", None)], seen) == []
+    manifest.close()
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from readers import iter_chunks, sample_chunks
+
+
+def frames(rows=20, chunk_size=3, consumed=None):
+    for start in range(0, rows, chunk_size):
+        if consumed is not None:
+            consumed.append(start)
+        index = pd.RangeIndex(start, min(start + chunk_size, rows))
+        yield pd.DataFrame({"value": list(index)}, index=index)
+
+
+def rows(chunks):
+    return [value for chunk in chunks for value in chunk["value"]]
+
+
+def test_iter_chunks_numbers_rows_across_chunks(tmp_path):
+    path = tmp_path / "data.csv"
+    pd.DataFrame({"value": range(7)}).to_csv(path, index=False)
+    chunks = list(iter_chunks(str(path), chunk_size=3))
+    assert [len(chunk) for chunk in chunks] == [3, 3, 1]
+    assert [list(chunk.index) for chunk in chunks][-1] == [6]
+    with pytest.raises(ValueError):
+        list(iter_chunks(str(tmp_path / "data.xml")))
+
+
+def test_head_stops_reading_early():
+    consumed = []
+    assert rows(sample_chunks(frames(consumed=consumed), 5, mode='head')) == [0, 1, 2, 3, 4]
+    assert consumed == [0, 3]
+    consumed.clear()
+    assert rows(sample_chunks(frames(consumed=consumed), 6, mode='head')) == list(range(6))
+    assert consumed == [0, 3]
+    assert rows(sample_chunks(frames(consumed=consumed), 0, mode='head')) == []
+
+
+def test_tail_keeps_the_last_rows():
+    assert rows(sample_chunks(frames(), 5, mode='tail')) == [15, 16, 17, 18, 19]
+    assert rows(sample_chunks(frames(), 50, mode='tail')) == list(range(20))
+    assert rows(sample_chunks(frames(), 0, mode='tail')) == []
+    assert rows(sample_chunks(frames(), -1)) == list(range(20))
+
+
+def test_reservoir_keeps_distinct_rows_in_file_order():
+    sample = next(sample_chunks(frames(), 5, mode='reservoir', seed=7))
+    assert len(sample) == 5
+    assert list(sample.index) == sorted(set(sample.index))
+    assert list(sample["value"]) == list(sample.index)
+    assert rows(sample_chunks(frames(), 5, mode='reservoir', seed=7)) == list(sample["value"])
+    assert rows(sample_chunks(frames(), 50, mode='reservoir', seed=7)) == list(range(20))
+    assert rows(sample_chunks(frames(), 0, mode='reservoir')) == []
+    with pytest.raises(ValueError):
+        list(sample_chunks(frames(), 5, mode='random'))
+
+
+def test_reservoir_is_uniform():
+    # Every row, in the first chunk or the last, is kept with probability sample_size / rows
+    trials = 400
+    counts = np.zeros(20)
+    for seed in range(trials):
+        for value in rows(sample_chunks(frames(rows=20, chunk_size=3), 5, mode='reservoir', seed=seed)):
+            counts[value] += 1
+    expected = trials * 5 / 20
+    # Five standard deviations of a binomial count
+    assert np.all(np.abs(counts - expected) < 5 * np.sqrt(trials * 0.25 * 0.75))
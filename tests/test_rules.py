@@ -0,0 +1,94 @@
+from rules import Eq, In, Regex, RuleSet, Rules, compile_rules
+
+
+def llm_observation(id, name="llm", type="SPAN", **metadata):
+    return {"id": id, "name": name, "type": type, "metadata": metadata or None}
+
+
+class CountingEq(Eq):
+    def __init__(self, field, value):
+        super().__init__(field, value)
+        self.calls = 0
+
+    def test(self, value):
+        self.calls += 1
+        return super().test(value)
+
+
+def test_key_predicates_run_once_per_bucket():
+    name = CountingEq('name', 'llm')
+    node = CountingEq('metadata.node_type', 'llm')
+    rules = RuleSet([name, Eq('type', 'SPAN'), node])
+    data = [llm_observation(index, node_type='llm') for index in range(50)]
+    data += [llm_observation(index, name="knowledge-retrieval") for index in range(50, 100)]
+    assert rules.select_indices(data) == list(range(50))
+    assert name.calls == 2
+    assert node.calls == 50
+
+
+def test_missing_fields_fail_instead_of_raising():
+    rules = Rules().llm_rules
+    data = [
+        llm_observation("ok", node_name='LLM', node_type='llm'),
+        llm_observation("no metadata"),
+        {"id": "no name or type", "metadata": {"node_name": 'LLM', "node_type": 'llm'}},
+        llm_observation("other node", node_name='LLM', node_type='code'),
+    ]
+    assert rules.select_indices(data) == [0]
+    assert In('metadata.node_type', ['llm'])(data[1]) is False
+    assert Regex('metadata.node_name', '^LL')(data[1]) is False
+
+
+def test_lambda_rules_fall_back_to_a_safe_call():
+    rules = RuleSet([Eq('name', 'llm'), lambda item: item['metadata']['node_type'] == 'llm'])
+    data = [
+        llm_observation(0, node_type='llm'),
+        llm_observation(1),
+        {"id": 2, "name": "llm", "type": "SPAN"},
+        llm_observation(3, node_type='code'),
+    ]
+    assert rules.select_indices(data) == [0]
+    assert rules(data[0]) and not rules(data[2])
+    # A plain list of rules is accepted wherever a RuleSet is
+    assert compile_rules(list(rules)).select_indices(data) == [0]
+
+
+def test_compiled_matcher_follows_changes_to_the_rules():
+    rules = RuleSet([Eq('name', 'llm')])
+    data = [llm_observation(0, node_type='llm'), llm_observation(1, node_type='code')]
+    assert rules.select_indices(data) == [0, 1]
+    rules.append(Eq('metadata.node_type', 'llm'))
+    assert rules.select_indices(data) == [0]
+
+
+def test_split_sends_exact_matches_on_query_fields_to_the_server():
+    custom = lambda item: True  # noqa: E731
+    rules = RuleSet([
+        Eq('name', 'llm'),
+        Eq('type', 'SPAN'),
+        Eq('name', 'duplicate'),
+        In('type', ['SPAN', 'GENERATION']),
+        Eq('metadata.node_type', 'llm'),
+        custom,
+    ])
+    query, residual = rules.split()
+    assert query == {"name": "llm", "type": "SPAN"}
+    assert isinstance(residual, RuleSet)
+    assert [repr(rule) for rule in residual[:3]] == [
+        "Eq('name', 'duplicate')", "In('type', ['GENERATION', 'SPAN'])", "Eq('metadata.node_type', 'llm')"]
+    assert residual[3] is custom
+
+
+def test_query_and_residual_select_what_the_rule_set_selects():
+    rules = Rules().llm_rules
+    query, residual = rules.split()
+    assert query == {"name": "llm", "type": "SPAN"}
+    data = [
+        llm_observation(0, node_name='LLM', node_type='llm'),
+        llm_observation(1, name='other', node_name='LLM', node_type='llm'),
+        llm_observation(2, node_name='LLM', node_type='code'),
+        llm_observation(3),
+    ]
+    served = [item for item in data if all(item.get(field) == value for field, value in query.items())]
+    assert [served[index]["id"] for index in residual.select_indices(served)] == [0]
+    assert [data[index]["id"] for index in rules.select_indices(data)] == [0]
@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+from scheduler import worker_pool
+
+
+def test_worker_pool_draws_items_lazily_and_keeps_order():
+    drawn = []
+    in_flight = []
+    peak = []
+    done = []
+
+    def items():
+        for index in range(20):
+            drawn.append(index)
+            yield index
+
+    async def work(item):
+        # An item is only drawn when a worker is free
+        assert len(drawn) <= len(done) + 3
+        in_flight.append(item)
+        peak.append(len(in_flight))
+        # Later items finish first, the results still come back in item order
+        await asyncio.sleep(0.001 * (20 - item))
+        in_flight.remove(item)
+        done.append(item)
+        return item * 2
+
+    assert asyncio.run(worker_pool(work, items(), workers=3)) == [index * 2 for index in range(20)]
+    assert max(peak) == 3
+
+
+def test_worker_pool_failure_cancels_other_workers():
+    started = []
+
+    async def work(item):
+        started.append(item)
+        if item == 2:
+            raise RuntimeError("boom")
+        await asyncio.sleep(10)
+
+    with pytest.raises(ExceptionGroup) as excinfo:
+        asyncio.run(asyncio.wait_for(worker_pool(work, range(100), workers=4), 5))
+    assert excinfo.group_contains(RuntimeError)
+    assert started == [0, 1, 2, 3]
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+from snapshot import DatasetSnapshot
+
+
+class FakeFetchLangfuse:
+    def __init__(self, items):
+        self.items = items
+        self.calls = []
+
+    async def fetch_dataset_items(self, **params):
+        pass
+
+    async def iter_pages(self, fetch_page, page_size=50, prefetch=True, **params):
+        self.calls.append(prefetch)
+        for item in self.items:
+            yield item
+
+
+def dataset_item(index, timestamp):
+    return {"id": f"i{index}", "status": "ACTIVE", "input": {"ask": f"q{index}"}, "expectedOutput": "a",
+            "createdAt": timestamp, "updatedAt": timestamp}
+
+
+def test_missing_snapshot_raises(tmp_path):
+    snapshot = DatasetSnapshot("ds", FakeFetchLangfuse([]), directory=str(tmp_path))
+    assert snapshot.info() is None
+    with pytest.raises(FileNotFoundError):
+        snapshot.items
+
+
+def test_refresh_merges_delta(tmp_path):
+    fetch_langfuse = FakeFetchLangfuse([
+        dataset_item(1, "2024-01-01T00:00:02Z"), dataset_item(0, "2024-01-01T00:00:01Z")])
+    snapshot = DatasetSnapshot("ds", fetch_langfuse, directory=str(tmp_path))
+    assert asyncio.run(snapshot.refresh()) == 2
+    assert [item.input for item in snapshot.items] == [{"ask": "q1"}, {"ask": "q0"}]
+
+    edited = dict(dataset_item(0, "2024-01-01T00:00:01Z"), updatedAt="2024-01-01T00:00:03Z", expectedOutput="b")
+    fetch_langfuse.items = [dataset_item(2, "2024-01-01T00:00:04Z"), edited, dataset_item(1, "2024-01-01T00:00:02Z")]
+    assert asyncio.run(snapshot.refresh()) == 2
+    assert {item.id: item.expected_output for item in snapshot.items} == {"i2": "a", "i0": "b", "i1": "a"}
+    assert snapshot.info()["watermark"] == "2024-01-01T00:00:04Z"
+    # The first refresh has no watermark and prefetches, the delta scan does not
+    assert fetch_langfuse.calls == [True, False]
@@ -0,0 +1,97 @@
+import sys
+import types
+
+import pytest
+
+import utils
+
+
+class FakeRunConfig:
+    pass
+
+
+class FakeLangchainLLMWrapper:
+    def __init__(self, llm):
+        self.langchain_llm = llm
+        self.run_config = FakeRunConfig()
+
+
+class FakeBaseRagasEmbeddings:
+    pass
+
+
+class FakeLangchainEmbeddingsWrapper(FakeBaseRagasEmbeddings):
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.run_config = FakeRunConfig()
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+class FakeOpenAI:
+    def __init__(self, model=None, **kwargs):
+        self.model = model
+        self.model_name = model
+
+
+@pytest.fixture
+def ragas_stack(monkeypatch):
+    # Stand-ins for ragas and langchain_openai, which only need to be constructible here
+    modules = {
+        "ragas": types.ModuleType("ragas"),
+        "ragas.llms": types.ModuleType("ragas.llms"),
+        "ragas.embeddings": types.ModuleType("ragas.embeddings"),
+        "langchain_openai": types.ModuleType("langchain_openai"),
+        "langchain_openai.chat_models": types.ModuleType("langchain_openai.chat_models"),
+        "langchain_openai.embeddings": types.ModuleType("langchain_openai.embeddings"),
+    }
+    modules["ragas.llms"].LangchainLLMWrapper = FakeLangchainLLMWrapper
+    modules["ragas.embeddings"].LangchainEmbeddingsWrapper = FakeLangchainEmbeddingsWrapper
+    modules["ragas.embeddings"].BaseRagasEmbeddings = FakeBaseRagasEmbeddings
+    modules["langchain_openai.chat_models"].ChatOpenAI = FakeOpenAI
+    modules["langchain_openai.embeddings"].OpenAIEmbeddings = FakeOpenAI
+    for name, module in modules.items():
+        monkeypatch.setitem(sys.modules, name, module)
+    monkeypatch.delitem(sys.modules, "embedding_cache", raising=False)
+    monkeypatch.setenv("RAGAS_CRITIC_LLM", "critic")
+    monkeypatch.setenv("RAGAS_EMBEDDING", "text-embedding")
+    monkeypatch.delenv("CRITIC_CACHE_PATH", raising=False)
+
+
+def test_embeddings_without_cache(ragas_stack, monkeypatch):
+    monkeypatch.delenv("EMBEDDING_CACHE_DIR", raising=False)
+    _, embeddings = utils.get_ragas_llm_and_embeddings()
+    assert isinstance(embeddings, FakeLangchainEmbeddingsWrapper)
+
+
+def test_embeddings_with_cache(ragas_stack, monkeypatch, tmp_path):
+    monkeypatch.setenv("EMBEDDING_CACHE_DIR", str(tmp_path))
+    _, embeddings = utils.get_ragas_llm_and_embeddings()
+
+    from embedding_cache import CachedEmbeddings
+    assert isinstance(embeddings, CachedEmbeddings)
+    assert isinstance(embeddings.embeddings, FakeLangchainEmbeddingsWrapper)
+    assert embeddings.embed_documents(["a", "bb", "a"]) == [[1.0, 1.0], [2.0, 1.0], [1.0, 1.0]]
+    assert embeddings.embed_documents(["bb"]) == [[2.0, 1.0]]
+    assert embeddings.embeddings.calls == [["a", "bb"]]
+    assert (tmp_path / "text-embedding" / "vectors.f32").exists()
+
+
+def test_metric_attribute_names(monkeypatch):
+    class Metric:
+        def __init__(self, name):
+            self.name = name
+
+    module = types.ModuleType("ragas.metrics")
+    module.answer_similarity = Metric("semantic_similarity")
+    module.faithfulness = Metric("faithfulness")
+    ragas = types.ModuleType("ragas")
+    ragas.metrics = module
+    monkeypatch.setitem(sys.modules, "ragas", ragas)
+    monkeypatch.setitem(sys.modules, "ragas.metrics", module)
+    assert utils.metric_attribute_names([module.answer_similarity, module.faithfulness]) == ["answer_similarity", "faithfulness"]
+    with pytest.raises(ValueError):
+        utils.metric_attribute_names([Metric("custom")])
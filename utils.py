@@ -7,75 +7,37 @@ Description: file content
 '''
 # from fetch_langfuse import FetchLangfuse
 import aiohttp
+import json
 import os
+import time
+from columnar import LLMBatchBuilder, RetrievalBatchBuilder, to_dataset
 
 def process_llm_batch(llm_observations):
     """Process a batch of LLM observations.
 
     Args:
-        llm_observations (list): A list of LLM observations.
+        llm_observations (iterable): The LLM observations or their EvalRecords.
 
     Returns:
-        dict: A dictionary containing the processed evaluation batch.
+        pa.Table: The question, contexts, answer, trace_id and observation_id columns,
+            with a null answer where the observation has no output text.
     """
-    evaluation_batch = {
-        "question": [],
-        "contexts": [],
-        "answer": [],
-        "trace_id": [],
-        "observation_id": []
-    }
-    for observation in llm_observations:
-        d = dict(observation)
-        question = ""
-        context = []
-        for item in d["input"]:
-            if item["role"] == "user":
-                question = item["content"]
-            elif item["role"] == "system":
-                context.append(item["content"])
-
-        evaluation_batch["question"].append(question)
-        evaluation_batch["contexts"].append(context)
-
-        if "output" in d and "text" in d["output"]:
-            evaluation_batch["answer"].append(d["output"]["text"])
-        evaluation_batch["trace_id"].append(observation["traceId"])
-        evaluation_batch["observation_id"].append(observation["id"])
-    
-    return evaluation_batch
+    builder = LLMBatchBuilder()
+    builder.extend(llm_observations)
+    return builder.finish()
 
 def process_retrieval_batch(retrieval_observations):
     """Process a batch of retrieval observations.
 
     Args:
-        retrieval_observations (list): A list of retrieval observations.
+        retrieval_observations (iterable): The retrieval observations.
 
     Returns:
-        dict: A dictionary containing the processed evaluation batch.
+        pa.Table: The query, retrieval result, trace_id and observation_id columns.
     """
-    evaluation_batch = {
-        "query": [],
-        "retrieval result": [],
-        "trace_id": [],
-        "observation_id": []
-    }
-    for observation in retrieval_observations:
-        d = dict(observation)
-        query = d["input"]["query"]
-        retrieval_result = {"title": [], "content": []}
-
-        evaluation_batch["query"].append(query)
-        if "output" in d:
-            for item in d["output"]["result"]:
-                if "title" in item and "content" in item:
-                    retrieval_result["title"].append(item["title"])
-                    retrieval_result["content"].append(item["content"])
-        evaluation_batch["retrieval result"].append(retrieval_result)
-        evaluation_batch["trace_id"].append(observation["traceId"])
-        evaluation_batch["observation_id"].append(observation["id"])
-    
-    return evaluation_batch
+    builder = RetrievalBatchBuilder()
+    builder.extend(retrieval_observations)
+    return builder.finish()
 
 def pull_scores_to_langfuse(langfuse, scores, scores_keys, node_name=None):
     """Pull scores to Langfuse.
@@ -160,7 +122,8 @@ async def send_chat_message(
     inputs={},
     response_mode: ["streaming", "blocking"] = "blocking",
     user: str = "abc-123",
-    file_array = []
+    file_array = [],
+    session = None
     ):
     """Send a chat message.
 
@@ -172,9 +135,11 @@ async def send_chat_message(
         response_mode (str, optional): The response mode for the chat message. Defaults to "blocking".
         user (str, optional): The user identifier. Defaults to "abc-123".
         file_array (list, optional): An array of files to be sent with the chat message. Defaults to [].
+        session (aiohttp.ClientSession, optional): A session to reuse. Defaults to None (a new session per call).
 
     Returns:
-        dict: The response from the chat message API.
+        dict: The response from the chat message API. In streaming mode, the answer assembled from the
+            events with conversation_id, message_id, metadata and latency (ttft, itl, total in seconds).
     """
     base_url = f"{url}/chat-messages"
     headers = {
@@ -189,13 +154,71 @@ async def send_chat_message(
         "user": user,
         "files": file_array
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(base_url, headers=headers, json=payload) as response:
+    if session is None:
+        async with aiohttp.ClientSession() as session:
+            return await _post_chat_message(session, base_url, headers, payload)
+    return await _post_chat_message(session, base_url, headers, payload)
+
+async def _post_chat_message(session, base_url, headers, payload):
+    start = time.monotonic()
+    async with session.post(base_url, headers=headers, json=payload) as response:
+        if payload["response_mode"] != "streaming" or response.content_type != "text/event-stream":
             return await response.json()
+        return await read_chat_stream(response, start)
+
+async def read_chat_stream(response, start=None):
+    """Assemble a streaming chat message from Dify's server-sent events.
+
+    Args:
+        response (aiohttp.ClientResponse): The streaming response.
+        start (float, optional): The time.monotonic() the request was sent at. Defaults to now.
+
+    Returns:
+        dict: The answer, conversation_id, message_id, metadata and latency of the message.
+    """
+    start = time.monotonic() if start is None else start
+    result = {
+        "answer": "",
+        "conversation_id": None,
+        "message_id": None,
+        "metadata": {},
+    }
+    token_times = []
+    buffer = b""
+    async for chunk in response.content.iter_any():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            event = json.loads(line[5:])
+            event_type = event.get("event")
+            if event_type == "error":
+                raise RuntimeError(f"Dify error {event.get('status')} {event.get('code')}: {event.get('message')}")
+            result["conversation_id"] = event.get("conversation_id", result["conversation_id"])
+            result["message_id"] = event.get("message_id", result["message_id"])
+            if event_type in ("message", "agent_message") and event.get("answer"):
+                token_times.append(time.monotonic())
+                result["answer"] += event["answer"]
+            elif event_type == "message_replace":
+                result["answer"] = event.get("answer", "")
+            elif event_type == "message_end":
+                result["metadata"] = event.get("metadata", {})
+    end = time.monotonic()
+    result["latency"] = {
+        "ttft": token_times[0] - start if token_times else None,
+        "itl": [later - earlier for earlier, later in zip(token_times, token_times[1:])],
+        "total": end - start,
+    }
+    return result
 
 def get_ragas_llm_and_embeddings():
     """Get Ragas LLM and Embeddings.
 
+    The LLM answers repeated judgements from a persistent cache when CRITIC_CACHE_PATH is set,
+    and the embeddings reuse stored vectors when EMBEDDING_CACHE_DIR is set.
+
     Returns:
         tuple: A tuple containing the LLM and embeddings objects.
     """
@@ -214,6 +237,11 @@ def get_ragas_llm_and_embeddings():
             max_retries=2,
         )
     )
+    from cache import SQLiteCache
+    critic_cache = SQLiteCache.from_env(prefix="CRITIC_CACHE")
+    if critic_cache is not None:
+        from critic_cache import CachedLLMWrapper
+        llm = CachedLLMWrapper(llm, critic_cache)
     embeddings = LangchainEmbeddingsWrapper(
         OpenAIEmbeddings(
             model=os.getenv("RAGAS_EMBEDDING"),
@@ -221,4 +249,59 @@ def get_ragas_llm_and_embeddings():
             api_key=os.getenv("RAGAS_API_KEY"),
         )
     )
-    return llm, embeddings
\ No newline at end of file
+    embedding_cache_dir = os.getenv("EMBEDDING_CACHE_DIR")
+    if embedding_cache_dir:
+        import re
+        from embedding_cache import CachedEmbeddings, EmbeddingStore
+        store = EmbeddingStore(os.path.join(embedding_cache_dir, re.sub(r'[^\w.-]+', '_', os.getenv("RAGAS_EMBEDDING") or 'default')))
+        embeddings = CachedEmbeddings(embeddings, store, batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", 256)))
+    return llm, embeddings
+
+
+def metric_attribute_names(metrics):
+    """Find the names under which ragas metrics are exported by ragas.metrics.
+
+    A metric's own name can differ from its attribute, e.g. answer_similarity is named
+    "semantic_similarity", so evaluate_shard looks metrics up by attribute name.
+
+    Args:
+        metrics (list): The ragas metric instances.
+
+    Returns:
+        list: The attribute name of every metric in ragas.metrics.
+
+    Raises:
+        ValueError: If a metric is not one of the instances exported by ragas.metrics.
+    """
+    import ragas.metrics
+    names = {id(value): name for name, value in vars(ragas.metrics).items()}
+    missing = [metric.name for metric in metrics if id(metric) not in names]
+    if missing:
+        raise ValueError(f"Sharded evaluation only supports metrics exported by ragas.metrics, got {missing}")
+    return [names[id(metric)] for metric in metrics]
+
+
+def evaluate_shard(batch, metric_names, max_workers=16):
+    """Evaluate one shard of an evaluation batch in a worker process.
+
+    The worker builds its own critic LLM and embeddings from the environment, and the
+    ragas metrics are passed by name so that the arguments stay picklable.
+
+    Args:
+        batch (pa.Table): The rows of the shard, as built by process_llm_batch with a ground_truth column.
+        metric_names (list): The attribute names of the metrics in ragas.metrics, see metric_attribute_names.
+        max_workers (int, optional): The critic concurrency within the shard. Defaults to 16.
+
+    Returns:
+        pd.DataFrame: The scores of the shard with its trace_id and observation_id columns.
+    """
+    import ragas.metrics
+    from ragas import evaluate, RunConfig
+    llm, embeddings = get_ragas_llm_and_embeddings()
+    metrics = [getattr(ragas.metrics, name) for name in metric_names]
+    dataset = to_dataset(batch)
+    scores = evaluate(dataset, metrics=metrics, llm=llm, embeddings=embeddings,
+                      run_config=RunConfig(max_workers=max_workers))
+    scores['trace_id'] = dataset['trace_id']
+    scores['observation_id'] = dataset['observation_id']
+    return scores.to_pandas()